@@ -0,0 +1,126 @@
+"""
+Agent 模式：模型可以调用本地工具，多轮循环直到给出最终回答
+- 同一轮返回的多个工具调用并发执行，每个工具有独立超时，每轮耗时取决于最慢的工具
+- 工具结果（或错误信息）作为 ToolMessage 返回给模型，进入下一轮
+- 超过最大轮数（AGENT_MAX_STEPS）后不再提供工具，要求模型直接回答
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage, ToolMessage
+
+from app.chat_service import ainvoke_message, estimate_tokens
+from app.deadline import Deadline, get_current_deadline
+from app.tools import ToolRegistry, aget_tool_registry
+
+logger = logging.getLogger(__name__)
+
+# 最多执行的工具调用轮数
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", 5))
+
+AGENT_SYSTEM_PROMPT = """你是一个专业的AI编程助手，可以调用工具来验证代码和获取信息。
+需要多个互不依赖的工具结果时，请在同一轮中一次性发起所有工具调用，它们会被并行执行。
+拿到足够信息后直接给出最终回答。请用中文回答。"""
+
+
+async def run_tool_call(registry: ToolRegistry, call: Dict[str, Any], deadline: Optional[Deadline]) -> Dict[str, Any]:
+    """
+    执行一个工具调用，出错或超时时把错误信息作为结果返回给模型
+
+    Returns:
+        {"id", "name", "args", "output", "ok", "elapsed_ms"}
+    """
+    name = call.get("name")
+    args = call.get("args") or {}
+    started = time.perf_counter()
+    tool = registry.get(name)
+    ok = False
+    if tool is None:
+        output = f"错误：未知工具 {name}，可用工具：{', '.join(registry.names())}"
+    else:
+        timeout = tool.timeout if deadline is None else min(tool.timeout, deadline.remaining())
+        try:
+            output = await asyncio.wait_for(tool.run(args), timeout=timeout)
+            ok = True
+        except asyncio.TimeoutError:
+            output = f"错误：工具 {name} 执行超时（{timeout:.1f}s）"
+        except TypeError as e:
+            # 模型给出的参数与工具定义不符
+            output = f"错误：工具参数不正确：{e}"
+        except Exception as e:
+            logger.warning(f"Tool {name} failed: {e}")
+            output = f"错误：工具执行失败：{e}"
+    return {
+        "id": call.get("id"),
+        "name": name,
+        "args": args,
+        "output": output,
+        "ok": ok,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+async def run_agent(messages: List[BaseMessage], temperature: Optional[float] = None,
+                    max_tokens: Optional[int] = None, deadline: Optional[Deadline] = None,
+                    registry: Optional[ToolRegistry] = None, max_steps: int = AGENT_MAX_STEPS) -> Dict[str, Any]:
+    """
+    运行 Agent 循环
+
+    Args:
+        messages: LangChain 消息列表（没有 system 消息时使用 Agent 系统提示）
+        temperature: 温度参数
+        max_tokens: 每次模型调用的最大token数
+        deadline: 截止时间，默认使用当前请求的截止时间
+        registry: 工具注册表，默认使用内置工具
+        max_steps: 最多执行的工具调用轮数
+
+    Returns:
+        {"message": 最终回答, "steps": 每轮的工具调用记录, "estimated_tokens": 估算的 token 数}
+    """
+    deadline = deadline or get_current_deadline()
+    registry = registry or await aget_tool_registry()
+    tools = registry.schemas()
+    messages = list(messages)
+    if not any(isinstance(m, SystemMessage) for m in messages):
+        messages.insert(0, SystemMessage(content=AGENT_SYSTEM_PROMPT))
+
+    steps = []
+    estimated_tokens = 0
+    while True:
+        # 达到轮数上限后不再提供工具，要求模型根据已有结果直接回答
+        offer_tools = tools if len(steps) < max_steps else None
+        estimated_tokens += estimate_tokens("".join(str(m.content) for m in messages))
+        response: AIMessage = await ainvoke_message(messages, temperature, max_tokens, deadline, offer_tools)
+        estimated_tokens += estimate_tokens(str(response.content))
+        tool_calls = getattr(response, "tool_calls", None) or []
+        if not tool_calls or offer_tools is None:
+            return {
+                "message": response.content if isinstance(response.content, str) else str(response.content),
+                "steps": steps,
+                "estimated_tokens": estimated_tokens,
+            }
+
+        # 同一轮的工具调用互不依赖，并发执行
+        results = await asyncio.gather(*[run_tool_call(registry, call, deadline) for call in tool_calls])
+        messages.append(response)
+        for result in results:
+            messages.append(ToolMessage(content=result["output"], tool_call_id=result["id"]))
+        steps.append([{k: v for k, v in result.items() if k != "id"} for result in results])
+        logger.info(f"Agent step {len(steps)}: " + ", ".join(
+            f"{r['name']}({r['elapsed_ms']}ms{'' if r['ok'] else ', failed'})" for r in results
+        ))
+
+
+def format_steps(steps: List[List[Dict[str, Any]]]) -> str:
+    """把工具调用记录格式化为 Markdown（用于 Gradio 界面展示）"""
+    lines = []
+    for i, step in enumerate(steps, 1):
+        for call in step:
+            status = "✅" if call["ok"] else "⚠️"
+            args = json.dumps(call["args"], ensure_ascii=False)
+            lines.append(f"{status} 第 {i} 轮 `{call['name']}` {args[:200]}（{call['elapsed_ms']:.0f}ms）")
+    return "\n".join(lines)
@@ -0,0 +1,167 @@
+"""
+DeepSeek Chat Agent API 的异步客户端
+供独立部署的 Gradio UI（gradio_app_api.py）使用：
+- 进程内共享一个 httpx.AsyncClient，复用 keep-alive 连接池，安装了 h2 时启用 HTTP/2
+- 消费 /api/chat/stream 流式接口，逐块返回回复
+- 连接阶段出错时自动重试（此时服务端尚未返回任何内容，重试是幂等的）
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from app.deadline import Deadline, DeadlineExceeded, iterate_with_deadline
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 需要额外安装 h2（pip install httpx[http2]），未安装时使用 HTTP/1.1 keep-alive
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# API 配置
+API_BASE_URL = os.getenv("CHAT_API_BASE_URL", "http://localhost:8080")
+# 单次读取超时（秒）：流式接口下只要持续有数据返回就不会超时
+API_TIMEOUT = float(os.getenv("CHAT_API_TIMEOUT", 60))
+API_MAX_CONNECTIONS = int(os.getenv("CHAT_API_MAX_CONNECTIONS", 100))
+API_MAX_RETRIES = int(os.getenv("CHAT_API_MAX_RETRIES", 2))
+# 每轮对话的总截止时间（秒），包括重试，剩余时间通过 X-Request-Timeout 传给服务端
+API_DEADLINE = float(os.getenv("CHAT_API_DEADLINE", 300))
+
+# 可以安全重试的错误：只限连接阶段，此时请求尚未发到服务端。
+# RemoteProtocolError 等错误可能发生在服务端已经开始生成之后，重试会重复生成并重复计费
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class ChatAPIError(Exception):
+    """服务端在流式响应中返回的错误"""
+
+
+class ChatAPIClient:
+    """聊天 API 异步客户端"""
+
+    def __init__(self, base_url: str = API_BASE_URL, timeout: float = API_TIMEOUT,
+                 max_connections: int = API_MAX_CONNECTIONS, max_retries: int = API_MAX_RETRIES):
+        """
+        初始化客户端
+
+        Args:
+            base_url: API 服务地址
+            timeout: 读取超时（秒）
+            max_connections: 连接池最大连接数
+            max_retries: 连接错误时的最大重试次数
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """延迟创建 AsyncClient（需要在事件循环中创建）"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(self.timeout, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections
+                )
+            )
+        return self._client
+
+    async def stream_chat(self, messages: List[Dict[str, str]], temperature: float = 0.7,
+                          max_tokens: int = 5000, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+        """
+        流式调用聊天接口
+
+        Args:
+            messages: 完整对话历史
+            temperature: 温度参数
+            max_tokens: 最大token数
+            deadline: 总截止时间（包括重试），默认 CHAT_API_DEADLINE 秒
+
+        Yields:
+            新生成的回复文本片段
+
+        Raises:
+            ChatAPIError: 服务端返回错误事件，或流在结束事件之前中断
+            DeadlineExceeded: 超过截止时间
+            httpx.HTTPError: 网络或 HTTP 错误
+        """
+        deadline = deadline or Deadline(API_DEADLINE)
+        request_data = {
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        attempt = 0
+        while True:
+            deadline.check()
+            received = False
+            remaining = deadline.remaining()
+            try:
+                async with self._get_client().stream(
+                    "POST",
+                    "/api/chat/stream",
+                    json=request_data,
+                    # 服务端据此限制上游超时和 max_tokens（/api/chat/stream 按路由属于 interactive）
+                    headers={"X-Request-Timeout": f"{remaining:.3f}"},
+                    timeout=httpx.Timeout(min(self.timeout, remaining), connect=min(5.0, remaining))
+                ) as response:
+                    if response.status_code == 504:
+                        raise DeadlineExceeded("服务端判断剩余时间不足以生成回复")
+                    response.raise_for_status()
+                    async for line in iterate_with_deadline(response.aiter_lines(), deadline):
+                        if not line.startswith("data: "):
+                            continue
+                        event = json.loads(line[len("data: "):])
+                        if "error" in event:
+                            raise ChatAPIError(event["error"])
+                        if "delta" in event:
+                            received = True
+                            yield event["delta"]
+                        if event.get("done"):
+                            return
+                # 没有收到结束事件：连接被提前关闭，回复不完整
+                raise ChatAPIError("回复不完整：流式响应在结束前中断")
+            except RETRYABLE_ERRORS as e:
+                # 已经收到部分内容时重试会导致回复重复，直接抛出
+                if received or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                backoff = 0.2 * 2 ** attempt
+                # 剩余时间不够再试一次时不再重试
+                if deadline.remaining() <= backoff:
+                    raise
+                logger.warning(f"Chat API connection error ({e.__class__.__name__}), retry {attempt}/{self.max_retries}")
+                await asyncio.sleep(backoff)
+
+    async def chat(self, messages: List[Dict[str, str]], temperature: float = 0.7, max_tokens: int = 5000,
+                   deadline: Optional[Deadline] = None) -> str:
+        """调用流式接口并返回完整回复"""
+        return "".join([chunk async for chunk in self.stream_chat(messages, temperature, max_tokens, deadline)])
+
+    async def check_health(self) -> bool:
+        """检查 API 服务是否可用"""
+        try:
+            response = await self._get_client().get("/health", timeout=5)
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def aclose(self):
+        """关闭连接池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# 进程内共享的客户端（所有会话复用同一个连接池）
+api_client = ChatAPIClient()
@@ -10,16 +10,24 @@ from langchain_core.prompts import (
 )
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
+from app.ollama_backend import OllamaBackend, OllamaBusy, OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE, OLLAMA_MODELS
+from app.ui_queue import configure_queue, chat_event_options
+
 
 # Initialize the chat engine
 def get_llm_engine(model_name):
     return ChatOllama(
         model=model_name,
-        base_url="http://127.0.0.1:11434",
-        temperature=0.3
+        base_url=OLLAMA_BASE_URL,
+        temperature=0.3,
+        keep_alive=OLLAMA_KEEP_ALIVE  # keep the model resident between messages
     )
 
 
+# One shared client per model, preloaded and kept warm in the background
+ollama_backend = OllamaBackend(get_llm_engine)
+
+
 # System prompt configuration
 SYSTEM_TEMPLATE = """You are an expert AI coding assistant. Provide concise, correct solutions 
 with strategic print statements for debugging. Always respond in English."""
@@ -55,14 +63,18 @@ class ChatBot:
     def chat(self, message, model_choice, history):
         if not message:
             return "", history
-            
-        llm_engine = get_llm_engine(model_choice)
         
         # Add user message to log
         self.message_log.append({"role": "user", "content": message})
         
-        # Generate AI response
-        ai_response = self.generate_ai_response(message, llm_engine)
+        # Generate AI response (queues when the model is at its concurrency limit)
+        try:
+            with ollama_backend.lease(model_choice) as llm_engine:
+                ai_response = self.generate_ai_response(message, llm_engine)
+        except OllamaBusy as e:
+            self.message_log.pop()
+            history.append((message, f"⚠️ {e}"))
+            return "", history
         
         # Add AI response to log
         self.message_log.append({"role": "ai", "content": ai_response})
@@ -92,8 +104,8 @@ def create_demo():
                 
             with gr.Column(scale=1):
                 model_dropdown = gr.Dropdown(
-                    choices=["deepseek-r1:1.5b", "deepseek-r1:3b"],
-                    value="deepseek-r1:1.5b",
+                    choices=OLLAMA_MODELS or ["deepseek-r1:1.5b", "deepseek-r1:3b"],
+                    value=(OLLAMA_MODELS or ["deepseek-r1:1.5b"])[0],
                     label="Choose Model"
                 )
                 
@@ -105,17 +117,29 @@ def create_demo():
                 - 💡 Solution Design
                 """)
                 
+                gr.Markdown("### Model Status")
+                # Per-model concurrency limit, in-flight/queued requests and warm state
+                model_status = gr.JSON(label="Local models")
+                refresh_status = gr.Button("Refresh", size="sm")
+
                 gr.Markdown("Built with [Ollama](https://ollama.ai/) | [LangChain](https://python.langchain.com/)")
 
+        # Chats run concurrently (the per-model limits in ollama_backend decide who queues),
+        # instead of Gradio's default of one event at a time
         msg.submit(
             fn=chatbot.chat,
             inputs=[msg, model_dropdown, chatbot_component],
-            outputs=[msg, chatbot_component]
+            outputs=[msg, chatbot_component],
+            **chat_event_options()
         )
+        refresh_status.click(fn=ollama_backend.snapshot, outputs=model_status, queue=False)
+        demo.load(fn=ollama_backend.snapshot, outputs=model_status, queue=False)
 
-    return demo
+    return configure_queue(demo)
 
 
 if __name__ == "__main__":
+    # Load the configured models before the first message arrives
+    ollama_backend.start()
     demo = create_demo()
     demo.launch()
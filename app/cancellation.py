@@ -0,0 +1,93 @@
+"""
+客户端断开检测与生成取消
+客户端关闭页面或超时断开后立即取消上游模型调用，释放并发名额，
+并统计被取消的请求数和 token 数，用于评估回收的容量
+"""
+import os
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Awaitable, Dict, TypeVar
+
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+# 非流式接口检测客户端断开的轮询间隔（秒）
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))
+
+T = TypeVar("T")
+
+
+class ClientDisconnected(Exception):
+    """客户端在回复生成完成前断开了连接"""
+
+
+class CancellationStats:
+    """按来源统计被取消的生成"""
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {
+            "cancelled_requests": 0,
+            # 取消前已经生成、随后被丢弃的 token 数（浪费的容量）
+            "discarded_tokens": 0,
+            # 取消后不再生成的 token 预算上限（回收的容量）
+            "reclaimed_token_budget": 0,
+        })
+
+    def record(self, source: str, generated_tokens: int, max_tokens: int):
+        """
+        记录一次取消
+
+        Args:
+            source: 来源（接口路径或 UI 名称）
+            generated_tokens: 取消前已生成的 token 数（估算）
+            max_tokens: 本次请求的 token 上限
+        """
+        stats = self._stats[source]
+        stats["cancelled_requests"] += 1
+        stats["discarded_tokens"] += generated_tokens
+        stats["reclaimed_token_budget"] += max(0, max_tokens - generated_tokens)
+        logger.info(f"Generation cancelled ({source}) after ~{generated_tokens} tokens")
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """返回当前统计（按来源）"""
+        return {source: dict(stats) for source, stats in self._stats.items()}
+
+
+cancellation_stats = CancellationStats()
+
+
+async def run_until_disconnected(request: Request, awaitable: Awaitable[T],
+                                 poll_interval: float = DISCONNECT_POLL_INTERVAL) -> T:
+    """
+    执行协程，期间持续检测客户端是否断开，断开时取消协程
+
+    Args:
+        request: 当前 HTTP 请求
+        awaitable: 要执行的协程
+        poll_interval: 检测间隔（秒）
+
+    Returns:
+        协程的返回值
+
+    Raises:
+        ClientDisconnected: 客户端已断开，协程已被取消
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                raise ClientDisconnected()
+    finally:
+        # 当前请求本身被取消时（如服务关闭）也要取消生成任务
+        if not task.done():
+            task.cancel()
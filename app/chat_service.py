@@ -0,0 +1,253 @@
+"""
+聊天服务层
+统一管理 DeepSeek 模型实例和调用逻辑，FastAPI 接口与 Gradio UI 在同一进程内直接调用，
+无需经过本地 HTTP 回环
+"""
+import os
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from dotenv import load_dotenv
+from langchain_deepseek import ChatDeepSeek
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage
+
+from app.deadline import Deadline, DeadlineExceeded, get_current_deadline, iterate_with_deadline
+from app.key_pool import KeyPool, is_key_error, is_transient_error, load_api_keys
+from app.scheduler import get_scheduler
+
+# 加载 .env 文件（如果存在）
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 从环境变量获取API Key（DEEPSEEK_API_KEYS 可配置多个，逗号分隔）
+DEEPSEEK_API_KEYS = load_api_keys()
+if not DEEPSEEK_API_KEYS:
+    raise ValueError("DEEPSEEK_API_KEY environment variable is not set")
+DEEPSEEK_API_KEY = DEEPSEEK_API_KEYS[0]
+
+# DeepSeek API endpoint - 注意：应该是 /v1 端点
+DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
+
+# 默认参数
+DEFAULT_MODEL = "deepseek-chat"
+DEFAULT_TEMPERATURE = 0.7
+MAX_TOKENS_LIMIT = 5000
+DEFAULT_SYSTEM_PROMPT = "你是一个有用的AI助手。"
+# 上游临时故障（5xx、超时、连接错误）的重试次数（与 openai SDK 默认值一致）
+UPSTREAM_MAX_RETRIES = 2
+# 上游临时故障重试的初始和最大退避时间（秒）
+UPSTREAM_RETRY_BACKOFF = 0.5
+UPSTREAM_RETRY_MAX_BACKOFF = 8.0
+# 配置了多个 Key 时关闭 SDK 自身的重试：429/401 立即交给 Key 池换一个 Key 重试并暂停出错的 Key，
+# 临时故障由下面的重试循环处理（尚未输出内容时）；只有一个 Key 时由 SDK 重试
+SDK_MAX_RETRIES = 0 if len(DEEPSEEK_API_KEYS) > 1 else UPSTREAM_MAX_RETRIES
+POOL_TRANSIENT_RETRIES = UPSTREAM_MAX_RETRIES - SDK_MAX_RETRIES
+
+
+def create_llm(api_key: str) -> ChatDeepSeek:
+    """为一个 API Key 创建 ChatDeepSeek 模型实例"""
+    # 注意：参数名是 api_base，不是 base_url
+    return ChatDeepSeek(
+        model=DEFAULT_MODEL,
+        temperature=DEFAULT_TEMPERATURE,
+        max_tokens=MAX_TOKENS_LIMIT,  # 控制token在5000以内
+        api_key=api_key,
+        api_base=DEEPSEEK_API_BASE,  # 使用 api_base 而不是 base_url
+        max_retries=SDK_MAX_RETRIES
+    )
+
+
+# 每个 Key 一个 ChatDeepSeek 实例（进程内共享，复用底层连接池），按负载分配请求
+key_pool = KeyPool(DEEPSEEK_API_KEYS, create_llm)
+# 第一个 Key 的模型实例（兼容直接使用 llm 的代码）
+llm = key_pool.keys[0].client
+logger.info("Initialized ChatDeepSeek model")
+
+
+def to_langchain_messages(messages: List[Dict[str, str]], system_prompt: Optional[str] = DEFAULT_SYSTEM_PROMPT) -> List[BaseMessage]:
+    """
+    将 OpenAI 风格的消息列表转换为 LangChain 消息
+
+    Args:
+        messages: [{"role": ..., "content": ...}] 格式的消息列表
+        system_prompt: 没有 system 消息时插入的默认系统提示，None 表示不插入
+
+    Returns:
+        LangChain 消息列表
+    """
+    langchain_messages = []
+    for msg in messages:
+        role = msg["role"]
+        if role == "system":
+            langchain_messages.append(SystemMessage(content=msg["content"]))
+        elif role == "user":
+            langchain_messages.append(HumanMessage(content=msg["content"]))
+        elif role in ("assistant", "ai"):
+            langchain_messages.append(AIMessage(content=msg["content"]))
+
+    # 如果没有system消息，添加默认的
+    if system_prompt and not any(isinstance(m, SystemMessage) for m in langchain_messages):
+        langchain_messages.insert(0, SystemMessage(content=system_prompt))
+    return langchain_messages
+
+
+def clamp_max_tokens(max_tokens: Optional[int]) -> int:
+    """确保max_tokens不超过5000"""
+    return min(max_tokens or MAX_TOKENS_LIMIT, MAX_TOKENS_LIMIT)
+
+
+def bind_llm(temperature: Optional[float] = DEFAULT_TEMPERATURE, max_tokens: Optional[int] = None,
+             deadline: Optional[Deadline] = None, client: Optional[ChatDeepSeek] = None,
+             tools: Optional[List[Dict[str, Any]]] = None):
+    """
+    按请求参数绑定模型
+
+    使用 bind 而不是修改全局 llm 的属性，避免并发请求之间互相影响。
+    给出截止时间时，上游超时设为剩余时间，max_tokens 限制在剩余时间内能生成的数量。
+    client 为 Key 池分配的模型实例，默认使用 llm；tools 为可供模型调用的工具定义
+
+    Raises:
+        DeadlineExceeded: 剩余时间不足以生成回复
+    """
+    if temperature is None:
+        temperature = DEFAULT_TEMPERATURE
+    max_tokens = clamp_max_tokens(max_tokens)
+    kwargs = {}
+    if deadline is not None:
+        max_tokens = deadline.cap_max_tokens(max_tokens)
+        kwargs["timeout"] = deadline.remaining()
+    model = client or llm
+    if tools:
+        return model.bind_tools(tools).bind(temperature=temperature, max_tokens=max_tokens, **kwargs)
+    return model.bind(temperature=temperature, max_tokens=max_tokens, **kwargs)
+
+
+async def retry_or_raise(error: Exception, key: Any, tried: set, transient_retries: int,
+                         deadline: Optional[Deadline]) -> int:
+    """
+    上游调用失败后决定是否重试：与 Key 有关的错误换一个 Key 重试，临时故障退避后重试（由 Key 池重新分配 Key）
+
+    Args:
+        error: 上游异常
+        key: 本次使用的 Key
+        tried: 本次请求已经失败过的 Key（index）
+        transient_retries: 已经进行的临时故障重试次数
+        deadline: 截止时间，剩余时间不够退避时不再重试
+
+    Returns:
+        更新后的临时故障重试次数
+
+    Raises:
+        不需要重试时重新抛出 error
+    """
+    if is_key_error(error) and len(tried) + 1 < len(key_pool.keys):
+        tried.add(key.index)
+        return transient_retries
+    if is_transient_error(error) and transient_retries < POOL_TRANSIENT_RETRIES:
+        delay = min(UPSTREAM_RETRY_BACKOFF * 2 ** transient_retries, UPSTREAM_RETRY_MAX_BACKOFF)
+        if deadline is None or deadline.remaining() > delay:
+            logger.warning(f"Upstream error on API {key.label}, retrying in {delay:.1f}s: {error!r}")
+            await asyncio.sleep(delay)
+            return transient_retries + 1
+    raise error
+
+
+async def ainvoke_message(messages: List[BaseMessage], temperature: Optional[float] = DEFAULT_TEMPERATURE,
+                          max_tokens: Optional[int] = None, deadline: Optional[Deadline] = None,
+                          tools: Optional[List[Dict[str, Any]]] = None) -> AIMessage:
+    """
+    异步调用模型，返回完整的 AI 消息（包括工具调用）
+
+    Args:
+        messages: LangChain 消息列表
+        temperature: 温度参数
+        max_tokens: 最大token数
+        deadline: 截止时间，默认使用当前请求的截止时间
+        tools: 可供模型调用的工具定义（OpenAI function calling 格式）
+
+    Returns:
+        AI 消息
+    """
+    deadline = deadline or get_current_deadline()
+    tried = set()
+    transient_retries = 0
+    # 先按流量类别排队领取上游名额，重试期间不释放
+    async with get_scheduler().slot(deadline):
+        while True:
+            key = None
+            try:
+                async with key_pool.lease(deadline, tried) as key:
+                    runnable = bind_llm(temperature, max_tokens, deadline, key.client, tools)
+                    if deadline is None:
+                        response = await runnable.ainvoke(messages)
+                    else:
+                        try:
+                            response = await asyncio.wait_for(runnable.ainvoke(messages), timeout=deadline.remaining())
+                        except asyncio.TimeoutError:
+                            raise DeadlineExceeded("上游生成超过截止时间")
+                    return response
+            except Exception as e:
+                transient_retries = await retry_or_raise(e, key, tried, transient_retries, deadline)
+
+
+async def ainvoke_chat(messages: List[BaseMessage], temperature: Optional[float] = DEFAULT_TEMPERATURE,
+                       max_tokens: Optional[int] = None, deadline: Optional[Deadline] = None) -> str:
+    """
+    异步调用模型，返回完整回复
+
+    Args:
+        messages: LangChain 消息列表
+        temperature: 温度参数
+        max_tokens: 最大token数
+        deadline: 截止时间，默认使用当前请求的截止时间
+
+    Returns:
+        AI回复内容
+    """
+    response = await ainvoke_message(messages, temperature, max_tokens, deadline)
+    return response.content if hasattr(response, "content") else str(response)
+
+
+async def astream_chat(messages: List[BaseMessage], temperature: Optional[float] = DEFAULT_TEMPERATURE,
+                       max_tokens: Optional[int] = None, deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    """
+    异步流式调用模型，逐块返回回复文本（增量）
+
+    Args:
+        messages: LangChain 消息列表
+        temperature: 温度参数
+        max_tokens: 最大token数
+        deadline: 截止时间，默认使用当前请求的截止时间
+
+    Yields:
+        回复文本片段
+    """
+    deadline = deadline or get_current_deadline()
+    tried = set()
+    transient_retries = 0
+    # 名额一直占用到流式输出结束
+    async with get_scheduler().slot(deadline):
+        while True:
+            key = None
+            received = False
+            try:
+                async with key_pool.lease(deadline, tried) as key:
+                    stream = bind_llm(temperature, max_tokens, deadline, key.client).astream(messages)
+                    async for chunk in iterate_with_deadline(stream, deadline):
+                        content = chunk.content if hasattr(chunk, "content") else str(chunk)
+                        if content:
+                            received = True
+                            yield content
+                    return
+            except Exception as e:
+                # 已经输出内容后不能重试，否则客户端会收到重复的文本
+                if received:
+                    raise
+                transient_retries = await retry_or_raise(e, key, tried, transient_retries, deadline)
+
+
+def estimate_tokens(text: str) -> int:
+    """简单的token估算（1 token ≈ 4 characters）"""
+    return len(text) // 4
@@ -0,0 +1,25 @@
+"""
+合并部署：Gradio UI 挂载到 FastAPI 应用中
+同一进程、同一端口、同一事件循环同时提供 UI 和 HTTP API，
+UI 的事件处理直接在进程内调用 chat_service，不经过本地 HTTP 回环和二次序列化
+
+启动方式：
+    uvicorn app.combined_app:app --port 8080
+    或 APP_MODE=combined python -m app.start_server
+"""
+import os
+import logging
+
+import gradio as gr
+
+from app.main import app as api_app
+from app.gradio_app import create_demo
+
+logger = logging.getLogger(__name__)
+
+# Gradio UI 的挂载路径（API 的 / 和 /health 健康检查保持不变）
+GRADIO_MOUNT_PATH = os.getenv("GRADIO_MOUNT_PATH", "/ui")
+
+demo = create_demo()
+app = gr.mount_gradio_app(api_app, demo, path=GRADIO_MOUNT_PATH)
+logger.info(f"Mounted Gradio UI at {GRADIO_MOUNT_PATH}")
@@ -0,0 +1,195 @@
+"""
+响应压缩中间件
+根据 Accept-Encoding 协商使用 brotli（需安装 brotli 包）或 gzip 压缩响应：
+- 普通响应：超过 COMPRESSION_MIN_SIZE 字节才压缩
+- 流式响应（StreamingResponse / SSE）：逐块压缩并立即 flush，客户端仍能实时收到每个数据块
+- SSE（text/event-stream）：收到响应头后立即发出，不等第一块响应体，客户端在首个 token 之前就能拿到响应头
+"""
+import os
+import zlib
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于该大小（字节）的普通响应不压缩，压缩收益抵不上 CPU 开销
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+# brotli 质量等级：4-5 在压缩率和速度之间比较均衡，适合动态内容
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 4))
+
+# 只压缩文本类内容，图片、压缩包等已经压缩过的内容直接透传
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+# 一定是流式输出的内容类型：不需要等第一块响应体就能决定是否压缩
+STREAMING_TYPES = ("text/event-stream",)
+
+
+def select_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    根据 Accept-Encoding 选择压缩算法
+
+    Args:
+        accept_encoding: 请求头 Accept-Encoding 的值
+
+    Returns:
+        "br"、"gzip"，或 None（不压缩）
+    """
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+class _GzipEncoder:
+    def __init__(self):
+        # wbits=31：带 gzip 头
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def compress_all(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def compress_all(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class CompressionMiddleware:
+    """支持流式响应的 gzip / brotli 压缩中间件"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = select_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(send, encoding, self.minimum_size)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    """包装 send，按需压缩响应体"""
+
+    def __init__(self, send: Send, encoding: str, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message: Optional[Message] = None
+        self.encoder = None
+        # None：尚未决定；True：压缩；False：透传
+        self.compressing: Optional[bool] = None
+
+    def _should_compress(self, headers: Headers) -> bool:
+        if "content-encoding" in headers:
+            return False
+        content_type = headers.get("content-type", "")
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def _new_encoder(self):
+        return _BrotliEncoder() if self.encoding == "br" else _GzipEncoder()
+
+    def _compressed_headers(self) -> MutableHeaders:
+        headers = MutableHeaders(raw=self.start_message["headers"])
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        return headers
+
+    async def send(self, message: Message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            self.start_message = message
+            headers = Headers(raw=message["headers"])
+            if headers.get("content-type", "").startswith(STREAMING_TYPES):
+                # SSE 的第一块数据可能要等到首个 token，响应头立即发出
+                self.compressing = self._should_compress(headers)
+                if self.compressing:
+                    self.encoder = self._new_encoder()
+                    headers = self._compressed_headers()
+                    del headers["Content-Length"]
+                    message["headers"] = headers.raw
+                await self._send(message)
+                return
+            # 其他响应等拿到第一块响应体后再决定是否压缩
+            return
+        if self.compressing is False:
+            await self._send(message)
+            return
+        if message_type != "http.response.body":
+            # 其他类型的消息（如 http.response.pathsend）不压缩
+            if self.compressing is None:
+                self.compressing = False
+                await self._send(self.start_message)
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressing is None:
+            headers = Headers(raw=self.start_message["headers"])
+            if not self._should_compress(headers) or (not more_body and len(body) < self.minimum_size):
+                self.compressing = False
+                await self._send(self.start_message)
+                await self._send(message)
+                return
+
+            self.compressing = True
+            self.encoder = self._new_encoder()
+            headers = self._compressed_headers()
+            if more_body:
+                # 流式响应：长度未知，逐块压缩
+                del headers["Content-Length"]
+                message["body"] = self.encoder.compress(body)
+            else:
+                body = self.encoder.compress_all(body)
+                headers["Content-Length"] = str(len(body))
+                message["body"] = body
+            self.start_message["headers"] = headers.raw
+            await self._send(self.start_message)
+            await self._send(message)
+            return
+
+        # 流式响应的后续数据块
+        data = self.encoder.compress(body) if body else b""
+        if not more_body:
+            data += self.encoder.finish()
+        message["body"] = data
+        await self._send(message)
@@ -0,0 +1,246 @@
+"""
+对话持久化存储
+聊天记录以追加写入的方式保存到 SQLite（消息内容 zlib 压缩，按会话建立索引）：
+- 写入先进入内存队列，由后台线程批量提交，不阻塞请求处理
+- 读取按页进行（从最新消息往前翻），恢复长会话时不需要把完整记录载入内存
+
+通过 CONVERSATION_STORE_BACKEND 选择后端：
+- none（默认）：不持久化
+- sqlite：保存到 CONVERSATION_STORE_PATH 指定的文件（Cloud Run 上应指向挂载的持久化卷）
+
+写入线程是守护线程，退出前需要调用 close 写完队列中剩余的消息：FastAPI 在 shutdown 时调用，
+进程正常退出时由 atexit 调用；独立运行的 Gradio 需要先调用 exit_on_sigterm，SIGTERM 时才会执行 atexit
+"""
+import os
+import sys
+import time
+import atexit
+import signal
+import uuid
+import zlib
+import queue
+import sqlite3
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_STORE_BACKEND = os.getenv("CONVERSATION_STORE_BACKEND", "none").lower()
+CONVERSATION_STORE_PATH = os.getenv("CONVERSATION_STORE_PATH", "/tmp/deepseek-chat-agent/conversations.db")
+# 每页加载的消息数
+CONVERSATION_PAGE_SIZE = int(os.getenv("CONVERSATION_PAGE_SIZE", 20))
+# 后台批量写入的最大批次大小和最长等待时间（秒）
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 0.5
+# flush 最多等待的时间（秒），写入线程异常时不让读取一直挂起
+FLUSH_TIMEOUT = 5.0
+
+# 一页消息及下一页的游标（None 表示没有更早的消息）
+Page = Tuple[List[Dict[str, str]], Optional[int]]
+
+
+def new_conversation_id() -> str:
+    """生成新的会话 ID"""
+    return uuid.uuid4().hex
+
+
+class ConversationStore:
+    """对话存储接口，默认实现不做任何持久化"""
+
+    enabled = False
+
+    def append(self, conversation_id: str, role: str, content: str):
+        """追加一条消息（不阻塞调用方）"""
+
+    def load_page(self, conversation_id: str, before: Optional[int] = None,
+                  limit: int = CONVERSATION_PAGE_SIZE) -> Page:
+        """
+        加载一页消息
+
+        Args:
+            conversation_id: 会话 ID
+            before: 游标，只加载该游标之前的消息；None 表示从最新消息开始
+            limit: 每页消息数
+
+        Returns:
+            (按时间顺序排列的消息列表, 下一页游标)
+        """
+        return [], None
+
+    def flush(self):
+        """等待已提交的写入全部落盘"""
+
+    def close(self):
+        """关闭存储"""
+
+
+class SQLiteConversationStore(ConversationStore):
+    """基于 SQLite 的追加写入对话存储"""
+
+    enabled = True
+
+    def __init__(self, path: str = CONVERSATION_STORE_PATH):
+        """
+        初始化存储并启动后台写入线程
+
+        Args:
+            path: SQLite 数据库文件路径
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "conversation_id TEXT NOT NULL, "
+            "role TEXT NOT NULL, "
+            "content BLOB NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, id)")
+        # 队列元素：待写入的消息元组、flush 标记（threading.Event）或停止信号 None
+        self._queue: "queue.Queue[Union[tuple, threading.Event, None]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-store-writer", daemon=True)
+        self._writer.start()
+        logger.info(f"Conversation store ready at {path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def append(self, conversation_id: str, role: str, content: str):
+        """追加一条消息：只放入队列，由后台线程写入"""
+        self._queue.put((conversation_id, role, zlib.compress(content.encode("utf-8")), time.time()))
+
+    def _write_loop(self):
+        """后台线程：把队列中的消息按批次写入数据库"""
+        conn = self._connect()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = []
+            markers = []
+            stop = False
+            deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+            while True:
+                if isinstance(item, threading.Event):
+                    # 有读取在等待之前的写入：立即提交当前批次，不再等凑满
+                    markers.append(item)
+                    break
+                batch.append(item)
+                timeout = deadline - time.monotonic()
+                if len(batch) >= WRITE_BATCH_SIZE or timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+            try:
+                if batch:
+                    with conn:
+                        conn.execute("BEGIN")
+                        conn.executemany(
+                            "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                            batch
+                        )
+            except Exception as e:
+                logger.error(f"Failed to persist {len(batch)} conversation messages: {e}", exc_info=True)
+            finally:
+                for marker in markers:
+                    marker.set()
+            if stop:
+                return
+
+    def load_page(self, conversation_id: str, before: Optional[int] = None,
+                  limit: int = CONVERSATION_PAGE_SIZE) -> Page:
+        """从最新消息往前分页加载"""
+        # 确保刚提交的消息也能读到
+        self.flush()
+        if before is None:
+            rows = self._connect().execute(
+                "SELECT id, role, content FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, limit + 1)
+            ).fetchall()
+        else:
+            rows = self._connect().execute(
+                "SELECT id, role, content FROM messages WHERE conversation_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (conversation_id, before, limit + 1)
+            ).fetchall()
+        # 多取一条用于判断是否还有更早的消息
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        messages = [
+            {"role": role, "content": zlib.decompress(content).decode("utf-8")}
+            for _, role, content in reversed(rows)
+        ]
+        next_before = rows[-1][0] if has_more else None
+        return messages, next_before
+
+    def flush(self):
+        """
+        等待调用之前提交的消息全部写入
+
+        只等待队列中的一个标记，之后其他会话持续提交的写入不会让调用方一直等待
+        """
+        marker = threading.Event()
+        self._queue.put(marker)
+        if not marker.wait(FLUSH_TIMEOUT):
+            logger.warning("Timed out waiting for conversation store writes to flush")
+
+    def close(self):
+        """写完剩余消息并停止后台线程（可重复调用）"""
+        if not self._writer.is_alive():
+            return
+        self._queue.put(None)
+        self._writer.join(timeout=FLUSH_TIMEOUT)
+
+
+_store: Optional[ConversationStore] = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """根据 CONVERSATION_STORE_BACKEND 获取进程内的对话存储单例"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if CONVERSATION_STORE_BACKEND == "sqlite":
+                    _store = SQLiteConversationStore()
+                    # 进程退出前写完队列中剩余的消息
+                    atexit.register(_store.close)
+                else:
+                    if CONVERSATION_STORE_BACKEND != "none":
+                        logger.warning(f"Unknown CONVERSATION_STORE_BACKEND '{CONVERSATION_STORE_BACKEND}', persistence disabled")
+                    _store = ConversationStore()
+    return _store
+
+
+def close_conversation_store():
+    """关闭对话存储单例（尚未创建时不做任何事）"""
+    if _store is not None:
+        _store.close()
+
+
+def exit_on_sigterm():
+    """
+    收到 SIGTERM 时正常退出（执行 atexit），用于独立运行的 Gradio
+
+    Python 默认收到 SIGTERM 直接终止进程，Cloud Run 停止实例时队列中尚未写入的消息会丢失；
+    uvicorn 启动的服务自己处理 SIGTERM，不需要调用
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
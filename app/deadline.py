@@ -0,0 +1,159 @@
+"""
+请求截止时间（deadline）传播
+每个请求带有一个截止时间：来自请求头，或使用路由的默认值（与 Cloud Run 请求超时保持一致）。
+截止时间贯穿排队等待、重试和上游调用：
+- 上游调用的超时设置为剩余时间
+- max_tokens 限制在剩余时间内实际能生成的数量
+- 剩余时间不足以生成有意义的回复时直接拒绝，不再占用上游容量
+
+请求头（二选一）：
+- X-Request-Timeout: 相对超时（秒）
+- X-Request-Deadline: 绝对截止时间（Unix 时间戳，秒）
+"""
+import os
+import time
+import asyncio
+import contextvars
+import logging
+from typing import AsyncIterator, Optional, TypeVar
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+# 默认请求超时（秒），与 Cloud Run 默认请求超时一致
+REQUEST_TIMEOUT_DEFAULT = float(os.getenv("REQUEST_TIMEOUT_DEFAULT", 300))
+# 各路由的默认超时（秒），未列出的路由使用 REQUEST_TIMEOUT_DEFAULT
+ROUTE_TIMEOUTS = {
+    "/api/chat": float(os.getenv("REQUEST_TIMEOUT_CHAT", REQUEST_TIMEOUT_DEFAULT)),
+    "/api/chat/simple": float(os.getenv("REQUEST_TIMEOUT_CHAT", REQUEST_TIMEOUT_DEFAULT)),
+    "/api/chat/stream": float(os.getenv("REQUEST_TIMEOUT_STREAM", REQUEST_TIMEOUT_DEFAULT)),
+    "/api/agent": float(os.getenv("REQUEST_TIMEOUT_AGENT", REQUEST_TIMEOUT_DEFAULT)),
+    "/api/chat/sample": float(os.getenv("REQUEST_TIMEOUT_SAMPLE", REQUEST_TIMEOUT_DEFAULT)),
+}
+# 上游生成速度估计：首 token 延迟（秒）和每秒生成 token 数
+UPSTREAM_FIRST_TOKEN_SECONDS = float(os.getenv("UPSTREAM_FIRST_TOKEN_SECONDS", 2.0))
+UPSTREAM_TOKENS_PER_SECOND = float(os.getenv("UPSTREAM_TOKENS_PER_SECOND", 30.0))
+# 剩余时间内能生成的 token 少于该值时直接放弃
+MIN_USEFUL_TOKENS = int(os.getenv("MIN_USEFUL_TOKENS", 32))
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    """请求已经（或即将）超过截止时间"""
+
+
+class Deadline:
+    """请求截止时间（基于单调时钟）"""
+
+    def __init__(self, timeout: float):
+        """
+        Args:
+            timeout: 从现在开始的超时时间（秒）
+        """
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        """剩余时间（秒），已过期时为 0"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        """是否已过期"""
+        return self.remaining() <= 0
+
+    def check(self):
+        """已过期时抛出 DeadlineExceeded"""
+        if self.expired():
+            raise DeadlineExceeded("请求已超过截止时间")
+
+    def cap_max_tokens(self, max_tokens: int) -> int:
+        """
+        把 max_tokens 限制在剩余时间内能生成的数量
+
+        Args:
+            max_tokens: 请求的 token 上限
+
+        Returns:
+            调整后的 token 上限
+
+        Raises:
+            DeadlineExceeded: 剩余时间不足以生成 MIN_USEFUL_TOKENS 个 token
+        """
+        budget = int((self.remaining() - UPSTREAM_FIRST_TOKEN_SECONDS) * UPSTREAM_TOKENS_PER_SECOND)
+        if budget < min(max_tokens, MIN_USEFUL_TOKENS):
+            raise DeadlineExceeded(f"剩余时间 {self.remaining():.1f}s 不足以生成回复")
+        return min(max_tokens, budget)
+
+    @classmethod
+    def from_headers(cls, headers: Headers, default_timeout: float) -> "Deadline":
+        """
+        根据请求头创建截止时间，请求头给出的时间不能超过路由默认值
+
+        Args:
+            headers: 请求头
+            default_timeout: 路由默认超时（秒）
+        """
+        timeout = default_timeout
+        try:
+            if "x-request-timeout" in headers:
+                timeout = min(timeout, float(headers["x-request-timeout"]))
+            elif "x-request-deadline" in headers:
+                timeout = min(timeout, float(headers["x-request-deadline"]) - time.time())
+        except ValueError:
+            logger.warning("Ignoring malformed request deadline header")
+        return cls(max(0.0, timeout))
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("request_deadline", default=None)
+
+
+def get_current_deadline() -> Optional[Deadline]:
+    """获取当前请求的截止时间（不在请求上下文中时为 None）"""
+    return _current_deadline.get()
+
+
+async def iterate_with_deadline(iterator: AsyncIterator[T], deadline: Optional[Deadline]) -> AsyncIterator[T]:
+    """
+    迭代异步迭代器，每次等待都不超过截止时间
+
+    Raises:
+        DeadlineExceeded: 等待下一个元素时超过截止时间
+    """
+    if deadline is None:
+        async for item in iterator:
+            yield item
+        return
+    iterator = iterator.__aiter__()
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(iterator.__anext__(), timeout=deadline.remaining())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise DeadlineExceeded("上游生成超过截止时间")
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class DeadlineMiddleware:
+    """为每个 HTTP 请求设置截止时间"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        default_timeout = ROUTE_TIMEOUTS.get(scope["path"], REQUEST_TIMEOUT_DEFAULT)
+        token = _current_deadline.set(Deadline.from_headers(Headers(scope=scope), default_timeout))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_deadline.reset(token)
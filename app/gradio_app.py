@@ -1,6 +1,6 @@
 """
 Gradio Web UI for DeepSeek Chat Agent
-集成方案：直接使用 main.py 中的 LLM，无需通过 HTTP API
+集成方案：直接使用 chat_service 中的 LLM（与 main.py 共享），无需通过 HTTP API
 """
 # 兼容性修复：处理 huggingface_hub HfFolder 导入问题
 # 在导入 gradio 之前修复，避免导入错误
@@ -24,41 +24,39 @@ except ImportError:
     pass
 
 import gradio as gr
-from langchain_core.messages import HumanMessage, AIMessage
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 import os
+import asyncio
 from dotenv import load_dotenv
+import time
 import logging
 
-# 导入 main.py 中的 LLM 初始化逻辑
-from langchain_deepseek import ChatDeepSeek
+# 导入与 main.py 共享的 LLM（同一进程内只初始化一次）
+from app.chat_service import astream_chat, estimate_tokens, DEEPSEEK_API_BASE, DEFAULT_MODEL, MAX_TOKENS_LIMIT
+from app.cancellation import cancellation_stats
+from app.deadline import Deadline, DeadlineExceeded
+from app.ui_queue import configure_queue, chat_event_options
+from app.conversation_store import exit_on_sigterm, get_conversation_store, new_conversation_id
+from app.history_window import HistoryWindow
+from app.summarizer import ConversationCompactor
+from app.agent import run_agent, format_steps, AGENT_SYSTEM_PROMPT
+from app.retrieval import retrieve_context
+from app.structured_logging import configure_logging, log_event
+from app.memory_diagnostics import admin_routes, track_session
 
 # 加载环境变量
 load_dotenv()
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 配置日志（队列化的结构化日志，不阻塞对话）
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# 从环境变量获取API Key
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-if not DEEPSEEK_API_KEY:
-    raise ValueError("DEEPSEEK_API_KEY environment variable is not set")
+# 内存中保留的最近消息数（用于构建提示），更早的消息只保存在对话存储中
+CONVERSATION_MEMORY_MESSAGES = int(os.getenv("CONVERSATION_MEMORY_MESSAGES", 40))
 
-# DeepSeek API base URL - 注意：应该是 /v1 端点
-DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
-
-# 初始化 ChatDeepSeek 模型（与 main.py 保持一致）
-# 注意：参数名是 api_base，不是 base_url
-llm = ChatDeepSeek(
-    model="deepseek-chat",
-    temperature=0.7,
-    max_tokens=5000,
-    api_key=DEEPSEEK_API_KEY,
-    api_base=DEEPSEEK_API_BASE  # 使用 api_base 而不是 base_url
-)
-logger.info("Initialized ChatDeepSeek model for Gradio UI")
+# 每轮对话的截止时间（秒）：上游超时和 max_tokens 都按剩余时间调整
+GRADIO_REQUEST_TIMEOUT = float(os.getenv("GRADIO_REQUEST_TIMEOUT", 300))
 
 # 系统提示配置
 SYSTEM_TEMPLATE = """你是一个专业的AI编程助手。提供简洁、正确的解决方案，并包含用于调试的策略性打印语句。请用中文回答。"""
@@ -76,98 +74,211 @@ class ChatBot:
 
     def __init__(self):
         """初始化聊天机器人"""
+        self.store = get_conversation_store()
+        self.conversation_id = new_conversation_id()
+        # 界面上显示的消息（服务端保存，只显示最近的消息，更早的按页加载）
+        self.view = HistoryWindow(self.store)
+        self.view.reset(self.greeting())
         self.chat_history = []
+        # 长对话的后台摘要（较早的轮次压缩成一条摘要消息）
+        self.compactor = ConversationCompactor()
         # 使用新的 messages 格式（OpenAI 风格）
-        self.message_log = [{"role": "assistant", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}]
+        self.message_log = self.greeting()
+        # 登记到内存诊断（只统计本会话的对话数据，不包括共享的存储和模型）
+        track_session(self, "message_log", "chat_history", "compactor", "view")
+
+    @staticmethod
+    def greeting() -> list:
+        """新会话的欢迎语"""
+        return [{"role": "assistant", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}]
+
+    def trim_history(self):
+        """只在内存中保留最近的消息，完整记录由对话存储保存"""
+        if len(self.chat_history) > CONVERSATION_MEMORY_MESSAGES:
+            self.chat_history = self.chat_history[-CONVERSATION_MEMORY_MESSAGES:]
+        if len(self.message_log) > CONVERSATION_MEMORY_MESSAGES:
+            self.message_log = self.message_log[-CONVERSATION_MEMORY_MESSAGES:]
 
-    def generate_ai_response(self, user_input: str, temperature: float=0.7):
+    async def resume(self, conversation_id: str) -> list:
         """
-        生成AI回复
+        恢复已保存的会话（只加载最近一页）
+        
+        Args:
+            conversation_id: 会话 ID
+            
+        Returns:
+            Gradio聊天历史（messages 格式）
+        """
+        page, cursor = await asyncio.to_thread(self.store.load_page, conversation_id)
+        self.conversation_id = conversation_id
+        self.view.reset(page, saved=True, cursor=cursor)
+        self.compactor.reset()
+        self.message_log = list(page)
+        self.chat_history = [
+            HumanMessage(content=m["content"]) if m["role"] == "user" else AIMessage(content=m["content"])
+            for m in page
+        ]
+        self.trim_history()
+        return self.view.messages
+
+    async def load_earlier(self) -> list:
+        """
+        加载更早的一页消息，插入到界面历史的最前面
+        
+        Returns:
+            更新后的历史记录
+        """
+        return await self.view.load_earlier(self.conversation_id)
+
+    async def generate_ai_response(self, user_input: str, temperature: float=0.7, agent_mode: bool=False):
+        """
+        流式生成AI回复
         
         Args:
             user_input: 用户输入
             temperature: 温度参数，控制回复的随机性
+            agent_mode: 是否允许模型调用工具（工具调用记录显示在回复前面）
             
-        Returns:
-            AI回复内容
+        Yields:
+            截至目前已生成的AI回复内容
         """
+        # 后台摘要已完成时先用摘要替换旧消息
+        self.chat_history = self.compactor.apply(self.chat_history)
+        # 添加用户消息到聊天历史
+        self.chat_history.append(HumanMessage(content=user_input))
+        
+        response = ""
+        started = time.perf_counter()
+        first_token_ms = None
         try:
-            # 添加用户消息到聊天历史
-            self.chat_history.append(HumanMessage(content=user_input))
-            
-            # 如果设置了温度，更新LLM配置
-            if temperature != 0.7:
-                llm.temperature = temperature
+            # 构建提示（不包含当前用户消息，有摘要时放在最前面）
+            messages = chat_prompt.format_messages(
+                input=user_input,
+                chat_history=self.compactor.summary_messages() + self.chat_history[:-1]
+            )
+            # 本地知识库中检索到的相关片段放在系统提示之后（没有索引时为空）
+            context = await retrieve_context(user_input)
+            if context:
+                messages.insert(1, SystemMessage(content=f"以下是从内部文档和代码库中检索到的参考资料，回答时优先参考：\n\n{context}"))
             
-            # 构建对话链
-            chain = chat_prompt | llm | StrOutputParser()
-            
-            # 生成回复
-            response = chain.invoke({
-                "input": user_input,
-                "chat_history": self.chat_history[:-1]  # 不包含当前用户消息
-            })
+            deadline = Deadline(GRADIO_REQUEST_TIMEOUT)
+            if agent_mode:
+                # Agent 模式：使用带工具说明的系统提示，工具调用完成后一次性显示回答
+                yield "🛠️ 正在思考并调用工具…"
+                messages[0] = SystemMessage(content=AGENT_SYSTEM_PROMPT)
+                result = await run_agent(messages, temperature, deadline=deadline)
+                response = result["message"]
+                steps = format_steps(result["steps"])
+                yield f"{steps}\n\n{response}" if steps else response
+            else:
+                # 流式生成回复（由 Key 池分配 API Key，按截止时间限制上游超时和 max_tokens）
+                async for chunk in astream_chat(messages, temperature, deadline=deadline):
+                    if first_token_ms is None:
+                        first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                    response += chunk
+                    yield response
             
             # 添加AI回复到聊天历史
             self.chat_history.append(AIMessage(content=response))
+            # 超过阈值时在后台压缩较早的轮次，下一轮对话生效
+            self.compactor.maybe_schedule(self.chat_history)
+            self.trim_history()
+            
+            # 持久化本轮对话（后台批量写入，不阻塞回复）
+            self.store.append(self.conversation_id, "user", user_input)
+            self.store.append(self.conversation_id, "assistant", response)
+            self.view.mark_saved(2)
             
-            return response
+            log_event(
+                logger, "chat turn completed",
+                route="gradio/chat",
+                conversation_id=self.conversation_id,
+                backend=DEFAULT_MODEL,
+                prompt_tokens=sum(estimate_tokens(str(m.content)) for m in self.chat_history[:-1]),
+                completion_tokens=estimate_tokens(response),
+                first_token_ms=first_token_ms,
+                latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                summarized=self.compactor.summary is not None
+            )
             
+        except (asyncio.CancelledError, GeneratorExit):
+            # 用户点击停止或关闭页面：取消上游生成，本轮对话不计入历史
+            cancellation_stats.record("gradio", estimate_tokens(response), MAX_TOKENS_LIMIT)
+            self.chat_history.pop()
+            raise
+        except DeadlineExceeded:
+            logger.warning("AI response exceeded deadline")
+            self.chat_history.pop()
+            yield f"{response}\n\n⏱️ 回复生成超时，请稍后重试。" if response else "⏱️ 回复生成超时，请稍后重试。"
         except Exception as e:
             error_msg = str(e)
-            logger.error(f"Error generating AI response: {error_msg}", exc_info=True)
-            
-            # 提供更友好的错误信息
-            if "404" in error_msg or "Not Found" in error_msg:
-                return f"❌ API 端点错误 (404)。请检查：\n1. API Key 是否正确\n2. API Base URL 是否正确（应该是 https://api.deepseek.com/v1）\n3. 模型名称是否正确（deepseek-chat）\n\n详细错误：{error_msg}"
-            elif "401" in error_msg or "Unauthorized" in error_msg:
-                return f"❌ API Key 无效 (401)。请检查 .env 文件中的 DEEPSEEK_API_KEY 是否正确。\n\n详细错误：{error_msg}"
-            elif "429" in error_msg or "rate limit" in error_msg.lower():
-                return f"⏱️ API 请求频率过高 (429)。请稍后再试。\n\n详细错误：{error_msg}"
-            else:
-                return f"❌ 生成回复时出现错误：{error_msg}\n\n请检查：\n1. 网络连接是否正常\n2. API Key 是否有效\n3. API 服务是否可用"
+            logger.error("Error generating AI response: %s", error_msg, exc_info=True)
+            # 生成失败时移除本轮用户消息，避免历史中出现没有回复的提问
+            self.chat_history.pop()
+            yield self.format_error(error_msg)
+
+    @staticmethod
+    def format_error(error_msg: str) -> str:
+        """提供更友好的错误信息"""
+        if "404" in error_msg or "Not Found" in error_msg:
+            return f"❌ API 端点错误 (404)。请检查：\n1. API Key 是否正确\n2. API Base URL 是否正确（应该是 https://api.deepseek.com/v1）\n3. 模型名称是否正确（deepseek-chat）\n\n详细错误：{error_msg}"
+        elif "401" in error_msg or "Unauthorized" in error_msg:
+            return f"❌ API Key 无效 (401)。请检查 .env 文件中的 DEEPSEEK_API_KEY 是否正确。\n\n详细错误：{error_msg}"
+        elif "429" in error_msg or "rate limit" in error_msg.lower():
+            return f"⏱️ API 请求频率过高 (429)。请稍后再试。\n\n详细错误：{error_msg}"
+        else:
+            return f"❌ 生成回复时出现错误：{error_msg}\n\n请检查：\n1. 网络连接是否正常\n2. API Key 是否有效\n3. API 服务是否可用"
 
-    def chat(self, message: str, temperature: float, history: list):
+    async def chat(self, message: str, temperature: float, agent_mode: bool = False):
         """
-        处理聊天消息
+        处理聊天消息（流式推送到界面）
+        
+        聊天记录由服务端的消息窗口保存，不需要浏览器上传；窗口只保留最近的消息，
+        每轮发送到浏览器的数据量不随对话长度增长
         
         Args:
             message: 用户消息
             temperature: 温度参数
-            history: Gradio聊天历史（messages 格式）
+            agent_mode: 是否启用 Agent 模式（模型可以调用工具）
             
-        Returns:
+        Yields:
             (空字符串, 更新后的历史记录)
         """
         if not message or not message.strip():
-            return "", history
+            yield "", gr.update()
+            return
         
         # 添加用户消息到日志
         self.message_log.append({"role": "user", "content": message})
         
-        # 生成AI回复
-        ai_response = self.generate_ai_response(message, temperature)
+        # 更新界面消息窗口（messages 格式），AI回复随生成进度逐步填充
+        self.view.start_turn()
+        self.view.append("user", message)
+        self.view.append("assistant", "")
+        
+        ai_response = ""
+        async for ai_response in self.generate_ai_response(message, temperature, agent_mode):
+            self.view.update_last(ai_response)
+            yield "", self.view.messages
         
         # 添加AI回复到日志
         self.message_log.append({"role": "assistant", "content": ai_response})
-        
-        # 更新Gradio聊天历史（使用 messages 格式）
-        history.append({"role": "user", "content": message})
-        history.append({"role": "assistant", "content": ai_response})
-        
-        return "", history
+        self.trim_history()
 
     def clear_history(self):
-        """清空聊天历史"""
+        """清空聊天历史（开始新会话，旧会话仍保留在对话存储中）"""
+        self.conversation_id = new_conversation_id()
         self.chat_history = []
+        self.compactor.reset()
         # 使用新的 messages 格式
-        self.message_log = [{"role": "assistant", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}]
-        return [{"role": "assistant", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}]
+        self.message_log = self.greeting()
+        self.view.reset(self.greeting())
+        return self.view.messages
 
 
 def create_demo():
     """创建Gradio演示界面"""
-    chatbot = ChatBot()
+    store = get_conversation_store()
     
     with gr.Blocks(
         theme=gr.themes.Soft(primary_hue="blue", neutral_hue="zinc"),
@@ -180,6 +291,7 @@ def create_demo():
         with gr.Row():
             # 左侧：聊天区域
             with gr.Column(scale=4):
+                load_earlier_btn = gr.Button("加载更早的消息", variant="secondary", size="sm")
                 chatbot_component = gr.Chatbot(
                     value=[{"role": "assistant", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}],
                     height=500,
@@ -197,6 +309,7 @@ def create_demo():
                         container=False
                     )
                     submit_btn = gr.Button("发送", variant="primary", scale=1)
+                    stop_btn = gr.Button("停止", variant="stop", scale=1)
                     clear_btn = gr.Button("清空", variant="secondary", scale=1)
                 
             # 右侧：配置区域
@@ -212,6 +325,17 @@ def create_demo():
                     info="控制回复的随机性，值越高越随机"
                 )
                 
+                agent_checkbox = gr.Checkbox(
+                    value=False,
+                    label="Agent 模式",
+                    info="允许模型调用工具（执行 Python 代码等），多个工具并行执行"
+                )
+                
+                # 会话持久化：复制会话 ID，之后可以粘贴回来恢复会话
+                with gr.Group(visible=store.enabled):
+                    conversation_box = gr.Textbox(label="会话 ID", info="粘贴已保存的会话 ID 后点击恢复")
+                    resume_btn = gr.Button("恢复会话", variant="secondary", size="sm")
+                
                 gr.Markdown("### 📋 功能特性")
                 gr.Markdown("""
                 - 🐍 Python 编程助手
@@ -235,29 +359,93 @@ def create_demo():
                 - **API**: {DEEPSEEK_API_BASE}
                 """)
         
-        # 绑定事件
-        msg.submit(
-            fn=chatbot.chat,
-            inputs=[msg, temperature_slider, chatbot_component],
-            outputs=[msg, chatbot_component]
+        # 每个浏览器会话独立的 ChatBot（对话历史互不干扰），首次使用时创建
+        session_bot = gr.State(None)
+        
+        async def chat(message, temperature, bot, agent_mode):
+            """在当前会话的 ChatBot 上处理消息"""
+            bot = bot or ChatBot()
+            async for text, new_history in bot.chat(message, temperature, agent_mode):
+                yield text, new_history, bot
+        
+        def clear_history(bot):
+            """清空当前会话的聊天历史"""
+            bot = bot or ChatBot()
+            return bot.clear_history(), bot, bot.conversation_id
+        
+        def init_session():
+            """页面加载时创建会话并显示会话 ID"""
+            bot = ChatBot()
+            return bot, bot.conversation_id
+        
+        async def resume(conversation_id, bot):
+            """恢复已保存的会话"""
+            bot = bot or ChatBot()
+            conversation_id = (conversation_id or "").strip()
+            if not conversation_id:
+                return gr.update(), bot
+            return await bot.resume(conversation_id), bot
+        
+        async def load_earlier(bot):
+            """加载更早的一页消息"""
+            bot = bot or ChatBot()
+            return await bot.load_earlier(), bot
+        
+        # 绑定事件（聊天事件共享 chat 并发组）
+        # 聊天记录保存在服务端的 ChatBot 中，Chatbot 组件只作为输出，浏览器不上传历史
+        submit_event = msg.submit(
+            fn=chat,
+            inputs=[msg, temperature_slider, session_bot, agent_checkbox],
+            outputs=[msg, chatbot_component, session_bot],
+            **chat_event_options()
         )
         
-        submit_btn.click(
-            fn=chatbot.chat,
-            inputs=[msg, temperature_slider, chatbot_component],
-            outputs=[msg, chatbot_component]
+        click_event = submit_btn.click(
+            fn=chat,
+            inputs=[msg, temperature_slider, session_bot, agent_checkbox],
+            outputs=[msg, chatbot_component, session_bot],
+            **chat_event_options()
+        )
+        
+        # 停止生成：取消进行中的聊天事件，上游调用随之取消
+        stop_btn.click(
+            fn=None,
+            inputs=[],
+            outputs=[],
+            cancels=[submit_event, click_event]
         )
         
         clear_btn.click(
-            fn=chatbot.clear_history,
+            fn=clear_history,
+            inputs=[session_bot],
+            outputs=[chatbot_component, session_bot, conversation_box]
+        )
+        
+        resume_btn.click(
+            fn=resume,
+            inputs=[conversation_box, session_bot],
+            outputs=[chatbot_component, session_bot]
+        )
+        
+        load_earlier_btn.click(
+            fn=load_earlier,
+            inputs=[session_bot],
+            outputs=[chatbot_component, session_bot]
+        )
+        
+        demo.load(
+            fn=init_session,
             inputs=[],
-            outputs=[chatbot_component]
+            outputs=[session_bot, conversation_box]
         )
     
-    return demo
+    # 启用队列：限制并发、限制排队长度，并向用户显示排队位置
+    return configure_queue(demo)
 
 
 if __name__ == "__main__":
+    # SIGTERM 时正常退出，写完对话存储中排队的消息
+    exit_on_sigterm()
     # 创建并启动Gradio应用
     try:
         demo = create_demo()
@@ -285,7 +473,8 @@ if __name__ == "__main__":
             show_api=False,  # 在 Cloud Run 上不需要显示 API 文档
             prevent_thread_lock=False,  # 允许阻塞，保持容器运行
             inbrowser=False,  # Cloud Run 不需要打开浏览器
-            root_path=root_path  # 本地开发时不设置，避免 URL 双斜杠问题
+            root_path=root_path,  # 本地开发时不设置，避免 URL 双斜杠问题
+            app_kwargs={"routes": admin_routes()}  # 内存诊断管理接口
         )
     except Exception as e:
         logger.error(f"Failed to start Gradio application: {e}", exc_info=True)
@@ -1,21 +1,42 @@
 """
 Gradio Web UI for DeepSeek Chat Agent (API调用方案)
-分离方案：通过 HTTP 调用 main.py 的 API 接口
+分离方案：通过 HTTP 调用 main.py 的流式 API 接口（异步连接池客户端）
 需要先启动 main.py 服务
 """
 import gradio as gr
-import requests
-import json
-from typing import List, Tuple, Optional
+import httpx
+import os
+import asyncio
+from typing import Dict, List, Tuple, Optional
 import logging
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+from app.api_client import api_client, ChatAPIError, API_BASE_URL
+from app.deadline import DeadlineExceeded
+from app.ui_queue import configure_queue, chat_event_options
+from app.conversation_store import exit_on_sigterm, get_conversation_store, new_conversation_id
+from app.history_window import HistoryWindow
+from app.memory_diagnostics import admin_routes, track_session
+from app.structured_logging import configure_logging
+
+# 配置日志（队列化的结构化日志，不阻塞对话）
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# API 配置
-API_BASE_URL = "http://localhost:8080"
-API_CHAT_ENDPOINT = f"{API_BASE_URL}/api/chat"
+# 内存中保留并发送给 API 的最近消息数，更早的消息只保存在对话存储中
+CONVERSATION_MEMORY_MESSAGES = int(os.getenv("CONVERSATION_MEMORY_MESSAGES", 40))
+
+
+def to_chat_pairs(messages: List[Dict[str, str]]) -> List[Tuple[Optional[str], Optional[str]]]:
+    """将 messages 格式的记录转换为 Gradio 的 (用户, AI) 元组格式"""
+    pairs = []
+    for m in messages:
+        if m["role"] == "user":
+            pairs.append((m["content"], None))
+        elif pairs and pairs[-1][1] is None:
+            pairs[-1] = (pairs[-1][0], m["content"])
+        else:
+            pairs.append((None, m["content"]))
+    return pairs
 
 
 class ChatBot:
@@ -23,124 +44,175 @@ class ChatBot:
 
     def __init__(self):
         """初始化聊天机器人"""
+        self.store = get_conversation_store()
+        self.conversation_id = new_conversation_id()
+        # 界面上显示的消息（服务端保存，只显示最近的消息，更早的按页加载）
+        self.view = HistoryWindow(self.store)
+        self.view.reset([{"role": "assistant", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}])
         self.message_log = [{"role": "ai", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}]
-        self.conversation_history = []  # 存储完整的对话历史
+        self.conversation_history = []  # 存储最近的对话历史（完整记录由对话存储保存）
+        # 登记到内存诊断（只统计本会话的对话数据）
+        track_session(self, "message_log", "conversation_history", "view")
+
+    def trim_history(self):
+        """只在内存中保留最近的消息，完整记录由对话存储保存"""
+        if len(self.conversation_history) > CONVERSATION_MEMORY_MESSAGES:
+            self.conversation_history = self.conversation_history[-CONVERSATION_MEMORY_MESSAGES:]
+        if len(self.message_log) > CONVERSATION_MEMORY_MESSAGES:
+            self.message_log = self.message_log[-CONVERSATION_MEMORY_MESSAGES:]
 
-    def generate_ai_response(self, user_input: str, temperature: float = 0.7) -> str:
+    async def resume(self, conversation_id: str) -> List[Tuple[Optional[str], Optional[str]]]:
         """
-        通过 API 调用生成AI回复
+        恢复已保存的会话（只加载最近一页）
+        
+        Args:
+            conversation_id: 会话 ID
+            
+        Returns:
+            Gradio聊天历史
+        """
+        page, cursor = await asyncio.to_thread(self.store.load_page, conversation_id)
+        self.conversation_id = conversation_id
+        self.view.reset(page, saved=True, cursor=cursor)
+        self.conversation_history = list(page)
+        self.message_log = [{"role": "ai" if m["role"] == "assistant" else m["role"], "content": m["content"]} for m in page]
+        self.trim_history()
+        return to_chat_pairs(page)
+
+    async def load_earlier(self) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        加载更早的一页消息，插入到界面历史的最前面
+        
+        Returns:
+            更新后的历史记录
+        """
+        return to_chat_pairs(await self.view.load_earlier(self.conversation_id))
+
+    async def generate_ai_response(self, user_input: str, temperature: float = 0.7):
+        """
+        通过流式 API 生成AI回复
         
         Args:
             user_input: 用户输入
             temperature: 温度参数
             
-        Returns:
-            AI回复内容
+        Yields:
+            截至目前已生成的AI回复内容
         """
+        # 添加用户消息到对话历史
+        self.conversation_history.append({
+            "role": "user",
+            "content": user_input
+        })
+        
+        ai_message = ""
         try:
-            # 添加用户消息到对话历史
-            self.conversation_history.append({
-                "role": "user",
-                "content": user_input
-            })
-            
-            # 构建请求数据
-            request_data = {
-                "messages": self.conversation_history,
-                "temperature": temperature,
-                "max_tokens": 5000
-            }
-            
-            # 发送 POST 请求
-            response = requests.post(
-                API_CHAT_ENDPOINT,
-                json=request_data,
-                headers={"Content-Type": "application/json"},
-                timeout=60  # 60秒超时
-            )
-            
-            # 检查响应状态
-            response.raise_for_status()
+            async for chunk in api_client.stream_chat(
+                self.conversation_history,
+                temperature=temperature,
+                max_tokens=5000
+            ):
+                ai_message += chunk
+                yield ai_message
             
-            # 解析响应
-            result = response.json()
-            ai_message = result.get("message", "抱歉，无法获取回复。")
+            if not ai_message:
+                ai_message = "抱歉，无法获取回复。"
+                yield ai_message
             
             # 添加AI回复到对话历史
             self.conversation_history.append({
                 "role": "assistant",
                 "content": ai_message
             })
+            self.trim_history()
             
-            return ai_message
+            # 持久化本轮对话（后台批量写入，不阻塞回复）
+            self.store.append(self.conversation_id, "user", user_input)
+            self.store.append(self.conversation_id, "assistant", ai_message)
+            self.view.mark_saved(2)
+            return
             
-        except requests.exceptions.ConnectionError:
+        except (asyncio.CancelledError, GeneratorExit):
+            # 用户点击停止或关闭页面：关闭流式连接，服务端检测到断开后取消上游生成
+            self.conversation_history.pop()
+            raise
+            
+        except httpx.ConnectError:
             error_msg = "❌ 无法连接到 API 服务。请确保 main.py 服务正在运行（python -m app.main）"
             logger.error(error_msg)
-            return error_msg
             
-        except requests.exceptions.Timeout:
+        except (httpx.TimeoutException, DeadlineExceeded):
             error_msg = "⏱️ 请求超时，请稍后重试。"
             logger.error(error_msg)
-            return error_msg
             
-        except requests.exceptions.HTTPError as e:
-            error_msg = f"❌ HTTP 错误: {e.response.status_code} - {e.response.text}"
+        except httpx.HTTPStatusError as e:
+            error_msg = f"❌ HTTP 错误: {e.response.status_code}"
+            logger.error(error_msg)
+            
+        except ChatAPIError as e:
+            error_msg = f"❌ {str(e)}"
             logger.error(error_msg)
-            return error_msg
             
         except Exception as e:
             error_msg = f"❌ 发生错误: {str(e)}"
             logger.error(error_msg, exc_info=True)
-            return error_msg
+        
+        # 出错时移除本轮用户消息，保持对话历史一问一答
+        self.conversation_history.pop()
+        # 已经输出部分内容时保留已生成的部分
+        yield f"{ai_message}\n\n{error_msg}" if ai_message else error_msg
 
-    def chat(self, message: str, temperature: float, history: List[Tuple[str, str]]) -> Tuple[str, List[Tuple[str, str]]]:
+    async def chat(self, message: str, temperature: float):
         """
-        处理聊天消息
+        处理聊天消息（流式推送到界面）
+        
+        聊天记录由服务端的消息窗口保存，不需要浏览器上传；窗口只保留最近的消息，
+        每轮发送到浏览器的数据量不随对话长度增长
         
         Args:
             message: 用户消息
             temperature: 温度参数
-            history: Gradio聊天历史
             
-        Returns:
+        Yields:
             (空字符串, 更新后的历史记录)
         """
         if not message or not message.strip():
-            return "", history
+            yield "", gr.update()
+            return
         
         # 添加用户消息到日志
         self.message_log.append({"role": "user", "content": message})
         
-        # 生成AI回复
-        ai_response = self.generate_ai_response(message, temperature)
+        # 更新界面消息窗口，AI回复随生成进度逐步填充
+        self.view.start_turn()
+        self.view.append("user", message)
+        self.view.append("assistant", "")
+        
+        ai_response = ""
+        async for ai_response in self.generate_ai_response(message, temperature):
+            self.view.update_last(ai_response)
+            yield "", to_chat_pairs(self.view.messages)
         
         # 添加AI回复到日志
         self.message_log.append({"role": "ai", "content": ai_response})
-        
-        # 更新Gradio聊天历史
-        history.append((message, ai_response))
-        
-        return "", history
+        self.trim_history()
 
     def clear_history(self) -> List[Tuple[str, str]]:
-        """清空聊天历史"""
+        """清空聊天历史（开始新会话，旧会话仍保留在对话存储中）"""
+        self.conversation_id = new_conversation_id()
+        self.view.reset([])
         self.conversation_history = []
         self.message_log = [{"role": "ai", "content": "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻"}]
         return []
 
-    def check_api_health(self) -> bool:
+    async def check_api_health(self) -> bool:
         """检查 API 服务是否可用"""
-        try:
-            response = requests.get(f"{API_BASE_URL}/health", timeout=5)
-            return response.status_code == 200
-        except:
-            return False
+        return await api_client.check_health()
 
 
 def create_demo():
     """创建Gradio演示界面"""
-    chatbot = ChatBot()
+    store = get_conversation_store()
     
     with gr.Blocks(
         theme=gr.themes.Soft(primary_hue="blue", neutral_hue="zinc"),
@@ -157,20 +229,17 @@ def create_demo():
                 visible=True
             )
         
-        def check_status():
+        async def check_status():
             """检查API状态"""
-            if chatbot.check_api_health():
+            if await api_client.check_health():
                 return "🟢 API 服务状态：正常运行"
             else:
                 return "🔴 API 服务状态：未连接（请先运行: python -m app.main）"
         
-        # 初始状态检查
-        initial_status = check_status()
-        api_status.value = initial_status
-        
         with gr.Row():
             # 左侧：聊天区域
             with gr.Column(scale=4):
+                load_earlier_btn = gr.Button("加载更早的消息", variant="secondary", size="sm")
                 chatbot_component = gr.Chatbot(
                     value=[(None, "你好！我是 DeepSeek AI 助手。我可以帮助你解决编程问题、调试代码、编写文档等。有什么我可以帮助你的吗？💻")],
                     height=500,
@@ -188,6 +257,7 @@ def create_demo():
                         container=False
                     )
                     submit_btn = gr.Button("发送", variant="primary", scale=1)
+                    stop_btn = gr.Button("停止", variant="stop", scale=1)
                     clear_btn = gr.Button("清空", variant="secondary", scale=1)
                     refresh_btn = gr.Button("刷新状态", variant="secondary", scale=1)
                 
@@ -204,6 +274,11 @@ def create_demo():
                     info="控制回复的随机性，值越高越随机"
                 )
                 
+                # 会话持久化：复制会话 ID，之后可以粘贴回来恢复会话
+                with gr.Group(visible=store.enabled):
+                    conversation_box = gr.Textbox(label="会话 ID", info="粘贴已保存的会话 ID 后点击恢复")
+                    resume_btn = gr.Button("恢复会话", variant="secondary", size="sm")
+                
                 gr.Markdown("### 📋 功能特性")
                 gr.Markdown("""
                 - 🐍 Python 编程助手
@@ -228,23 +303,78 @@ def create_demo():
                 - **最大Tokens**: 5000
                 """)
         
-        # 绑定事件
-        msg.submit(
-            fn=chatbot.chat,
-            inputs=[msg, temperature_slider, chatbot_component],
-            outputs=[msg, chatbot_component]
+        # 每个浏览器会话独立的 ChatBot（对话历史互不干扰），首次使用时创建
+        session_bot = gr.State(None)
+        
+        async def chat(message, temperature, bot):
+            """在当前会话的 ChatBot 上处理消息"""
+            bot = bot or ChatBot()
+            async for text, new_history in bot.chat(message, temperature):
+                yield text, new_history, bot
+        
+        def clear_history(bot):
+            """清空当前会话的聊天历史"""
+            bot = bot or ChatBot()
+            return bot.clear_history(), bot, bot.conversation_id
+        
+        def init_session():
+            """页面加载时创建会话并显示会话 ID"""
+            bot = ChatBot()
+            return bot, bot.conversation_id
+        
+        async def resume(conversation_id, bot):
+            """恢复已保存的会话"""
+            bot = bot or ChatBot()
+            conversation_id = (conversation_id or "").strip()
+            if not conversation_id:
+                return gr.update(), bot
+            return await bot.resume(conversation_id), bot
+        
+        async def load_earlier(bot):
+            """加载更早的一页消息"""
+            bot = bot or ChatBot()
+            return await bot.load_earlier(), bot
+        
+        # 绑定事件（聊天事件共享 chat 并发组）
+        # 聊天记录保存在服务端的 ChatBot 中，Chatbot 组件只作为输出，浏览器不上传历史
+        submit_event = msg.submit(
+            fn=chat,
+            inputs=[msg, temperature_slider, session_bot],
+            outputs=[msg, chatbot_component, session_bot],
+            **chat_event_options()
         )
         
-        submit_btn.click(
-            fn=chatbot.chat,
-            inputs=[msg, temperature_slider, chatbot_component],
-            outputs=[msg, chatbot_component]
+        click_event = submit_btn.click(
+            fn=chat,
+            inputs=[msg, temperature_slider, session_bot],
+            outputs=[msg, chatbot_component, session_bot],
+            **chat_event_options()
         )
         
-        clear_btn.click(
-            fn=chatbot.clear_history,
+        # 停止生成：取消进行中的聊天事件，上游调用随之取消
+        stop_btn.click(
+            fn=None,
             inputs=[],
-            outputs=[chatbot_component]
+            outputs=[],
+            cancels=[submit_event, click_event]
+        )
+        
+        clear_btn.click(
+            fn=clear_history,
+            inputs=[session_bot],
+            outputs=[chatbot_component, session_bot, conversation_box]
+        )
+        
+        resume_btn.click(
+            fn=resume,
+            inputs=[conversation_box, session_bot],
+            outputs=[chatbot_component, session_bot]
+        )
+        
+        load_earlier_btn.click(
+            fn=load_earlier,
+            inputs=[session_bot],
+            outputs=[chatbot_component, session_bot]
         )
         
         refresh_btn.click(
@@ -252,11 +382,27 @@ def create_demo():
             inputs=[],
             outputs=[api_status]
         )
+        
+        # 页面加载时异步检查状态，不阻塞界面创建
+        demo.load(
+            fn=check_status,
+            inputs=[],
+            outputs=[api_status]
+        )
+        
+        demo.load(
+            fn=init_session,
+            inputs=[],
+            outputs=[session_bot, conversation_box]
+        )
     
-    return demo
+    # 启用队列：限制并发、限制排队长度，并向用户显示排队位置
+    return configure_queue(demo)
 
 
 if __name__ == "__main__":
+    # SIGTERM 时正常退出，写完对话存储中排队的消息
+    exit_on_sigterm()
     # 创建并启动Gradio应用
     demo = create_demo()
     
@@ -265,6 +411,7 @@ if __name__ == "__main__":
         server_name="0.0.0.0",  # 允许外部访问
         server_port=7860,        # Gradio默认端口
         share=False,             # 设置为True可以生成公共链接
-        show_error=True          # 显示详细错误信息
+        show_error=True,         # 显示详细错误信息
+        app_kwargs={"routes": admin_routes()}  # 内存诊断管理接口
     )
 
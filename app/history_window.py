@@ -0,0 +1,122 @@
+"""
+Gradio 对话窗口
+gr.Chatbot 作为事件输入时，浏览器每轮都要上传完整的聊天记录；作为输出时，每轮开始和结束也会发送完整的值。
+长时间的编程会话（大段代码）中，每轮的传输量和浏览器渲染时间都随对话长度增长。这里由服务端保存界面上显示的消息：
+- 聊天事件不再把 Chatbot 作为输入，浏览器不需要上传聊天记录
+- 界面只显示最近 GRADIO_HISTORY_WINDOW 条消息，每轮开始时把更早的消息移出窗口，
+  每轮发送和渲染的数据量与对话长度无关（流式生成过程中 Gradio 只发送新增的文本）
+- 移出窗口的消息通过“加载更早的消息”按页取回：已写入对话存储的从存储读取，
+  未启用对话存储时从内存读取（最多保留 CONVERSATION_MEMORY_MESSAGES 条）
+
+gradio_app.py 和 gradio_app_api.py 共用
+"""
+import os
+import asyncio
+from typing import Dict, List, Optional
+
+from app.conversation_store import CONVERSATION_PAGE_SIZE, ConversationStore
+
+# 界面上最多显示的消息数（加载更早的消息后可以临时超出，下一轮开始时恢复）
+GRADIO_HISTORY_WINDOW = int(os.getenv("GRADIO_HISTORY_WINDOW", 20))
+# 未启用对话存储时，内存中保留的已移出窗口的消息数
+CONVERSATION_MEMORY_MESSAGES = int(os.getenv("CONVERSATION_MEMORY_MESSAGES", 40))
+
+
+class HistoryWindow:
+    """界面上显示的消息窗口（messages 格式），以及移出窗口的消息的分页读取"""
+
+    def __init__(self, store: ConversationStore, window: int = GRADIO_HISTORY_WINDOW,
+                 memory_limit: int = CONVERSATION_MEMORY_MESSAGES):
+        self.store = store
+        self.window = max(2, window)
+        self.memory_limit = memory_limit
+        self.messages: List[Dict[str, str]] = []
+        # 每条显示中的消息是否已写入对话存储（出错的轮次和欢迎语不会写入）
+        self._saved: List[bool] = []
+        # 未启用对话存储时，移出窗口的消息
+        self._earlier: List[Dict[str, str]] = []
+        # 对话存储中最早一条显示中的消息之前的游标，窗口移出消息后失效，需要重新定位
+        self._cursor: Optional[int] = None
+        # 对话存储中是否还有未显示的更早消息
+        self._more_saved = False
+
+    def reset(self, messages: List[Dict[str, str]], saved: bool = False, cursor: Optional[int] = None):
+        """
+        替换窗口中的全部消息
+
+        Args:
+            messages: 新的消息列表
+            saved: 这些消息是否已写入对话存储（恢复会话时）
+            cursor: 对话存储中这些消息之前的游标
+        """
+        self.messages = [dict(m) for m in messages]
+        self._saved = [saved] * len(self.messages)
+        self._earlier = []
+        self._cursor = cursor
+        self._more_saved = cursor is not None
+
+    def append(self, role: str, content: str):
+        """追加一条消息"""
+        self.messages.append({"role": role, "content": content})
+        self._saved.append(False)
+
+    def update_last(self, content: str):
+        """更新最后一条消息（流式生成中的回复）"""
+        self.messages[-1]["content"] = content
+
+    def mark_saved(self, count: int):
+        """最后 count 条消息已写入对话存储"""
+        for i in range(max(0, len(self._saved) - count), len(self._saved)):
+            self._saved[i] = True
+
+    def start_turn(self, reserve: int = 2):
+        """新一轮开始前移出较早的消息，为本轮的 reserve 条消息留出位置"""
+        overflow = len(self.messages) + reserve - self.window
+        if overflow <= 0:
+            return
+        dropped, self.messages = self.messages[:overflow], self.messages[overflow:]
+        dropped_saved, self._saved = self._saved[:overflow], self._saved[overflow:]
+        if self.store.enabled:
+            # 已写入存储的消息之后从存储中重新读取，游标需要按窗口中的消息重新定位
+            if any(dropped_saved):
+                self._more_saved = True
+            self._cursor = None
+        else:
+            self._earlier.extend(dropped)
+            if len(self._earlier) > self.memory_limit:
+                self._earlier = self._earlier[-self.memory_limit:]
+
+    @property
+    def has_earlier(self) -> bool:
+        """是否还有未显示的更早消息"""
+        return bool(self._earlier) or self._more_saved
+
+    async def load_earlier(self, conversation_id: str, limit: int = CONVERSATION_PAGE_SIZE) -> List[Dict[str, str]]:
+        """
+        把更早的一页消息放回窗口最前面
+
+        Returns:
+            更新后的窗口消息
+        """
+        if self._earlier:
+            page, self._earlier = self._earlier[-limit:], self._earlier[:-limit]
+            saved = False
+        elif self._more_saved:
+            if self._cursor is not None:
+                page, self._cursor = await asyncio.to_thread(
+                    self.store.load_page, conversation_id, self._cursor, limit
+                )
+            else:
+                # 游标已失效：窗口中已保存的消息就是存储中最新的那些，多读这些条再丢弃，得到它们之前的一页
+                shown = sum(self._saved)
+                rows, self._cursor = await asyncio.to_thread(
+                    self.store.load_page, conversation_id, None, limit + shown
+                )
+                page = rows[:len(rows) - shown]
+            self._more_saved = self._cursor is not None
+            saved = True
+        else:
+            return self.messages
+        self.messages = [dict(m) for m in page] + self.messages
+        self._saved = [saved] * len(page) + self._saved
+        return self.messages
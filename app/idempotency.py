@@ -0,0 +1,177 @@
+"""
+幂等键（Idempotency-Key）支持
+客户端超时重试时携带相同的 Idempotency-Key，服务端不会再次调用模型：
+- 原请求仍在生成中：重试请求等待同一个生成任务的结果
+- 原请求已完成：直接返回保存的结果（在 TTL 内有效）
+
+生成任务独立于发起它的请求运行，原请求断开不会影响正在等待结果的重试请求。
+已完成的结果同时写入共享缓存，多 worker 部署时其他 worker 收到的重试也能命中。
+共享缓存的读写在线程池中执行（aget / aset），等待其他 worker 的写锁时不会阻塞事件循环。
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Set, Tuple
+
+from app.deadline import DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+# 已完成结果的保留时间（秒）
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 600))
+# 进程内最多保留的已完成结果数
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", 10000))
+# 是否把已完成结果写入多 worker 共享缓存
+IDEMPOTENCY_SHARED = os.getenv("IDEMPOTENCY_SHARED", "true").lower() == "true"
+
+
+class IdempotencyConflict(Exception):
+    """同一个幂等键被用于内容不同的请求"""
+
+
+class IdempotencyStore:
+    """幂等键存储：进程内跟踪进行中的任务，已完成结果带 TTL 保存"""
+
+    def __init__(self, ttl: int = IDEMPOTENCY_TTL, max_entries: int = IDEMPOTENCY_MAX_ENTRIES,
+                 shared: bool = IDEMPOTENCY_SHARED):
+        """
+        初始化存储
+
+        Args:
+            ttl: 已完成结果的保留时间（秒）
+            max_entries: 进程内最多保留的已完成结果数
+            shared: 是否把已完成结果写入共享缓存
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.shared_cache = None
+        if shared:
+            from app.shared_cache import get_shared_cache
+            self.shared_cache = get_shared_cache()
+        # key -> (请求指纹, 生成任务)
+        self._inflight: dict = {}
+        # key -> (请求指纹, 结果, 过期时间)，按写入顺序排列，便于淘汰
+        self._completed: "OrderedDict[str, Tuple[str, dict, float]]" = OrderedDict()
+        # 回调中发起的共享缓存写入任务（保留引用，避免任务被回收）
+        self._pending_writes: Set[asyncio.Task] = set()
+
+    def _evict(self):
+        """淘汰过期或超出数量上限的结果"""
+        now = time.time()
+        while self._completed:
+            key, (_, _, expires_at) = next(iter(self._completed.items()))
+            if expires_at >= now and len(self._completed) <= self.max_entries:
+                break
+            self._completed.popitem(last=False)
+
+    async def _lookup_completed(self, key: str, fingerprint: str) -> Optional[dict]:
+        """查找已完成的结果"""
+        entry = self._completed.get(key)
+        if entry is None and self.shared_cache is not None:
+            shared = await self.shared_cache.aget(f"idempotency:{key}")
+            if shared is not None:
+                entry = (shared["fingerprint"], shared["result"], time.time() + self.ttl)
+        if entry is None:
+            return None
+        stored_fingerprint, result, expires_at = entry
+        if expires_at < time.time():
+            self._completed.pop(key, None)
+            return None
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyConflict(key)
+        return result
+
+    def _store_completed(self, key: str, fingerprint: str, result: dict):
+        """在进程内保存已完成的结果"""
+        self._completed[key] = (fingerprint, result, time.time() + self.ttl)
+        self._completed.move_to_end(key)
+        self._evict()
+
+    async def _store_shared(self, key: str, fingerprint: str, result: dict):
+        """把已完成的结果写入共享缓存（失败只影响其他 worker 的命中，不影响本次请求）"""
+        if self.shared_cache is None:
+            return
+        try:
+            await self.shared_cache.aset(f"idempotency:{key}", {"fingerprint": fingerprint, "result": result},
+                                         ttl=self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to store idempotency key {key} in shared cache: {e!r}")
+
+    async def run(self, key: str, fingerprint: str, factory: Callable[[], Awaitable[dict]],
+                  timeout: Optional[float] = None) -> Tuple[dict, bool]:
+        """
+        按幂等键执行生成任务
+
+        Args:
+            key: Idempotency-Key
+            fingerprint: 请求内容指纹，同一个键必须对应相同的请求
+            factory: 真正执行生成的协程函数
+            timeout: 当前请求最多等待的时间（秒），超时后生成任务继续运行，供之后的重试复用
+
+        Returns:
+            (结果, 是否为重放的结果)
+
+        Raises:
+            IdempotencyConflict: 同一个键对应了不同的请求内容
+        """
+        result = await self._lookup_completed(key, fingerprint)
+        if result is not None:
+            logger.info(f"Idempotency key {key} replayed from completed result")
+            return result, True
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            inflight_fingerprint, task = inflight
+            if inflight_fingerprint != fingerprint:
+                raise IdempotencyConflict(key)
+            logger.info(f"Idempotency key {key} attached to in-flight generation")
+            # shield：当前请求被取消或超时时不影响生成任务本身
+            return await self._wait(task, timeout), True
+
+        task = asyncio.create_task(factory())
+        self._inflight[key] = (fingerprint, task)
+        try:
+            result = await self._wait(task, timeout)
+        finally:
+            if task.done():
+                self._inflight.pop(key, None)
+                # 失败的任务不保存，客户端重试时重新生成
+                if not task.cancelled() and task.exception() is None:
+                    self._store_completed(key, fingerprint, task.result())
+            else:
+                # 当前请求被取消但任务仍在运行：任务完成后再登记结果
+                task.add_done_callback(lambda t: self._on_detached_done(key, fingerprint, t))
+        await self._store_shared(key, fingerprint, result)
+        return result, False
+
+    @staticmethod
+    async def _wait(task: asyncio.Task, timeout: Optional[float]) -> dict:
+        """等待生成任务，超时抛出 DeadlineExceeded"""
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("等待生成结果超过截止时间")
+
+    def _on_detached_done(self, key: str, fingerprint: str, task: asyncio.Task):
+        """发起请求已断开的任务完成后的回调"""
+        self._inflight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._store_completed(key, fingerprint, task.result())
+            if self.shared_cache is not None:
+                # 回调中不能等待，共享缓存的写入作为后台任务执行
+                write = asyncio.create_task(self._store_shared(key, fingerprint, task.result()))
+                self._pending_writes.add(write)
+                write.add_done_callback(self._pending_writes.discard)
+
+
+_store: Optional[IdempotencyStore] = None
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """获取进程内的幂等键存储单例"""
+    global _store
+    if _store is None:
+        _store = IdempotencyStore()
+    return _store
@@ -0,0 +1,262 @@
+"""
+DeepSeek API Key 池
+单个 Key 的速率限制决定了整个服务的吞吐上限，配置多个 Key 后按负载分摊请求：
+- 每个 Key 独立维护令牌桶（KEY_POOL_RPM）、进行中的请求数和健康状态
+- 每次请求选择当前负载最低的可用 Key
+- 返回 429 的 Key 暂停使用一段时间（优先使用 Retry-After，连续失败时指数退避），到期后自动恢复
+- 返回 401/403 的 Key 暂停更长时间（KEY_POOL_AUTH_QUARANTINE_SECONDS），便于轮换密钥后自动恢复
+
+令牌桶、进行中的请求数和暂停状态都在进程内维护：多 worker 部署（WEB_CONCURRENCY=N）时每个 worker 各有一份，
+同一个 Key 的实际上限是 N × KEY_POOL_RPM（KEY_POOL_BURST、KEY_POOL_MAX_IN_FLIGHT 同理），配置时需按 worker 数均分
+"""
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import httpx
+import openai
+
+from app.deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+# 每个 worker 进程中每个 Key 每分钟允许的请求数（令牌桶速率），0 表示不在本地限速
+KEY_POOL_RPM = float(os.getenv("KEY_POOL_RPM", 0))
+# 令牌桶容量（允许的突发请求数），默认等于每分钟请求数
+KEY_POOL_BURST = float(os.getenv("KEY_POOL_BURST", KEY_POOL_RPM))
+# 每个 Key 同时进行中的请求数上限，0 表示不限制
+KEY_POOL_MAX_IN_FLIGHT = int(os.getenv("KEY_POOL_MAX_IN_FLIGHT", 0))
+# 429 后的基础暂停时间（秒），连续 429 时指数增长
+KEY_POOL_RATE_LIMIT_QUARANTINE_SECONDS = float(os.getenv("KEY_POOL_RATE_LIMIT_QUARANTINE_SECONDS", 10))
+# 401/403 后的暂停时间（秒）
+KEY_POOL_AUTH_QUARANTINE_SECONDS = float(os.getenv("KEY_POOL_AUTH_QUARANTINE_SECONDS", 600))
+# 没有可用 Key 时最多等待的时间（秒），同时受请求截止时间限制
+KEY_POOL_MAX_WAIT = float(os.getenv("KEY_POOL_MAX_WAIT", 30))
+# 暂停时间上限（秒）
+MAX_QUARANTINE_SECONDS = 900
+
+
+class NoAvailableKey(Exception):
+    """所有 Key 都处于暂停或限速状态，且在等待时间内没有恢复"""
+
+
+def load_api_keys() -> List[str]:
+    """
+    读取 API Key 列表
+
+    DEEPSEEK_API_KEYS（逗号分隔）优先，未设置时使用单个 DEEPSEEK_API_KEY
+    """
+    keys = [k.strip() for k in os.getenv("DEEPSEEK_API_KEYS", "").split(",") if k.strip()]
+    if not keys and os.getenv("DEEPSEEK_API_KEY"):
+        keys = [os.getenv("DEEPSEEK_API_KEY")]
+    # 去重并保持顺序
+    return list(dict.fromkeys(keys))
+
+
+def status_code_of(error: BaseException) -> Optional[int]:
+    """从上游异常（openai SDK 的 APIStatusError 等）中取出 HTTP 状态码"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after_of(error: BaseException) -> Optional[float]:
+    """读取上游响应的 Retry-After（秒）"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class KeyState:
+    """单个 Key 的令牌桶、负载和健康状态"""
+
+    def __init__(self, index: int, api_key: str, client: Any, rpm: float, burst: float):
+        self.index = index
+        self.api_key = api_key
+        # 使用该 Key 的模型实例
+        self.client = client
+        self.rate = rpm / 60.0
+        self.capacity = max(burst, 1.0) if rpm > 0 else 0.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.in_flight = 0
+        self.quarantined_until = 0.0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.auth_failures = 0
+
+    @property
+    def label(self) -> str:
+        """日志和统计中使用的脱敏标识"""
+        return f"key{self.index}:***{self.api_key[-4:]}"
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float, max_in_flight: int) -> float:
+        """距离该 Key 可以接受新请求还需等待的时间（秒），0 表示立即可用"""
+        self._refill(now)
+        wait = max(0.0, self.quarantined_until - now)
+        if self.rate > 0 and self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        if max_in_flight and self.in_flight >= max_in_flight:
+            # 需要等其他请求结束，无法预估，稍后重新检查
+            wait = max(wait, 0.05)
+        return wait
+
+    def load(self) -> float:
+        """当前负载：进行中的请求数，令牌越少负载越高"""
+        if self.rate <= 0:
+            return self.in_flight
+        return self.in_flight + (1 - self.tokens / self.capacity)
+
+    def quarantine(self, seconds: float):
+        self.quarantined_until = max(self.quarantined_until, time.monotonic() + min(seconds, MAX_QUARANTINE_SECONDS))
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "key": self.label,
+            "in_flight": self.in_flight,
+            "tokens": round(self.tokens, 2) if self.rate > 0 else None,
+            "quarantined_for": round(max(0.0, self.quarantined_until - now), 1),
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "auth_failures": self.auth_failures,
+        }
+
+
+class KeyPool:
+    """按最低负载分配 API Key"""
+
+    def __init__(self, api_keys: List[str], client_factory: Callable[[str], Any], rpm: float = KEY_POOL_RPM,
+                 burst: float = KEY_POOL_BURST, max_in_flight: int = KEY_POOL_MAX_IN_FLIGHT):
+        """
+        初始化 Key 池
+
+        Args:
+            api_keys: API Key 列表
+            client_factory: 根据 Key 创建模型实例的函数
+            rpm: 每个 Key 每分钟允许的请求数，0 表示不限速
+            burst: 令牌桶容量
+            max_in_flight: 每个 Key 同时进行中的请求数上限，0 表示不限制
+        """
+        if not api_keys:
+            raise ValueError("At least one API key is required")
+        self.max_in_flight = max_in_flight
+        self.keys = [KeyState(i, key, client_factory(key), rpm, burst) for i, key in enumerate(api_keys)]
+        logger.info(f"API key pool ready with {len(self.keys)} key(s)")
+
+    def _pick(self, exclude: Optional[set] = None) -> Tuple[Optional[KeyState], float]:
+        """选出立即可用且负载最低的 Key；都不可用时返回最短等待时间"""
+        now = time.monotonic()
+        best, best_wait = None, None
+        for state in self.keys:
+            if exclude and state.index in exclude:
+                continue
+            wait = state.wait_time(now, self.max_in_flight)
+            if wait == 0 and (best is None or state.load() < best.load()):
+                best = state
+            if best_wait is None or wait < best_wait:
+                best_wait = wait
+        return best, best_wait if best_wait is not None else 0.0
+
+    async def acquire(self, deadline: Optional[Deadline] = None, exclude: Optional[set] = None) -> KeyState:
+        """
+        获取一个可用的 Key（占用一个令牌和一个进行中名额），需要配合 release 使用
+
+        Args:
+            deadline: 请求截止时间，等待不会超过剩余时间
+            exclude: 本次请求已经失败过的 Key（index），重试时跳过
+
+        Raises:
+            NoAvailableKey: 等待时间内没有可用的 Key
+        """
+        max_wait = KEY_POOL_MAX_WAIT if deadline is None else min(KEY_POOL_MAX_WAIT, deadline.remaining())
+        give_up_at = time.monotonic() + max_wait
+        while True:
+            state, wait = self._pick(exclude)
+            if state is not None:
+                if state.rate > 0:
+                    state.tokens -= 1
+                state.in_flight += 1
+                state.requests += 1
+                return state
+            if exclude and len(exclude) >= len(self.keys):
+                raise NoAvailableKey("所有 API Key 都已尝试失败")
+            remaining = give_up_at - time.monotonic()
+            if wait > remaining:
+                raise NoAvailableKey(f"没有可用的 API Key（最早 {wait:.1f}s 后恢复）")
+            await asyncio.sleep(max(wait, 0.01))
+
+    def release(self, state: KeyState, error: Optional[BaseException] = None):
+        """
+        归还 Key，并根据上游结果更新健康状态
+
+        Args:
+            state: acquire 返回的 Key
+            error: 请求失败时的异常
+        """
+        state.in_flight -= 1
+        status = status_code_of(error) if error is not None else None
+        if status == 429:
+            state.rate_limited += 1
+            state.consecutive_failures += 1
+            # 令牌桶清空，避免暂停结束后立即突发
+            state.tokens = 0.0
+            seconds = retry_after_of(error) or KEY_POOL_RATE_LIMIT_QUARANTINE_SECONDS * 2 ** (state.consecutive_failures - 1)
+            state.quarantine(seconds)
+            logger.warning(f"API {state.label} rate limited, quarantined for {seconds:.0f}s")
+        elif status in (401, 403):
+            state.auth_failures += 1
+            state.consecutive_failures += 1
+            state.quarantine(KEY_POOL_AUTH_QUARANTINE_SECONDS)
+            logger.error(f"API {state.label} rejected ({status}), quarantined for {KEY_POOL_AUTH_QUARANTINE_SECONDS:.0f}s")
+        elif error is None:
+            state.consecutive_failures = 0
+
+    @asynccontextmanager
+    async def lease(self, deadline: Optional[Deadline] = None,
+                    exclude: Optional[set] = None) -> AsyncIterator[KeyState]:
+        """以上下文管理器的形式占用一个 Key，退出时自动归还并记录结果"""
+        state = await self.acquire(deadline, exclude)
+        try:
+            yield state
+        except (asyncio.CancelledError, GeneratorExit):
+            # 取消不代表 Key 有问题，只归还名额
+            state.in_flight -= 1
+            raise
+        except Exception as e:
+            self.release(state, e)
+            raise
+        else:
+            self.release(state)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """各 Key 的状态（Key 已脱敏）"""
+        return [state.snapshot() for state in self.keys]
+
+
+def is_key_error(error: BaseException) -> bool:
+    """上游错误是否与所用的 Key 有关（换一个 Key 重试可能成功）"""
+    return status_code_of(error) in (401, 403, 429)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """上游错误是否是临时故障（5xx、超时、连接错误），稍后重试可能成功"""
+    status = status_code_of(error)
+    if status is not None:
+        return status == 408 or status >= 500
+    return isinstance(error, (openai.APIConnectionError, httpx.TransportError))
@@ -2,39 +2,68 @@
 FastAPI application for DeepSeek Chat Agent
 使用LangChain集成DeepSeek API，提供聊天接口
 """
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Optional, List, Dict
 import os
+import json
+import asyncio
+import time
+import hashlib
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import logging
 
-# 导入 ChatDeepSeek（使用 langchain-deepseek 包）
-from langchain_deepseek import ChatDeepSeek
-
-# 导入消息类型
-try:
-    from langchain.schema import HumanMessage, AIMessage, SystemMessage
-except ImportError:
-    try:
-        from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-    except ImportError:
-        raise ImportError("无法导入 LangChain 消息类型，请检查 LangChain 安装")
+# 模型实例与调用逻辑统一由 chat_service 管理（与 Gradio UI 共享）
+from app import chat_service
+from app.chat_service import to_langchain_messages, clamp_max_tokens, estimate_tokens
+from app.responses import FastJSONResponse, json_dumps
+from app.compression import CompressionMiddleware
+from app.idempotency import get_idempotency_store, IdempotencyConflict
+from app.cancellation import cancellation_stats, run_until_disconnected, ClientDisconnected
+from app.deadline import DeadlineMiddleware, DeadlineExceeded, get_current_deadline
+from app.key_pool import NoAvailableKey
+from app.scheduler import SchedulerBusy, TrafficClassMiddleware, get_scheduler
+from app.agent import run_agent, AGENT_MAX_STEPS
+from app.sampling import SAMPLING_MAX_N, iter_candidates, sample_best, pick_best, public_candidate, resolve_scorers
+from app.structured_logging import configure_logging, bind_log_fields, RequestLoggingMiddleware, NonBlockingQueueHandler
+from app.traffic_capture import TrafficCaptureMiddleware, get_traffic_recorder
+from app.memory_diagnostics import admin_router
+from app.conversation_store import close_conversation_store
 
 # 加载 .env 文件（如果存在）
 load_dotenv()
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
+# 配置日志（队列化的结构化日志，不阻塞请求）
+configure_logging()
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：停止前写完对话存储队列中的消息（合并部署时 Gradio 界面使用对话存储）"""
+    yield
+    await asyncio.to_thread(close_conversation_store)
+
+
 app = FastAPI(
     title="DeepSeek Chat Agent API",
     description="基于LangChain和DeepSeek的聊天API服务",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=FastJSONResponse,  # 使用 orjson 编码响应
+    lifespan=lifespan
 )
 
+# 响应压缩（gzip / brotli，兼容流式响应）
+app.add_middleware(CompressionMiddleware)
+
+# 请求截止时间（X-Request-Timeout / X-Request-Deadline 或路由默认值）
+app.add_middleware(DeadlineMiddleware)
+
+# 流量类别（interactive / batch），模型调用按类别加权公平排队
+app.add_middleware(TrafficClassMiddleware)
+
 # 配置CORS
 app.add_middleware(
     CORSMiddleware,
@@ -44,25 +73,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 从环境变量获取API Key
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-if not DEEPSEEK_API_KEY:
-    raise ValueError("DEEPSEEK_API_KEY environment variable is not set")
-
-# 初始化DeepSeek模型
-# DeepSeek API endpoint - 注意：应该是 /v1 端点
-DEEPSEEK_API_BASE = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
-
-# 初始化 ChatDeepSeek 模型
-# 注意：参数名是 api_base，不是 base_url
-llm = ChatDeepSeek(
-    model="deepseek-chat",
-    temperature=0.7,
-    max_tokens=5000,  # 控制token在5000以内
-    api_key=DEEPSEEK_API_KEY,
-    api_base=DEEPSEEK_API_BASE  # 使用 api_base 而不是 base_url
-)
-logger.info("Initialized ChatDeepSeek model")
+# 流量采集（TRAFFIC_CAPTURE_PATH），从请求日志上下文读取 token 数，需在日志中间件内层
+app.add_middleware(TrafficCaptureMiddleware)
+
+# 请求日志上下文（request_id、路由、延迟），放在最外层以统计完整耗时
+app.add_middleware(RequestLoggingMiddleware)
+
+# 内存诊断管理接口（/admin/memory，需要 ADMIN_TOKEN）
+app.include_router(admin_router)
+
+# 回复缓存（多 worker 共享），CHAT_CACHE_TTL=0 表示关闭
+CHAT_CACHE_TTL = int(os.getenv("CHAT_CACHE_TTL", 0))
+if CHAT_CACHE_TTL > 0:
+    from app.shared_cache import get_shared_cache
+    chat_cache = get_shared_cache()
+    logger.info("Chat response cache enabled (ttl=%ss)", CHAT_CACHE_TTL)
+else:
+    chat_cache = None
 
 
 # 请求模型
@@ -77,11 +104,29 @@ class ChatRequest(BaseModel):
     max_tokens: Optional[int] = Field(5000, ge=1, le=5000, description="最大token数")
 
 
+class AgentRequest(ChatRequest):
+    max_steps: Optional[int] = Field(None, ge=0, le=AGENT_MAX_STEPS, description="最多执行的工具调用轮数")
+
+
+class SampleRequest(ChatRequest):
+    n: int = Field(3, ge=1, le=SAMPLING_MAX_N, description="并发生成的候选数")
+    temperatures: Optional[List[float]] = Field(None, min_length=1, description="各候选的温度参数（循环使用），默认都使用 temperature")
+    scorers: Optional[Dict[str, float]] = Field(None, description="打分器及权重，如 {\"format\": 1, \"code_compiles\": 2}")
+    return_all: bool = Field(False, description="是否返回全部候选")
+    stream: bool = Field(False, description="以 Server-Sent Events 按完成顺序逐个返回候选")
+
+
 class ChatResponse(BaseModel):
     message: str = Field(..., description="AI回复内容")
     usage: Optional[dict] = Field(None, description="Token使用情况")
 
 
+def chat_cache_key(request: ChatRequest) -> str:
+    """根据完整请求内容生成缓存键"""
+    payload = json.dumps(request.model_dump(), ensure_ascii=False, sort_keys=True)
+    return "chat:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
 @app.get("/")
 async def root():
     """健康检查端点"""
@@ -98,66 +143,344 @@ async def health_check():
     return {"status": "ok"}
 
 
+async def generate_chat(request: ChatRequest) -> dict:
+    """
+    调用模型生成回复
+    
+    返回与 ChatResponse 结构一致的字典，直接交给 FastJSONResponse 编码，
+    避免响应模型的二次校验和序列化
+    """
+    # 确保max_tokens不超过5000
+    max_tokens = clamp_max_tokens(request.max_tokens)
+    
+    # 命中共享缓存时直接返回，不再调用模型
+    cache_key = None
+    if chat_cache is not None:
+        cache_key = chat_cache_key(request)
+        cached = await chat_cache.aget(cache_key)
+        if cached is not None:
+            bind_log_fields(cache_hit=True)
+            return cached
+    
+    # 转换消息格式为LangChain格式
+    langchain_messages = to_langchain_messages([msg.model_dump() for msg in request.messages])
+    
+    prompt_tokens = estimate_tokens("".join([m.content for m in langchain_messages]))
+    bind_log_fields(backend=chat_service.DEFAULT_MODEL, messages=len(langchain_messages),
+                    prompt_tokens=prompt_tokens, max_tokens=max_tokens)
+    
+    # 以流式方式调用上游并在本地拼接：被取消时能知道已生成的长度，
+    # 关闭连接后上游也会立即停止生成
+    ai_message = ""
+    started = time.perf_counter()
+    try:
+        async for chunk in chat_service.astream_chat(
+            langchain_messages,
+            temperature=request.temperature,
+            max_tokens=max_tokens
+        ):
+            ai_message += chunk
+    except asyncio.CancelledError:
+        cancellation_stats.record("/api/chat", estimate_tokens(ai_message), max_tokens)
+        bind_log_fields(cancelled=True, completion_tokens=estimate_tokens(ai_message))
+        raise
+    
+    # 估算token使用（简单估算，实际应该从API响应中获取）
+    # 这里使用简单的字符数估算（1 token ≈ 4 characters for Chinese）
+    estimated_tokens = estimate_tokens(ai_message) + prompt_tokens
+    
+    bind_log_fields(completion_tokens=estimate_tokens(ai_message),
+                    upstream_ms=round((time.perf_counter() - started) * 1000, 1))
+    
+    chat_response = {
+        "message": ai_message,
+        "usage": {
+            "estimated_tokens": estimated_tokens,
+            "max_tokens": max_tokens
+        }
+    }
+    if cache_key is not None:
+        await chat_cache.aset(cache_key, chat_response, ttl=CHAT_CACHE_TTL)
+    
+    return chat_response
+
+
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(
+    request: ChatRequest,
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255,
+                                            description="幂等键：重试时携带相同的键，不会重复调用模型")
+):
     """
     聊天接口
     
     接收用户消息，调用DeepSeek模型，返回AI回复
+    
+    客户端在回复完成前断开时立即取消上游调用。携带 Idempotency-Key 的请求除外：
+    客户端会用同一个键重试，生成任务需要继续运行，供重试请求复用结果
     """
     try:
-        # 确保max_tokens不超过5000
-        max_tokens = min(request.max_tokens or 5000, 5000)
-        
-        # 转换消息格式为LangChain格式
-        langchain_messages = []
-        for msg in request.messages:
-            if msg.role == "system":
-                langchain_messages.append(SystemMessage(content=msg.content))
-            elif msg.role == "user":
-                langchain_messages.append(HumanMessage(content=msg.content))
-            elif msg.role == "assistant":
-                langchain_messages.append(AIMessage(content=msg.content))
-        
-        # 如果没有system消息，添加默认的
-        if not any(isinstance(m, SystemMessage) for m in langchain_messages):
-            langchain_messages.insert(0, SystemMessage(content="你是一个有用的AI助手。"))
-        
-        logger.info(f"Processing chat request with {len(langchain_messages)} messages")
-        
-        # 调用模型
-        if hasattr(llm, 'invoke'):
-            # ChatDeepSeek使用invoke方法
-            response = llm.invoke(langchain_messages)
-            ai_message = response.content if hasattr(response, 'content') else str(response)
-        else:
-            # DeepSeek LLM使用generate或直接调用
-            # 将消息列表转换为字符串
-            prompt = "\n".join([f"{m.__class__.__name__}: {m.content}" for m in langchain_messages])
-            response = llm(prompt)
-            ai_message = str(response)
+        if not idempotency_key:
+            return FastJSONResponse(await run_until_disconnected(http_request, generate_chat(request)))
         
-        # 估算token使用（简单估算，实际应该从API响应中获取）
-        # 这里使用简单的字符数估算（1 token ≈ 4 characters for Chinese）
-        estimated_tokens = len(ai_message) // 4 + len("".join([m.content for m in langchain_messages])) // 4
+        deadline = get_current_deadline()
+        result, replayed = await get_idempotency_store().run(
+            idempotency_key,
+            chat_cache_key(request),
+            lambda: generate_chat(request),
+            timeout=deadline.remaining() if deadline else None
+        )
+        headers = {"Idempotent-Replayed": "true"} if replayed else None
+        return FastJSONResponse(result, headers=headers)
         
-        logger.info(f"Generated response with estimated {estimated_tokens} tokens")
+    except IdempotencyConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key 已被用于内容不同的请求")
+    except DeadlineExceeded as e:
+        logger.warning("Chat request dropped: %s", e)
+        raise HTTPException(status_code=504, detail=str(e))
+    except (NoAvailableKey, SchedulerBusy) as e:
+        logger.warning("Chat request rejected: %s", e)
+        raise HTTPException(status_code=503, detail=str(e))
+    except ClientDisconnected:
+        # 499：客户端已关闭连接（响应不会被接收）
+        return Response(status_code=499)
+    except Exception as e:
+        logger.error("Error in chat endpoint: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
+
+
+def sse_event(data: dict) -> str:
+    """编码一条 Server-Sent Events 消息"""
+    return f"data: {json_dumps(data)}\n\n"
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    流式聊天接口
+    
+    以 Server-Sent Events 格式逐块返回AI回复：
+    - {"delta": "..."}：新生成的文本片段
+    - {"done": true, "usage": {...}}：生成结束
+    - {"error": "..."}：生成过程中出错
+    """
+    max_tokens = clamp_max_tokens(request.max_tokens)
+    # 剩余时间不足时在发送响应头之前直接拒绝
+    deadline = get_current_deadline()
+    if deadline is not None:
+        try:
+            max_tokens = deadline.cap_max_tokens(max_tokens)
+        except DeadlineExceeded as e:
+            logger.warning("Streaming chat request dropped: %s", e)
+            raise HTTPException(status_code=504, detail=str(e))
+    langchain_messages = to_langchain_messages([msg.model_dump() for msg in request.messages])
+    prompt_tokens = estimate_tokens("".join([m.content for m in langchain_messages]))
+    bind_log_fields(backend=chat_service.DEFAULT_MODEL, messages=len(langchain_messages),
+                    prompt_tokens=prompt_tokens, max_tokens=max_tokens)
+    
+    async def event_stream():
+        ai_message = ""
+        started = time.perf_counter()
+        try:
+            async for chunk in chat_service.astream_chat(
+                langchain_messages,
+                temperature=request.temperature,
+                max_tokens=max_tokens
+            ):
+                if not ai_message:
+                    bind_log_fields(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                ai_message += chunk
+                yield sse_event({"delta": chunk})
+            
+            estimated_tokens = estimate_tokens(ai_message) + prompt_tokens
+            bind_log_fields(completion_tokens=estimate_tokens(ai_message),
+                            upstream_ms=round((time.perf_counter() - started) * 1000, 1))
+            yield sse_event({
+                "done": True,
+                "usage": {
+                    "estimated_tokens": estimated_tokens,
+                    "max_tokens": max_tokens
+                }
+            })
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开：StreamingResponse 取消生成器，上游流式连接随之关闭
+            cancellation_stats.record("/api/chat/stream", estimate_tokens(ai_message), max_tokens)
+            bind_log_fields(cancelled=True, completion_tokens=estimate_tokens(ai_message))
+            raise
+        except DeadlineExceeded as e:
+            logger.warning("Streaming chat stopped: %s", e)
+            yield sse_event({"error": str(e)})
+        except Exception as e:
+            # 响应头已经发出，只能通过事件告知客户端出错
+            logger.error("Error in streaming chat endpoint: %s", e, exc_info=True)
+            yield sse_event({"error": f"处理请求时出错: {str(e)}"})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def prepare_sampling(request: SampleRequest):
+    """校验打分器、截断 max_tokens 并转换消息"""
+    try:
+        resolve_scorers(request.scorers)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if request.temperatures and any(not 0.0 <= t <= 2.0 for t in request.temperatures):
+        raise HTTPException(status_code=422, detail="temperatures 中的温度参数需在 0~2 之间")
+    max_tokens = clamp_max_tokens(request.max_tokens)
+    langchain_messages = to_langchain_messages([msg.model_dump() for msg in request.messages])
+    prompt_tokens = estimate_tokens("".join([m.content for m in langchain_messages]))
+    bind_log_fields(backend=chat_service.DEFAULT_MODEL, messages=len(langchain_messages),
+                    prompt_tokens=prompt_tokens, max_tokens=max_tokens, candidates=request.n)
+    return langchain_messages, max_tokens, prompt_tokens
+
+
+def sampling_usage(candidates: List[dict], prompt_tokens: int, max_tokens: int) -> dict:
+    """所有候选合计的 token 估算（每个候选都要发送一次完整提示词）"""
+    completion_tokens = sum(c.get("completion_tokens", 0) for c in candidates)
+    bind_log_fields(completion_tokens=completion_tokens)
+    return {
+        "estimated_tokens": completion_tokens + prompt_tokens * len(candidates),
+        "max_tokens": max_tokens
+    }
+
+
+@app.post("/api/chat/sample")
+async def chat_sample(request: SampleRequest, http_request: Request):
+    """
+    并行采样接口
+    
+    同一请求并发生成 n 个候选，在服务端按打分器排序后返回最佳回复（return_all 时返回全部候选）。
+    stream=true 时以 Server-Sent Events 按完成顺序返回：
+    - {"candidate": {...}}：一个候选生成完成（已打分）
+    - {"done": true, "best": 最佳候选的 index, "usage": {...}}：全部完成
+    - {"error": "..."}：所有候选都失败
+    """
+    langchain_messages, max_tokens, prompt_tokens = prepare_sampling(request)
+    
+    if request.stream:
+        async def event_stream():
+            candidates = []
+            try:
+                async for candidate in iter_candidates(langchain_messages, request.n, max_tokens,
+                                                       request.temperature, request.temperatures, request.scorers):
+                    candidates.append(candidate)
+                    yield sse_event({"candidate": public_candidate(candidate)})
+                best = pick_best(candidates)
+                if best is None:
+                    logger.warning("All sampling candidates failed: %s", candidates[0]["error"])
+                    yield sse_event({"error": f"所有候选都生成失败: {candidates[0]['error']}"})
+                    return
+                yield sse_event({
+                    "done": True,
+                    "best": best["index"],
+                    "usage": sampling_usage(candidates, prompt_tokens, max_tokens)
+                })
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开：iter_candidates 退出时取消尚未完成的候选
+                bind_log_fields(cancelled=True)
+                raise
         
-        return ChatResponse(
-            message=ai_message,
-            usage={
-                "estimated_tokens": estimated_tokens,
-                "max_tokens": max_tokens
-            }
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
         )
-        
+    
+    try:
+        result = await run_until_disconnected(http_request, sample_best(
+            langchain_messages, request.n, max_tokens, request.temperature, request.temperatures, request.scorers
+        ))
+    except DeadlineExceeded as e:
+        logger.warning("Sampling request dropped: %s", e)
+        raise HTTPException(status_code=504, detail=str(e))
+    except (NoAvailableKey, SchedulerBusy) as e:
+        logger.warning("Sampling request rejected: %s", e)
+        raise HTTPException(status_code=503, detail=str(e))
+    except ClientDisconnected:
+        return Response(status_code=499)
+    except Exception as e:
+        logger.error("Error in sampling endpoint: %s", e, exc_info=True)
+        raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
+    
+    best = result["best"]
+    response = {
+        "message": best["message"],
+        "best": best,
+        "usage": sampling_usage(result["candidates"], prompt_tokens, max_tokens)
+    }
+    if request.return_all:
+        response["candidates"] = result["candidates"]
+    return FastJSONResponse(response)
+
+
+@app.get("/api/stats")
+async def stats():
+    """运行统计（当前 worker 进程）"""
+    return {
+        "pid": os.getpid(),
+        "cancellations": cancellation_stats.snapshot(),
+        "api_keys": chat_service.key_pool.snapshot(),
+        "scheduler": get_scheduler().snapshot(),
+        "traffic_capture": get_traffic_recorder().snapshot() if get_traffic_recorder() else None,
+        # 日志队列满时丢弃的日志条数
+        "dropped_log_records": NonBlockingQueueHandler.dropped
+    }
+
+
+async def generate_agent_reply(request: AgentRequest) -> dict:
+    """运行 Agent 循环，返回最终回答和工具调用记录"""
+    max_tokens = clamp_max_tokens(request.max_tokens)
+    # 不插入默认系统提示，由 Agent 使用自己的系统提示
+    langchain_messages = to_langchain_messages([msg.model_dump() for msg in request.messages], system_prompt=None)
+    bind_log_fields(backend=chat_service.DEFAULT_MODEL, messages=len(langchain_messages), max_tokens=max_tokens)
+    result = await run_agent(
+        langchain_messages,
+        temperature=request.temperature,
+        max_tokens=max_tokens,
+        max_steps=AGENT_MAX_STEPS if request.max_steps is None else request.max_steps
+    )
+    bind_log_fields(agent_steps=len(result["steps"]), estimated_tokens=result["estimated_tokens"],
+                    completion_tokens=estimate_tokens(result["message"]))
+    return {
+        "message": result["message"],
+        "steps": result["steps"],
+        "usage": {
+            "estimated_tokens": result["estimated_tokens"],
+            "max_tokens": max_tokens
+        }
+    }
+
+
+@app.post("/api/agent")
+async def agent(request: AgentRequest, http_request: Request):
+    """
+    Agent 接口
+    
+    模型可以调用本地工具（如 python 代码执行），同一轮的多个工具调用并发执行，
+    返回最终回答和每轮的工具调用记录
+    """
+    try:
+        return FastJSONResponse(await run_until_disconnected(http_request, generate_agent_reply(request)))
+    except DeadlineExceeded as e:
+        logger.warning("Agent request dropped: %s", e)
+        raise HTTPException(status_code=504, detail=str(e))
+    except (NoAvailableKey, SchedulerBusy) as e:
+        logger.warning("Agent request rejected: %s", e)
+        raise HTTPException(status_code=503, detail=str(e))
+    except ClientDisconnected:
+        return Response(status_code=499)
     except Exception as e:
-        logger.error(f"Error in chat endpoint: {str(e)}", exc_info=True)
+        logger.error("Error in agent endpoint: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
 
 
 @app.post("/api/chat/simple")
-async def chat_simple(user_input: str=Query(..., description="用户输入的问题")):
+async def chat_simple(http_request: Request, user_input: str=Query(..., description="用户输入的问题")):
     """
     简化版聊天接口
     
@@ -170,16 +493,24 @@ async def chat_simple(user_input: str=Query(..., description="用户输入的问
         ]
         
         request = ChatRequest(messages=messages)
-        response = await chat(request)
+        response = await run_until_disconnected(http_request, generate_chat(request))
         
         return {
             "user_input": user_input,
-            "ai_response": response.message,
-            "usage": response.usage
+            "ai_response": response["message"],
+            "usage": response["usage"]
         }
         
+    except DeadlineExceeded as e:
+        logger.warning("Simple chat request dropped: %s", e)
+        raise HTTPException(status_code=504, detail=str(e))
+    except (NoAvailableKey, SchedulerBusy) as e:
+        logger.warning("Simple chat request rejected: %s", e)
+        raise HTTPException(status_code=503, detail=str(e))
+    except ClientDisconnected:
+        return Response(status_code=499)
     except Exception as e:
-        logger.error(f"Error in simple chat endpoint: {str(e)}", exc_info=True)
+        logger.error("Error in simple chat endpoint: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=f"处理请求时出错: {str(e)}")
 
 
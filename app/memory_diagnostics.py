@@ -0,0 +1,416 @@
+"""
+内存统计与泄漏诊断（管理接口）
+长期运行的实例内存持续增长时，不需要挂调试器即可定位：
+- 进程 RSS、峰值和容器（cgroup）内存上限
+- 每个会话（Gradio ChatBot）在内存中保存的对话字节数，以及存活的会话对象数
+  （会话对象数远大于在线用户数时，说明会话状态没有被释放）
+- 各缓存和队列的大小
+- 按类型统计的对象数量
+- 按需开启 tracemalloc，拍摄快照并比较两个时间点之间的内存增长（按代码行汇总）
+
+管理接口挂在 /admin/memory 下，需要设置 ADMIN_TOKEN 并通过 X-Admin-Token 请求头访问，
+未设置 ADMIN_TOKEN 时接口返回 404
+"""
+import os
+import gc
+import sys
+import hmac
+import time
+import asyncio
+import logging
+import tracemalloc
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+
+from app.conversation_store import ConversationStore
+
+logger = logging.getLogger(__name__)
+
+# 管理接口的访问令牌，未设置时管理接口不可用
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# 启动时就开启 tracemalloc 并记录的栈深度，0 表示按需通过接口开启（tracemalloc 会增加内存和 CPU 开销）
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv("MEMORY_TRACEMALLOC_FRAMES", 0))
+# 进程内最多保留的 tracemalloc 快照数（快照本身占用不少内存）
+MEMORY_SNAPSHOT_LIMIT = int(os.getenv("MEMORY_SNAPSHOT_LIMIT", 4))
+
+# 统计对象大小时不深入的类型（共享资源或与会话数据无关的运行时对象）
+# 会话的 HistoryWindow 持有进程共享的对话存储，存储的写入队列和线程不属于任何会话
+_OPAQUE_TYPES = (type, type(sys), type(len), type(lambda: None), asyncio.Future, weakref.ref, ConversationStore)
+
+if MEMORY_TRACEMALLOC_FRAMES > 0 and not tracemalloc.is_tracing():
+    tracemalloc.start(MEMORY_TRACEMALLOC_FRAMES)
+
+
+def deep_sizeof(obj: Any, seen: Optional[set] = None) -> int:
+    """
+    递归估算对象占用的字节数（容器、字符串、普通对象和 pydantic 模型的属性）
+
+    同一个对象只计算一次；类、模块、函数、Future 等运行时对象不深入
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, _OPAQUE_TYPES):
+            continue
+        seen.add(id(item))
+        try:
+            total += sys.getsizeof(item)
+        except TypeError:
+            continue
+        if isinstance(item, (str, bytes, bytearray, int, float, bool)) or item is None:
+            continue
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__"):
+            stack.append(vars(item))
+        elif hasattr(item, "__slots__"):
+            stack.extend(getattr(item, slot) for slot in item.__slots__ if hasattr(item, slot))
+    return total
+
+
+class SessionRegistry:
+    """弱引用跟踪存活的会话对象（不会延长会话的生命周期）"""
+
+    def __init__(self):
+        # 会话对象 -> (创建时间, 计入会话内存的属性名)
+        self._sessions: "weakref.WeakKeyDictionary[Any, tuple]" = weakref.WeakKeyDictionary()
+        self.created = 0
+
+    def track(self, session: Any, *fields: str):
+        """
+        登记一个会话
+
+        Args:
+            session: 会话对象（如 ChatBot）
+            fields: 属于该会话自己的属性（对话历史等），共享的存储、模型实例不要列出
+        """
+        self._sessions[session] = (time.time(), fields)
+        self.created += 1
+
+    def snapshot(self, limit: int = 20) -> Dict[str, Any]:
+        """会话总数、总字节数，以及占用最多的若干会话"""
+        now = time.time()
+        sessions = []
+        for session, (created_at, fields) in list(self._sessions.items()):
+            seen: set = set()
+            size = sum(deep_sizeof(getattr(session, field, None), seen) for field in fields)
+            message_log = getattr(session, "message_log", None)
+            sessions.append({
+                "type": type(session).__module__ + "." + type(session).__name__,
+                "conversation_id": str(getattr(session, "conversation_id", ""))[:8],
+                "messages": len(message_log) if isinstance(message_log, list) else None,
+                "bytes": size,
+                "age_seconds": round(now - created_at),
+            })
+        sessions.sort(key=lambda s: s["bytes"], reverse=True)
+        return {
+            "alive": len(sessions),
+            "created": self.created,
+            "total_bytes": sum(s["bytes"] for s in sessions),
+            "largest": sessions[:limit],
+        }
+
+
+session_registry = SessionRegistry()
+
+
+def track_session(session: Any, *fields: str):
+    """登记一个会话对象，fields 为属于该会话的属性名"""
+    session_registry.track(session, *fields)
+
+
+def _module_global(module: str, name: str) -> Any:
+    """读取已加载模块中的单例（模块未加载或单例未创建时为 None，不会触发创建）"""
+    loaded = sys.modules.get(module)
+    return getattr(loaded, name, None) if loaded is not None else None
+
+
+def _file_size(path: Optional[str]) -> Optional[int]:
+    try:
+        return os.path.getsize(path) if path else None
+    except OSError:
+        return None
+
+
+def cache_sizes() -> Dict[str, Any]:
+    """进程内各缓存、队列和单例的大小"""
+    caches: Dict[str, Any] = {}
+
+    store = _module_global("app.idempotency", "_store")
+    if store is not None:
+        caches["idempotency"] = {
+            "inflight": len(store._inflight),
+            "completed": len(store._completed),
+            "bytes": deep_sizeof(store._completed),
+        }
+
+    conversation_store = _module_global("app.conversation_store", "_store")
+    if conversation_store is not None:
+        write_queue = getattr(conversation_store, "_queue", None)
+        caches["conversation_store"] = {
+            "pending_writes": write_queue.qsize() if write_queue is not None else None,
+            "file_bytes": _file_size(getattr(conversation_store, "path", None)),
+        }
+
+    shared_cache = _module_global("app.shared_cache", "_shared_cache")
+    if shared_cache is not None:
+        caches["shared_cache"] = {"file_bytes": _file_size(shared_cache.path)}
+
+    index = _module_global("app.retrieval", "_index")
+    if index is not None:
+        segments = list(getattr(index, "segments", []) or [])
+        caches["retrieval_index"] = {
+            "segments": len(segments),
+            "mapped_bytes": sum(
+                _file_size(os.path.join(segment.path, name)) or 0
+                for segment in segments for name in os.listdir(segment.path)
+            ) if segments else 0,
+        }
+
+    key_pool = _module_global("app.chat_service", "key_pool")
+    if key_pool is not None:
+        caches["llm_clients"] = {"count": len(key_pool.keys)}
+
+    scheduler = _module_global("app.scheduler", "_scheduler")
+    if scheduler is not None:
+        caches["scheduler_queue"] = {"queued": sum(len(s.queue) for s in scheduler.classes.values())}
+
+    recorder = _module_global("app.traffic_capture", "_recorder")
+    if recorder is not None:
+        caches["traffic_capture_queue"] = {"queued": recorder.queue.qsize()}
+
+    for handler in logging.getLogger().handlers:
+        log_queue = getattr(handler, "queue", None)
+        if log_queue is not None and hasattr(log_queue, "qsize"):
+            caches["log_queue"] = {"queued": log_queue.qsize()}
+    return caches
+
+
+def _read_int(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def process_memory() -> Dict[str, Any]:
+    """进程 RSS、峰值 RSS，以及容器的内存用量和上限（cgroup v2 / v1）"""
+    info: Dict[str, Any] = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key = "rss_bytes" if line.startswith("VmRSS:") else "peak_rss_bytes"
+                    info[key] = int(line.split()[1]) * 1024
+    except OSError:
+        import resource
+        # Linux 上单位为 KB，macOS 上为字节
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        info["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+    info["cgroup_usage_bytes"] = (_read_int("/sys/fs/cgroup/memory.current")
+                                  or _read_int("/sys/fs/cgroup/memory/memory.usage_in_bytes"))
+    info["cgroup_limit_bytes"] = (_read_int("/sys/fs/cgroup/memory.max")
+                                  or _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes"))
+    return info
+
+
+def object_counts(limit: int = 30) -> List[Dict[str, Any]]:
+    """按类型统计 GC 跟踪的对象数量（遍历整个堆，耗时与对象数成正比）"""
+    counts: Dict[str, int] = {}
+    for obj in gc.get_objects():
+        cls = type(obj)
+        name = f"{cls.__module__}.{cls.__qualname__}"
+        counts[name] = counts.get(name, 0) + 1
+    top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [{"type": name, "count": count} for name, count in top]
+
+
+def memory_summary(session_limit: int = 20) -> Dict[str, Any]:
+    """内存概况：进程、会话、缓存、GC 和 tracemalloc 状态"""
+    summary = {
+        "process": process_memory(),
+        "sessions": session_registry.snapshot(session_limit),
+        "caches": cache_sizes(),
+        "gc": {"counts": gc.get_count(), "uncollectable": len(gc.garbage)},
+        "tracemalloc": {"tracing": tracemalloc.is_tracing(), "snapshots": snapshot_store.list()},
+    }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        summary["tracemalloc"].update({"traced_bytes": current, "traced_peak_bytes": peak})
+    return summary
+
+
+class SnapshotStore:
+    """进程内保存最近的 tracemalloc 快照，超过上限时丢弃最早的"""
+
+    # 与应用无关的分配（tracemalloc 自身、导入机制）
+    FILTERS = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ]
+
+    def __init__(self, limit: int = MEMORY_SNAPSHOT_LIMIT):
+        self.limit = limit
+        self._snapshots: "OrderedDict[int, tuple]" = OrderedDict()
+        self._next_id = 1
+
+    def take(self) -> Dict[str, Any]:
+        """拍摄快照（需要先开启 tracemalloc）"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError("tracemalloc 未开启")
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.FILTERS)
+        snapshot_id = self._next_id
+        self._next_id += 1
+        self._snapshots[snapshot_id] = (time.time(), snapshot)
+        while len(self._snapshots) > self.limit:
+            self._snapshots.popitem(last=False)
+        return {"id": snapshot_id, "total_bytes": sum(stat.size for stat in snapshot.statistics("filename"))}
+
+    def get(self, snapshot_id: int) -> tracemalloc.Snapshot:
+        if snapshot_id not in self._snapshots:
+            raise KeyError(snapshot_id)
+        return self._snapshots[snapshot_id][1]
+
+    def delete(self, snapshot_id: int):
+        self._snapshots.pop(snapshot_id, None)
+
+    def clear(self):
+        self._snapshots.clear()
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [{"id": snapshot_id, "taken_at": round(taken_at, 3)}
+                for snapshot_id, (taken_at, _) in self._snapshots.items()]
+
+
+snapshot_store = SnapshotStore()
+
+
+def _format_traceback(traceback: tracemalloc.Traceback) -> List[str]:
+    return [f"{frame.filename}:{frame.lineno}" for frame in traceback]
+
+
+def top_allocations(snapshot: tracemalloc.Snapshot, key_type: str = "lineno", limit: int = 30) -> List[Dict[str, Any]]:
+    """快照中占用最多的分配位置"""
+    return [
+        {"location": _format_traceback(stat.traceback), "bytes": stat.size, "count": stat.count}
+        for stat in snapshot.statistics(key_type)[:limit]
+    ]
+
+
+def diff_snapshots(current: tracemalloc.Snapshot, base: tracemalloc.Snapshot, key_type: str = "lineno",
+                   limit: int = 30) -> List[Dict[str, Any]]:
+    """两个快照之间增长最多的分配位置"""
+    return [
+        {"location": _format_traceback(stat.traceback), "bytes": stat.size, "bytes_diff": stat.size_diff,
+         "count": stat.count, "count_diff": stat.count_diff}
+        for stat in current.compare_to(base, key_type)[:limit]
+    ]
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """校验管理令牌；未配置 ADMIN_TOKEN 时管理接口不可用"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="管理令牌无效")
+
+
+KEY_TYPES = "^(lineno|filename|traceback)$"
+
+# FastAPI 应用通过 include_router 挂载；独立运行的 Gradio 通过 launch(app_kwargs={"routes": ...}) 挂载
+admin_router = APIRouter(prefix="/admin/memory", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@admin_router.get("")
+async def get_memory_summary(sessions: int = Query(20, ge=0, le=1000, description="列出占用最多的会话数")):
+    """内存概况：进程 RSS、会话字节数、缓存大小、GC 和 tracemalloc 状态"""
+    return await asyncio.to_thread(memory_summary, sessions)
+
+
+@admin_router.get("/objects")
+async def get_object_counts(limit: int = Query(30, ge=1, le=500)):
+    """按类型统计的对象数量"""
+    return {"objects": await asyncio.to_thread(object_counts, limit)}
+
+
+@admin_router.post("/gc")
+async def run_gc():
+    """执行一次完整 GC，返回回收的对象数和前后的 RSS（用来区分泄漏和尚未回收的循环引用）"""
+    before = process_memory().get("rss_bytes")
+    collected = gc.collect()
+    return {"collected": collected, "rss_before": before, "rss_after": process_memory().get("rss_bytes")}
+
+
+@admin_router.post("/tracemalloc/start")
+async def start_tracemalloc(frames: int = Query(10, ge=1, le=100, description="记录的调用栈深度")):
+    """开启 tracemalloc（之后的分配才会被记录）"""
+    if tracemalloc.is_tracing():
+        return {"tracing": True, "frames": tracemalloc.get_traceback_limit()}
+    tracemalloc.start(frames)
+    logger.warning("tracemalloc started with %s frame(s)", frames)
+    return {"tracing": True, "frames": frames}
+
+
+@admin_router.post("/tracemalloc/stop")
+async def stop_tracemalloc():
+    """关闭 tracemalloc 并丢弃已有快照"""
+    tracemalloc.stop()
+    snapshot_store.clear()
+    return {"tracing": False}
+
+
+@admin_router.post("/snapshots")
+async def take_snapshot(limit: int = Query(20, ge=0, le=500, description="返回占用最多的分配位置数")):
+    """拍摄 tracemalloc 快照"""
+    try:
+        result = await asyncio.to_thread(snapshot_store.take)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if limit:
+        result["top"] = top_allocations(snapshot_store.get(result["id"]), limit=limit)
+    return result
+
+
+@admin_router.get("/snapshots")
+async def list_snapshots():
+    """已保存的快照"""
+    return {"snapshots": snapshot_store.list()}
+
+
+@admin_router.get("/snapshots/{snapshot_id}")
+async def get_snapshot(snapshot_id: int, compare_to: Optional[int] = Query(None, description="与该快照比较增长"),
+                       key_type: str = Query("lineno", pattern=KEY_TYPES), limit: int = Query(30, ge=1, le=500)):
+    """快照中占用最多的分配位置，或与另一个快照相比增长最多的位置"""
+    try:
+        snapshot = snapshot_store.get(snapshot_id)
+        if compare_to is None:
+            return {"id": snapshot_id, "top": await asyncio.to_thread(top_allocations, snapshot, key_type, limit)}
+        base = snapshot_store.get(compare_to)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"快照 {e.args[0]} 不存在")
+    diff = await asyncio.to_thread(diff_snapshots, snapshot, base, key_type, limit)
+    return {"id": snapshot_id, "compare_to": compare_to, "diff": diff}
+
+
+@admin_router.delete("/snapshots/{snapshot_id}")
+async def delete_snapshot(snapshot_id: int):
+    """删除快照"""
+    snapshot_store.delete(snapshot_id)
+    return {"deleted": snapshot_id}
+
+
+def admin_routes() -> list:
+    """供独立运行的 Gradio 使用：launch(app_kwargs={"routes": admin_routes()})"""
+    return list(admin_router.routes)
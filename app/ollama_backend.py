@@ -0,0 +1,203 @@
+"""
+本地 Ollama 推理后端（app_ref.py 使用）
+Ollama 默认在模型空闲 5 分钟后卸载，切换模型或空闲后的第一条消息要先花几秒加载模型。
+这里统一管理本地模型：
+- 每个模型只创建一个客户端，进程内复用
+- 启动时预加载 OLLAMA_MODELS 中的模型，之后定期发送保活请求（OLLAMA_WARM_INTERVAL），并在每次
+  请求中带上 keep_alive（OLLAMA_KEEP_ALIVE），让模型一直驻留内存
+- 每个模型独立限制并发（OLLAMA_MODEL_CONCURRENCY），超出的请求排队，排队超过 OLLAMA_QUEUE_TIMEOUT 时返回繁忙
+
+同时驻留多个模型需要 Ollama 服务端允许（OLLAMA_MAX_LOADED_MODELS），否则保活请求会让模型来回切换
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Ollama 服务地址
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
+# 启动时预加载并保持常驻的模型（逗号分隔）
+OLLAMA_MODELS = [m.strip() for m in os.getenv("OLLAMA_MODELS", "deepseek-r1:1.5b,deepseek-r1:3b").split(",") if m.strip()]
+# 每次请求后模型在 Ollama 中保留的时间（Ollama 的 keep_alive 格式，如 "30m"，-1 表示一直保留）
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# 保活请求的间隔（秒），0 表示不发送保活请求
+OLLAMA_WARM_INTERVAL = float(os.getenv("OLLAMA_WARM_INTERVAL", 240))
+# 每个模型同时进行中的请求数上限（默认值）
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 1))
+# 单独设置某些模型的并发上限，如 "deepseek-r1:1.5b=2,deepseek-r1:3b=1"
+OLLAMA_MODEL_CONCURRENCY = {
+    name.strip(): int(limit)
+    for name, _, limit in (item.partition("=") for item in os.getenv("OLLAMA_MODEL_CONCURRENCY", "").split(","))
+    if name.strip() and limit.strip()
+}
+# 最多排队等待的时间（秒）
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", 60))
+# 加载模型的超时（秒）
+OLLAMA_LOAD_TIMEOUT = float(os.getenv("OLLAMA_LOAD_TIMEOUT", 120))
+
+
+class OllamaBusy(Exception):
+    """模型的并发名额在等待时间内没有空出来"""
+
+
+class ModelState:
+    """单个本地模型的客户端、并发名额和驻留状态"""
+
+    def __init__(self, name: str, client: Any, max_concurrency: int):
+        self.name = name
+        self.client = client
+        self.max_concurrency = max(1, max_concurrency)
+        self.semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests = 0
+        self.rejected = 0
+        # 最近一次确认模型已加载（预加载、保活或正常请求完成）的时间
+        self.warm_at: Optional[float] = None
+        self.last_load_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "model": self.name,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "warm_for": round(time.time() - self.warm_at, 1) if self.warm_at else None,
+            "last_load_ms": self.last_load_ms,
+            "last_error": self.last_error,
+        }
+
+
+class OllamaBackend:
+    """按模型缓存客户端、预加载并保活、限制并发"""
+
+    def __init__(self, client_factory: Callable[[str], Any], models: Optional[List[str]] = None,
+                 base_url: str = OLLAMA_BASE_URL, keep_alive: str = OLLAMA_KEEP_ALIVE,
+                 warm_interval: float = OLLAMA_WARM_INTERVAL):
+        """
+        初始化后端
+
+        Args:
+            client_factory: 根据模型名创建客户端（ChatOllama）的函数
+            models: 预加载并保活的模型
+            base_url: Ollama 服务地址
+            keep_alive: 模型在 Ollama 中保留的时间
+            warm_interval: 保活请求的间隔（秒），0 表示不发送
+        """
+        self.client_factory = client_factory
+        self.models = list(OLLAMA_MODELS if models is None else models)
+        self.base_url = base_url
+        self.keep_alive = keep_alive
+        self.warm_interval = warm_interval
+        self._states: Dict[str, ModelState] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def state(self, model: str) -> ModelState:
+        """获取模型状态（首次使用时创建客户端）"""
+        state = self._states.get(model)
+        if state is None:
+            with self._lock:
+                state = self._states.get(model)
+                if state is None:
+                    limit = OLLAMA_MODEL_CONCURRENCY.get(model, OLLAMA_MAX_CONCURRENCY)
+                    state = ModelState(model, self.client_factory(model), limit)
+                    self._states[model] = state
+        return state
+
+    def client(self, model: str) -> Any:
+        """模型的共享客户端"""
+        return self.state(model).client
+
+    @contextmanager
+    def lease(self, model: str, timeout: float = OLLAMA_QUEUE_TIMEOUT) -> Iterator[Any]:
+        """
+        占用模型的一个并发名额，返回该模型的客户端
+
+        Raises:
+            OllamaBusy: 等待 timeout 秒后仍没有空闲名额
+        """
+        state = self.state(model)
+        state.waiting += 1
+        try:
+            acquired = state.semaphore.acquire(timeout=timeout)
+        finally:
+            state.waiting -= 1
+        if not acquired:
+            state.rejected += 1
+            raise OllamaBusy(f"模型 {model} 繁忙（{state.max_concurrency} 个请求进行中），请稍后重试")
+        state.in_flight += 1
+        state.requests += 1
+        try:
+            yield state.client
+            state.warm_at = time.time()
+        finally:
+            state.in_flight -= 1
+            state.semaphore.release()
+
+    def warm(self, model: str) -> bool:
+        """
+        让 Ollama 加载模型并重置保留时间（不带 prompt 的 generate 请求只加载模型，不生成内容）
+
+        Returns:
+            是否成功
+        """
+        state = self.state(model)
+        started = time.perf_counter()
+        try:
+            response = httpx.post(
+                f"{self.base_url}/api/generate",
+                json={"model": model, "keep_alive": self.keep_alive},
+                timeout=OLLAMA_LOAD_TIMEOUT
+            )
+            response.raise_for_status()
+        except Exception as e:
+            state.last_error = str(e)
+            logger.warning(f"Failed to warm Ollama model {model}: {e}")
+            return False
+        state.last_load_ms = round((time.perf_counter() - started) * 1000, 1)
+        state.warm_at = time.time()
+        state.last_error = None
+        return True
+
+    def preload(self):
+        """依次加载所有配置的模型"""
+        for model in self.models:
+            if self.warm(model):
+                logger.info(f"Ollama model {model} loaded in {self.state(model).last_load_ms}ms")
+
+    def start(self):
+        """在后台线程中预加载模型，之后定期保活（可重复调用，只启动一次）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="ollama-keepalive", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        self.preload()
+        while self.warm_interval > 0 and not self._stop.wait(self.warm_interval):
+            for model in self.models:
+                state = self.state(model)
+                # 最近已有请求使用过的模型不需要额外保活
+                if state.in_flight or (state.warm_at and time.time() - state.warm_at < self.warm_interval):
+                    continue
+                self.warm(model)
+
+    def stop(self):
+        """停止保活线程"""
+        self._stop.set()
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """各模型的并发、排队和驻留状态"""
+        return [state.snapshot() for state in list(self._states.values())]
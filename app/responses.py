@@ -0,0 +1,29 @@
+"""
+JSON 序列化
+安装了 orjson 时使用 orjson 编码响应和 SSE 事件（比标准库 json 快数倍），否则回退到标准库
+"""
+import json
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(data: Any) -> str:
+    """编码为 JSON 字符串（保留中文，不做 ASCII 转义）"""
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False)
+
+
+class FastJSONResponse(JSONResponse):
+    """使用 orjson 渲染的 JSON 响应"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
@@ -0,0 +1,568 @@
+"""
+本地检索增强（BM25）
+对本地文档和代码目录建立磁盘上的倒排索引，回答前检索最相关的片段并在 token 预算内注入提示：
+- 分词：中文按相邻两个字（bigram）切分，代码标识符保留原词并按 snake_case / camelCase 拆分
+- 索引按段（segment）存储，每段是一组 .npy 数组和二进制文件，查询时以内存映射方式打开，
+  启动时不需要把索引读入内存
+- 增量更新：只为新增或修改过的文件写入新段，旧段中对应的片段标记为删除；
+  段数或删除比例过高时合并为一个段
+- 查询时用 numpy 在倒排表上向量化计算 BM25，跳过出现在大部分文档中的词，百万级片段下仍为毫秒级
+
+构建 / 更新索引：
+    python -m app.retrieval update <文档目录>
+    python -m app.retrieval search "<问题>"
+"""
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import shutil
+import asyncio
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 索引目录
+RETRIEVAL_INDEX_PATH = os.getenv("RETRIEVAL_INDEX_PATH", "/tmp/deepseek-chat-agent/retrieval_index")
+# 是否在回答前检索（索引不存在时自动跳过）
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true"
+# 注入提示的片段数和 token 预算
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 5))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", 1500))
+# 每个片段的目标字符数
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", 800))
+# 每个段最多包含的片段数（限制构建时的内存占用）
+RETRIEVAL_SEGMENT_DOCS = int(os.getenv("RETRIEVAL_SEGMENT_DOCS", 200000))
+# 段数超过该值时合并
+RETRIEVAL_MAX_SEGMENTS = int(os.getenv("RETRIEVAL_MAX_SEGMENTS", 8))
+# 出现在超过该比例文档中的词不参与打分（区分度低，倒排表又很长）
+RETRIEVAL_MAX_DF_RATIO = float(os.getenv("RETRIEVAL_MAX_DF_RATIO", 0.05))
+# 跳过超过该大小（字节）的文件
+RETRIEVAL_MAX_FILE_BYTES = int(os.getenv("RETRIEVAL_MAX_FILE_BYTES", 2 * 1024 * 1024))
+
+INDEXED_EXTENSIONS = {
+    ".md", ".txt", ".rst", ".py", ".js", ".ts", ".tsx", ".jsx", ".java", ".go", ".rs", ".c", ".h",
+    ".cpp", ".hpp", ".cs", ".rb", ".php", ".kt", ".swift", ".scala", ".sql", ".sh", ".yaml", ".yml",
+    ".toml", ".json", ".ini", ".cfg", ".html", ".css", ".vue",
+}
+SKIPPED_DIRS = {".git", "node_modules", "__pycache__", ".venv", "venv", "dist", "build", ".idea", ".vscode"}
+
+# BM25 参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+|[\u3400-\u4dbf\u4e00-\u9fff]+")
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中文和代码混合分词
+
+    - 中文：相邻两个字组成一个词（单字的词保留单字）
+    - 标识符：保留完整的小写形式，并按下划线和大小写拆分出子词（getUserName -> get, user, name）
+    - 数字：原样保留
+    """
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        word = match.group()
+        first = word[0]
+        if "\u3400" <= first <= "\u9fff":
+            if len(word) == 1:
+                tokens.append(word)
+            else:
+                tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+            continue
+        lower = word.lower()
+        tokens.append(lower)
+        if first.isdigit():
+            continue
+        parts = [p.lower() for piece in word.split("_") for p in _CAMEL_RE.findall(piece)]
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if len(p) > 1)
+    return tokens
+
+
+def chunk_text(text: str, chunk_chars: int = RETRIEVAL_CHUNK_CHARS) -> List[str]:
+    """按空行（段落 / 代码块）切分，合并到接近 chunk_chars 的片段；超长段落按行切分"""
+    chunks, current = [], ""
+    for block in re.split(r"\n\s*\n", text):
+        block = block.strip("\n")
+        if not block.strip():
+            continue
+        pieces = [block]
+        if len(block) > chunk_chars:
+            pieces, piece = [], ""
+            for line in block.splitlines():
+                if piece and len(piece) + len(line) + 1 > chunk_chars:
+                    pieces.append(piece)
+                    piece = ""
+                piece = f"{piece}\n{line}" if piece else line
+            if piece:
+                pieces.append(piece)
+        for piece in pieces:
+            if current and len(current) + len(piece) + 2 > chunk_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class Segment:
+    """一个只读的索引段（内存映射）"""
+
+    def __init__(self, path: str, deleted: List[int]):
+        self.path = path
+        self.name = os.path.basename(path)
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        self.term_offsets = load("term_offsets.npy")
+        self.post_offsets = load("post_offsets.npy")
+        self.post_docs = load("post_docs.npy")
+        self.post_tfs = load("post_tfs.npy")
+        self.doc_lens = load("doc_lens.npy")
+        self.text_offsets = load("text_offsets.npy")
+        self._files = [open(os.path.join(path, name), "rb") for name in ("terms.bin", "texts.bin")]
+        self.terms = self._mmap(self._files[0])
+        self.texts = self._mmap(self._files[1])
+        self.num_terms = len(self.term_offsets) - 1
+        self.num_docs = len(self.doc_lens)
+        self.total_len = int(self.doc_lens.sum(dtype=np.uint64))
+        self.deleted = np.zeros(self.num_docs, dtype=bool)
+        if deleted:
+            self.deleted[np.asarray(deleted, dtype=np.int64)] = True
+        self.live_docs = self.num_docs - int(self.deleted.sum())
+        self._norm = None
+        self._norm_avgdl = None
+
+    @staticmethod
+    def _mmap(f) -> bytes:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def length_norm(self, avgdl: float) -> np.ndarray:
+        """BM25 中与文档长度有关的部分 k1 * (1 - b + b * dl / avgdl)，按平均长度缓存"""
+        if self._norm_avgdl != avgdl:
+            self._norm = (BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lens / avgdl)).astype(np.float32)
+            self._norm_avgdl = avgdl
+        return self._norm
+
+    def _term(self, i: int) -> bytes:
+        return self.terms[int(self.term_offsets[i]):int(self.term_offsets[i + 1])]
+
+    def find(self, term: bytes) -> int:
+        """二分查找词的序号，不存在时返回 -1"""
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.num_terms and self._term(lo) == term else -1
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = int(self.post_offsets[term_id]), int(self.post_offsets[term_id + 1])
+        return self.post_docs[start:end], self.post_tfs[start:end]
+
+    def document(self, doc_id: int) -> dict:
+        start, end = int(self.text_offsets[doc_id]), int(self.text_offsets[doc_id + 1])
+        return json.loads(self.texts[start:end].decode("utf-8"))
+
+    def close(self):
+        for m in (self.terms, self.texts):
+            if isinstance(m, mmap.mmap):
+                m.close()
+        for f in self._files:
+            f.close()
+
+
+def write_segment(path: str, documents: List[dict]):
+    """
+    把一批片段写成一个索引段
+
+    Args:
+        path: 段目录
+        documents: [{"source", "chunk", "text"}]
+    """
+    postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    doc_lens = np.zeros(len(documents), dtype=np.uint32)
+    for doc_id, doc in enumerate(documents):
+        counts = Counter(tokenize(doc["text"]))
+        doc_lens[doc_id] = sum(counts.values())
+        for term, tf in counts.items():
+            postings[term].append((doc_id, min(tf, 65535)))
+
+    terms = sorted((t.encode("utf-8"), t) for t in postings)
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    post_offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    total = sum(len(p) for p in postings.values())
+    post_docs = np.empty(total, dtype=np.uint32)
+    post_tfs = np.empty(total, dtype=np.uint16)
+    pos = 0
+    for i, (encoded, term) in enumerate(terms):
+        plist = postings[term]
+        term_offsets[i + 1] = term_offsets[i] + len(encoded)
+        post_docs[pos:pos + len(plist)] = [d for d, _ in plist]
+        post_tfs[pos:pos + len(plist)] = [tf for _, tf in plist]
+        pos += len(plist)
+        post_offsets[i + 1] = pos
+
+    encoded_docs = [json.dumps(doc, ensure_ascii=False).encode("utf-8") for doc in documents]
+    text_offsets = np.zeros(len(documents) + 1, dtype=np.uint64)
+    text_offsets[1:] = np.cumsum([len(d) for d in encoded_docs], dtype=np.uint64)
+
+    tmp_path = path + ".tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    with open(os.path.join(tmp_path, "terms.bin"), "wb") as f:
+        f.write(b"".join(encoded for encoded, _ in terms))
+    with open(os.path.join(tmp_path, "texts.bin"), "wb") as f:
+        f.write(b"".join(encoded_docs))
+    for name, array in (("term_offsets", term_offsets), ("post_offsets", post_offsets), ("post_docs", post_docs),
+                        ("post_tfs", post_tfs), ("doc_lens", doc_lens), ("text_offsets", text_offsets)):
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    os.replace(tmp_path, path)
+
+
+class BM25Index:
+    """由多个段组成的 BM25 索引，manifest.json 记录段列表、已删除片段和文件状态"""
+
+    def __init__(self, path: str = RETRIEVAL_INDEX_PATH):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.segments: List[Segment] = []
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def _read_manifest(self) -> dict:
+        if not self.exists():
+            return {"next_segment": 1, "segments": [], "sources": {}}
+        with open(self.manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: dict):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        # 原子替换：正在查询的进程要么看到旧索引，要么看到新索引
+        os.replace(tmp, self.manifest_path)
+
+    def reload_if_changed(self) -> bool:
+        """manifest 有变化（其他进程更新了索引）时重新打开各段，返回索引是否可用"""
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._manifest_mtime:
+            return bool(self.segments)
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                manifest = self._read_manifest()
+                # 旧段不主动关闭：可能仍有查询在使用，不再被引用后由垃圾回收释放
+                self.segments = [Segment(os.path.join(self.path, s["name"]), s.get("deleted", []))
+                                 for s in manifest["segments"]]
+                self._manifest_mtime = mtime
+                logger.info(f"Retrieval index loaded: {len(self.segments)} segment(s), "
+                            f"{sum(s.live_docs for s in self.segments)} chunks")
+        return bool(self.segments)
+
+    def search(self, query: str, top_k: int = RETRIEVAL_TOP_K) -> List[dict]:
+        """
+        检索与问题最相关的片段
+
+        Returns:
+            [{"source", "chunk", "text", "score"}]，按得分从高到低排列
+        """
+        if not self.reload_if_changed():
+            return []
+        segments = self.segments
+        terms = [t.encode("utf-8") for t in dict.fromkeys(tokenize(query))]
+        if not terms:
+            return []
+
+        total_docs = sum(s.live_docs for s in segments)
+        if total_docs == 0:
+            return []
+        avgdl = sum(s.total_len for s in segments) / max(1, sum(s.num_docs for s in segments))
+        # 每个词在各段中的位置和全局文档频率
+        lookups = [[s.find(term) for s in segments] for term in terms]
+        dfs = [sum(int(s.post_offsets[i + 1] - s.post_offsets[i]) for s, i in zip(segments, ids) if i >= 0)
+               for ids in lookups]
+        selected = [j for j, df in enumerate(dfs) if 0 < df <= RETRIEVAL_MAX_DF_RATIO * total_docs]
+        if not selected:
+            # 所有词都很常见时，只用最少见的一个词
+            present = [j for j, df in enumerate(dfs) if df > 0]
+            if not present:
+                return []
+            selected = [min(present, key=lambda j: dfs[j])]
+
+        candidates = []
+        for seg_index, segment in enumerate(segments):
+            doc_parts, score_parts = [], []
+            for j in selected:
+                term_id = lookups[j][seg_index]
+                if term_id < 0:
+                    continue
+                docs, tfs = segment.postings(term_id)
+                idf = np.float32(np.log1p((total_docs - dfs[j] + 0.5) / (dfs[j] + 0.5)))
+                tf = tfs.astype(np.float32)
+                norm = segment.length_norm(avgdl)[docs]
+                doc_parts.append(docs)
+                score_parts.append(idf * tf * np.float32(BM25_K1 + 1) / (tf + norm))
+            if not doc_parts:
+                continue
+            if sum(len(d) for d in doc_parts) * 8 < segment.num_docs:
+                # 候选较少：按候选去重累加，避免分配整段大小的数组
+                docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+                scores = np.bincount(inverse, weights=np.concatenate(score_parts)).astype(np.float32)
+            else:
+                # 候选较多：在整段大小的数组上累加（同一个词的倒排表中文档不重复，可以直接按下标相加），
+                # 再只在出现过的文档中取前 k 个
+                totals = np.zeros(segment.num_docs, dtype=np.float32)
+                for part_docs, part_scores in zip(doc_parts, score_parts):
+                    totals[part_docs] += part_scores
+                docs = np.concatenate(doc_parts)
+                # 一个文档最多重复 len(doc_parts) 次，取前 k * len(doc_parts) 个再去重即可覆盖前 k 名
+                limit = top_k * len(doc_parts)
+                if len(docs) > limit:
+                    docs = docs[np.argpartition(-totals[docs], limit)[:limit]]
+                docs = np.unique(docs)
+                scores = totals[docs]
+            keep = ~segment.deleted[docs] & (scores > 0)
+            docs, scores = docs[keep], scores[keep]
+            if len(docs) > top_k:
+                best = np.argpartition(-scores, top_k)[:top_k]
+                docs, scores = docs[best], scores[best]
+            candidates.extend((float(score), seg_index, int(doc)) for doc, score in zip(docs, scores))
+
+        candidates.sort(reverse=True)
+        results = []
+        for score, seg_index, doc_id in candidates[:top_k]:
+            doc = segments[seg_index].document(doc_id)
+            doc["score"] = round(score, 3)
+            results.append(doc)
+        return results
+
+    def update(self, corpus_dir: str) -> dict:
+        """
+        增量更新索引：新增或修改过的文件写入新段，删除或修改过的文件在旧段中标记删除
+
+        Returns:
+            {"added_files", "removed_files", "chunks"}
+        """
+        os.makedirs(self.path, exist_ok=True)
+        manifest = self._read_manifest()
+        segments_by_name = {s["name"]: s for s in manifest["segments"]}
+        sources = manifest["sources"]
+        seen = set()
+        changed = []
+        for file_path in iter_corpus_files(corpus_dir):
+            stat = os.stat(file_path)
+            seen.add(file_path)
+            entry = sources.get(file_path)
+            if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                continue
+            changed.append((file_path, stat))
+
+        changed_paths = {file_path for file_path, _ in changed}
+        removed = [p for p in sources if p not in seen or p in changed_paths]
+        for file_path in removed:
+            entry = sources.pop(file_path)
+            segment = segments_by_name.get(entry["segment"])
+            if segment is not None:
+                segment.setdefault("deleted", []).extend(range(entry["start"], entry["end"]))
+
+        documents: List[dict] = []
+        pending_sources: Dict[str, dict] = {}
+
+        def flush():
+            if not documents:
+                return
+            name = f"seg-{manifest['next_segment']:06d}"
+            manifest["next_segment"] += 1
+            write_segment(os.path.join(self.path, name), documents)
+            manifest["segments"].append({"name": name, "docs": len(documents), "deleted": []})
+            segments_by_name[name] = manifest["segments"][-1]
+            for source, entry in pending_sources.items():
+                entry["segment"] = name
+                sources[source] = entry
+            documents.clear()
+            pending_sources.clear()
+
+        chunks_added = 0
+        for file_path, stat in changed:
+            try:
+                with open(file_path, encoding="utf-8") as f:
+                    text = f.read()
+            except (UnicodeDecodeError, OSError):
+                continue
+            start = len(documents)
+            relative = os.path.relpath(file_path, corpus_dir)
+            for i, chunk in enumerate(chunk_text(text)):
+                documents.append({"source": relative, "chunk": i, "text": chunk})
+            pending_sources[file_path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size,
+                                          "start": start, "end": len(documents)}
+            chunks_added += len(documents) - start
+            if len(documents) >= RETRIEVAL_SEGMENT_DOCS:
+                flush()
+        flush()
+
+        # 删除比例过高或段数过多时合并
+        total = sum(s["docs"] for s in manifest["segments"])
+        deleted = sum(len(s.get("deleted", [])) for s in manifest["segments"])
+        if len(manifest["segments"]) > RETRIEVAL_MAX_SEGMENTS or (total and deleted / total > 0.3):
+            manifest = self._merge(manifest)
+        else:
+            # 删除掉已经没有存活片段的段
+            manifest["segments"] = [s for s in manifest["segments"] if len(set(s.get("deleted", []))) < s["docs"]]
+        self._write_manifest(manifest)
+        self._remove_unused_segments(manifest)
+        return {
+            "added_files": len(changed),
+            "removed_files": len([p for p in removed if p not in seen]),
+            "chunks": chunks_added
+        }
+
+    def _merge(self, manifest: dict) -> dict:
+        """把所有段中存活的片段按段大小上限重新写成新段"""
+        merged = {"next_segment": manifest["next_segment"], "segments": [], "sources": {}}
+        documents: List[dict] = []
+        source_ranges: Dict[str, List[int]] = {}
+        by_segment = defaultdict(list)
+        for path, entry in manifest["sources"].items():
+            by_segment[entry["segment"]].append((entry["start"], entry["end"], path, entry))
+
+        def flush():
+            if not documents:
+                return
+            name = f"seg-{merged['next_segment']:06d}"
+            merged["next_segment"] += 1
+            write_segment(os.path.join(self.path, name), documents)
+            merged["segments"].append({"name": name, "docs": len(documents), "deleted": []})
+            for path, (start, end, entry) in source_ranges.items():
+                merged["sources"][path] = dict(entry, segment=name, start=start, end=end)
+            documents.clear()
+            source_ranges.clear()
+
+        for info in manifest["segments"]:
+            segment = Segment(os.path.join(self.path, info["name"]), [])
+            try:
+                for start, end, path, entry in sorted(by_segment.get(info["name"], [])):
+                    new_start = len(documents)
+                    documents.extend(segment.document(d) for d in range(start, end))
+                    source_ranges[path] = (new_start, len(documents), entry)
+                    if len(documents) >= RETRIEVAL_SEGMENT_DOCS:
+                        flush()
+            finally:
+                segment.close()
+        flush()
+        logger.info(f"Merged retrieval index into {len(merged['segments'])} segment(s)")
+        return merged
+
+    def _remove_unused_segments(self, manifest: dict):
+        """删除 manifest 中不再引用的段目录（已打开的内存映射在 Linux 上仍然有效）"""
+        used = {s["name"] for s in manifest["segments"]}
+        for name in os.listdir(self.path):
+            if name.startswith("seg-") and name not in used:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+
+def iter_corpus_files(corpus_dir: str) -> Iterator[str]:
+    """遍历语料目录中需要索引的文本和代码文件"""
+    for root, dirs, files in os.walk(corpus_dir):
+        dirs[:] = [d for d in dirs if d not in SKIPPED_DIRS and not d.startswith(".")]
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in INDEXED_EXTENSIONS:
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            try:
+                if os.path.getsize(path) <= RETRIEVAL_MAX_FILE_BYTES:
+                    yield path
+            except OSError:
+                continue
+
+
+def build_context(passages: List[dict], token_budget: int = RETRIEVAL_TOKEN_BUDGET) -> str:
+    """
+    把检索结果拼成注入提示的参考资料，总长度不超过 token 预算（按得分顺序，放不下的片段跳过）
+    """
+    # 延迟导入：命令行构建索引时不需要配置 DEEPSEEK_API_KEY
+    from app.chat_service import estimate_tokens
+    parts, used = [], 0
+    for p in passages:
+        part = f"[{p['source']}#{p['chunk']}]\n{p['text']}"
+        tokens = estimate_tokens(part)
+        if used + tokens > token_budget:
+            continue
+        parts.append(part)
+        used += tokens
+    return "\n\n---\n\n".join(parts)
+
+
+_index: Optional[BM25Index] = None
+
+
+def get_retrieval_index() -> BM25Index:
+    """获取进程内的检索索引单例"""
+    global _index
+    if _index is None:
+        _index = BM25Index()
+    return _index
+
+
+async def retrieve_context(query: str, top_k: int = RETRIEVAL_TOP_K,
+                           token_budget: int = RETRIEVAL_TOKEN_BUDGET) -> str:
+    """
+    检索与问题相关的参考资料（未启用或索引不存在时返回空字符串）
+
+    在线程池中执行，冷启动时的缺页读取不会阻塞事件循环
+    """
+    if not RETRIEVAL_ENABLED:
+        return ""
+    index = get_retrieval_index()
+    if not index.exists():
+        return ""
+    started = time.perf_counter()
+    try:
+        passages = await asyncio.to_thread(index.search, query, top_k)
+    except Exception as e:
+        logger.warning(f"Retrieval failed: {e}")
+        return ""
+    logger.debug(f"Retrieved {len(passages)} passages in {(time.perf_counter() - started) * 1000:.1f}ms")
+    return build_context(passages, token_budget)
+
+
+def main(argv: List[str]):
+    """命令行入口：update <目录> / search <问题>"""
+    if len(argv) < 2 or argv[0] not in ("update", "search"):
+        print("Usage: python -m app.retrieval update <corpus_dir> | search <query>")
+        sys.exit(1)
+    index = get_retrieval_index()
+    if argv[0] == "update":
+        started = time.perf_counter()
+        stats = index.update(argv[1])
+        print(f"Indexed {stats['added_files']} changed file(s), {stats['chunks']} chunk(s); "
+              f"removed {stats['removed_files']} file(s) in {time.perf_counter() - started:.1f}s")
+        return
+    started = time.perf_counter()
+    results = index.search(" ".join(argv[1:]))
+    elapsed = (time.perf_counter() - started) * 1000
+    for r in results:
+        print(f"{r['score']:.3f}  {r['source']}#{r['chunk']}  {r['text'][:80]!r}")
+    print(f"{len(results)} result(s) in {elapsed:.1f}ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,207 @@
+"""
+并行 N 选优采样
+同一个请求并发生成多个候选回复（可以为每个候选指定不同的 temperature），在服务端用本地打分器排序：
+- 候选之间互不等待，总耗时约等于最慢的一个候选，而不是 N 次串行调用之和
+- 单个候选失败不影响其他候选，全部失败时才报错
+- 打分器可插拔：register_scorer 注册新的打分函数，请求中按名称和权重组合使用
+
+内置打分器（分数范围 0~1）：
+- length：非空、没有被 max_tokens 截断的回复得分高，越简洁得分越高
+- format：Markdown 代码块闭合；看起来是 JSON 的回复能被解析
+- code_compiles：回复中的 Python 代码块都能通过编译（只编译、不执行）
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage
+
+from app.chat_service import ainvoke_chat, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 单个请求最多生成的候选数
+SAMPLING_MAX_N = int(os.getenv("SAMPLING_MAX_N", 8))
+# 未指定打分器时使用的组合（名称: 权重）
+DEFAULT_SCORERS = {"format": 1.0, "length": 0.5}
+
+_CODE_BLOCK_RE = re.compile(r"```([\w+-]*)[^\n]*\n(.*?)```", re.S)
+
+# 打分函数：(回复文本, 最大 token 数) -> 0~1 的分数
+Scorer = Callable[[str, int], float]
+
+
+def score_length(text: str, max_tokens: int) -> float:
+    """非空且没有被截断的回复得分高，越短越好"""
+    tokens = estimate_tokens(text)
+    if not text.strip():
+        return 0.0
+    if tokens >= max_tokens * 0.95:
+        # 很可能被 max_tokens 截断
+        return 0.2
+    return 1.0 - 0.5 * tokens / max_tokens
+
+
+def score_format(text: str, max_tokens: int) -> float:
+    """Markdown 代码块闭合；以 { 或 [ 开头的回复必须是合法 JSON"""
+    checks = [text.count("```") % 2 == 0]
+    stripped = text.strip()
+    if stripped.startswith(("{", "[")):
+        try:
+            json.loads(stripped)
+            checks.append(True)
+        except ValueError:
+            checks.append(False)
+    return sum(checks) / len(checks)
+
+
+def score_code_compiles(text: str, max_tokens: int) -> float:
+    """Python 代码块中能通过编译的比例（没有 Python 代码块时为 0）"""
+    blocks = [code for lang, code in _CODE_BLOCK_RE.findall(text) if lang.lower() in ("python", "py", "python3")]
+    if not blocks:
+        return 0.0
+    compiled = 0
+    for code in blocks:
+        try:
+            compile(code, "<candidate>", "exec")
+            compiled += 1
+        except (SyntaxError, ValueError):
+            pass
+    return compiled / len(blocks)
+
+
+SCORERS: Dict[str, Scorer] = {
+    "length": score_length,
+    "format": score_format,
+    "code_compiles": score_code_compiles,
+}
+
+
+def register_scorer(name: str, scorer: Scorer):
+    """注册打分器（同名打分器会被覆盖）"""
+    SCORERS[name] = scorer
+
+
+def resolve_scorers(scorers: Optional[Dict[str, float]]) -> Dict[str, float]:
+    """
+    校验请求中的打分器组合
+
+    Raises:
+        ValueError: 包含未注册的打分器
+    """
+    scorers = scorers or DEFAULT_SCORERS
+    unknown = [name for name in scorers if name not in SCORERS]
+    if unknown:
+        raise ValueError(f"未知的打分器：{', '.join(unknown)}，可用：{', '.join(SCORERS)}")
+    return scorers
+
+
+def score_candidate(text: str, max_tokens: int, scorers: Dict[str, float]) -> Dict[str, Any]:
+    """按权重计算总分，返回总分和各打分器的分数"""
+    scores = {}
+    for name, weight in scorers.items():
+        try:
+            scores[name] = round(float(SCORERS[name](text, max_tokens)), 4)
+        except Exception as e:
+            logger.warning(f"Scorer {name} failed: {e}")
+            scores[name] = 0.0
+    total_weight = sum(scorers.values()) or 1.0
+    return {
+        "score": round(sum(scores[name] * weight for name, weight in scorers.items()) / total_weight, 4),
+        "scores": scores,
+    }
+
+
+def candidate_temperatures(n: int, temperature: Optional[float], temperatures: Optional[List[float]]) -> List[float]:
+    """每个候选使用的 temperature：指定列表时循环使用，否则都使用请求的 temperature"""
+    if temperatures:
+        return [temperatures[i % len(temperatures)] for i in range(n)]
+    return [temperature if temperature is not None else 0.7] * n
+
+
+async def _generate_candidate(index: int, messages: List[BaseMessage], temperature: float, max_tokens: int,
+                              scorers: Dict[str, float]) -> Dict[str, Any]:
+    """生成并打分一个候选（失败时记录错误，不抛出）"""
+    started = time.perf_counter()
+    candidate: Dict[str, Any] = {"index": index, "temperature": temperature}
+    try:
+        message = await ainvoke_chat(messages, temperature=temperature, max_tokens=max_tokens)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # _exception 只在服务端使用：所有候选都失败时重新抛出，便于接口返回对应的状态码
+        candidate.update({"message": None, "error": str(e), "score": None, "scores": {}, "_exception": e})
+    else:
+        # 编译代码等打分可能较慢，放到线程池中执行
+        candidate["message"] = message
+        candidate.update(await asyncio.to_thread(score_candidate, message, max_tokens, scorers))
+        candidate["completion_tokens"] = estimate_tokens(message)
+    candidate["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return candidate
+
+
+def public_candidate(candidate: Dict[str, Any]) -> Dict[str, Any]:
+    """去掉仅供服务端使用的字段"""
+    return {k: v for k, v in candidate.items() if not k.startswith("_")}
+
+
+def pick_best(candidates: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """分数最高的候选（同分时取先完成的）"""
+    succeeded = [c for c in candidates if c.get("error") is None]
+    if not succeeded:
+        return None
+    return max(succeeded, key=lambda c: c["score"])
+
+
+async def iter_candidates(messages: List[BaseMessage], n: int, max_tokens: int, temperature: Optional[float] = None,
+                          temperatures: Optional[List[float]] = None,
+                          scorers: Optional[Dict[str, float]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    并发生成 n 个候选，按完成顺序逐个返回（已打分）
+
+    迭代提前结束（如客户端断开）时取消尚未完成的候选
+
+    Args:
+        messages: LangChain 消息列表
+        n: 候选数
+        max_tokens: 每个候选的最大 token 数
+        temperature: 请求的 temperature
+        temperatures: 各候选的 temperature（循环使用）
+        scorers: 打分器组合（名称: 权重）
+    """
+    scorers = resolve_scorers(scorers)
+    tasks = [
+        asyncio.create_task(_generate_candidate(i, messages, t, max_tokens, scorers))
+        for i, t in enumerate(candidate_temperatures(n, temperature, temperatures))
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def sample_best(messages: List[BaseMessage], n: int, max_tokens: int, temperature: Optional[float] = None,
+                      temperatures: Optional[List[float]] = None,
+                      scorers: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    并发生成 n 个候选并排序
+
+    Returns:
+        {"best": 最佳候选, "candidates": 按分数从高到低排列的全部候选（失败的排在最后）}
+
+    Raises:
+        所有候选都失败时，抛出第一个完成的候选的异常
+    """
+    candidates = [c async for c in iter_candidates(messages, n, max_tokens, temperature, temperatures, scorers)]
+    best = pick_best(candidates)
+    if best is None:
+        raise candidates[0]["_exception"]
+    candidates.sort(key=lambda c: (c.get("error") is not None, -(c["score"] or 0)))
+    return {"best": public_candidate(best), "candidates": [public_candidate(c) for c in candidates]}
@@ -0,0 +1,330 @@
+"""
+上游调用调度器：按流量类别加权公平排队
+Gradio 交互用户和后台批量调用共用同一份上游并发和速率限制，批量任务突发时不能让界面卡住：
+- 所有模型调用先在调度器领取一个并发名额（SCHEDULER_MAX_CONCURRENCY），名额不足时按类别排队
+- 各类别按权重（SCHEDULER_WEIGHTS）加权公平地获得名额：排队中的类别轮流领取，权重越大领取得越频繁
+- interactive 类别保留一部分名额（SCHEDULER_INTERACTIVE_RESERVED），批量流量再多也占不到
+- 某个类别排队超过 SCHEDULER_STARVATION_SECONDS 仍未领到名额时优先服务它，低权重类别不会被饿死
+
+满足以下任一条件的请求属于 batch，其余属于 interactive：
+1. 请求使用的 API Key 在 SCHEDULER_BATCH_API_KEYS 中（X-API-Key 或 Authorization: Bearer）
+2. X-Traffic-Class: batch 请求头（请求头只能降级：任何客户端都能发送，不能据此占用 interactive 的权重和保留名额）
+3. 路由在 SCHEDULER_BATCH_ROUTES 中
+不在 HTTP 请求中的调用（进程内的 Gradio 界面）属于 interactive
+
+名额和排队状态在进程内维护：多 worker 部署（WEB_CONCURRENCY=N）时每个 worker 各有一份，
+整个实例同时进行中的上游调用最多为 N × SCHEDULER_MAX_CONCURRENCY，保留名额同理
+"""
+import os
+import time
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.deadline import Deadline, DeadlineExceeded
+from app.structured_logging import bind_log_fields
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+TRAFFIC_CLASSES = (INTERACTIVE, BATCH)
+
+
+def _parse_weights(value: str) -> Dict[str, float]:
+    """解析 "interactive=4,batch=1" 格式的权重配置"""
+    weights = {INTERACTIVE: 4.0, BATCH: 1.0}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() in weights and weight.strip():
+            weights[name.strip()] = max(float(weight), 0.01)
+    return weights
+
+
+def _parse_list(value: str) -> List[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# 每个 worker 进程中同时进行中的上游调用数上限，0 表示不调度（不排队，直接调用）
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", 16))
+# 各类别的权重
+SCHEDULER_WEIGHTS = _parse_weights(os.getenv("SCHEDULER_WEIGHTS", "interactive=4,batch=1"))
+# 为 interactive 保留的名额数（batch 最多使用 SCHEDULER_MAX_CONCURRENCY 减去该值）
+SCHEDULER_INTERACTIVE_RESERVED = int(os.getenv("SCHEDULER_INTERACTIVE_RESERVED",
+                                               max(1, SCHEDULER_MAX_CONCURRENCY // 4)))
+# 类别排队超过该时间（秒）仍未领到名额时不再按权重，优先服务该类别
+SCHEDULER_STARVATION_SECONDS = float(os.getenv("SCHEDULER_STARVATION_SECONDS", 10))
+# 每个类别最多排队的请求数，超过后直接拒绝（503），0 表示不限制
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", 256))
+# 最多排队等待的时间（秒），同时受请求截止时间限制
+SCHEDULER_MAX_WAIT = float(os.getenv("SCHEDULER_MAX_WAIT", 60))
+# 默认属于 batch 的路由
+SCHEDULER_BATCH_ROUTES = set(_parse_list(os.getenv("SCHEDULER_BATCH_ROUTES", "/api/chat,/api/chat/simple,/api/chat/sample")))
+# 属于 batch 的客户端 API Key
+SCHEDULER_BATCH_API_KEYS = set(_parse_list(os.getenv("SCHEDULER_BATCH_API_KEYS", "")))
+
+_traffic_class: contextvars.ContextVar[str] = contextvars.ContextVar("traffic_class", default=INTERACTIVE)
+
+
+class SchedulerBusy(Exception):
+    """排队的请求过多，或排队时间超过上限"""
+
+
+def get_traffic_class() -> str:
+    """当前请求的流量类别（不在 HTTP 请求中时为 interactive）"""
+    return _traffic_class.get()
+
+
+def set_traffic_class(traffic_class: str):
+    """设置当前上下文的流量类别（如后台任务改为 batch，只影响当前任务）"""
+    _traffic_class.set(traffic_class)
+
+
+def classify_request(path: str, headers: Headers) -> str:
+    """
+    根据 API Key、请求头和路由确定流量类别
+
+    Args:
+        path: 请求路径
+        headers: 请求头
+
+    Returns:
+        interactive 或 batch
+    """
+    api_key = headers.get("x-api-key") or ""
+    authorization = headers.get("authorization", "")
+    if not api_key and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    if api_key and api_key in SCHEDULER_BATCH_API_KEYS:
+        return BATCH
+    # 客户端可以主动把请求降为 batch，但不能把批量路由提升为 interactive
+    if headers.get("x-traffic-class", "").strip().lower() == BATCH:
+        return BATCH
+    return BATCH if path in SCHEDULER_BATCH_ROUTES else INTERACTIVE
+
+
+class _Waiter:
+    """一个排队中的请求"""
+
+    __slots__ = ("future", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class _ClassState:
+    """单个流量类别的队列和统计"""
+
+    def __init__(self, name: str, weight: float, reserved: int):
+        self.name = name
+        self.weight = weight
+        self.reserved = reserved
+        self.queue: Deque[_Waiter] = deque()
+        self.in_flight = 0
+        # 虚拟时间：每领取一个名额增加 1 / weight，值最小的类别优先
+        self.virtual_time = 0.0
+        self.last_granted_at = 0.0
+        self.granted = 0
+        self.rejected = 0
+        self.starvation_grants = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "weight": self.weight,
+            "reserved": self.reserved,
+            "in_flight": self.in_flight,
+            "queued": len(self.queue),
+            "oldest_wait": round(now - self.queue[0].enqueued_at, 3) if self.queue else 0.0,
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "starvation_grants": self.starvation_grants,
+            "avg_wait": round(self.total_wait / self.granted, 4) if self.granted else 0.0,
+            "max_wait": round(self.max_wait, 3),
+        }
+
+
+class FairScheduler:
+    """加权公平排队的并发名额调度器"""
+
+    def __init__(self, capacity: int = SCHEDULER_MAX_CONCURRENCY, weights: Optional[Dict[str, float]] = None,
+                 interactive_reserved: int = SCHEDULER_INTERACTIVE_RESERVED,
+                 starvation_seconds: float = SCHEDULER_STARVATION_SECONDS, max_queue: int = SCHEDULER_MAX_QUEUE):
+        """
+        初始化调度器
+
+        Args:
+            capacity: 同时进行中的上游调用数上限，0 表示不调度
+            weights: 各类别的权重
+            interactive_reserved: 为 interactive 保留的名额数
+            starvation_seconds: 类别排队超过该时间仍未领到名额时优先服务
+            max_queue: 每个类别最多排队的请求数，0 表示不限制
+        """
+        weights = weights or SCHEDULER_WEIGHTS
+        self.capacity = capacity
+        self.starvation_seconds = starvation_seconds
+        self.max_queue = max_queue
+        reserved = min(interactive_reserved, capacity - 1) if capacity > 1 else 0
+        self.classes = {
+            name: _ClassState(name, weights.get(name, 1.0), reserved if name == INTERACTIVE else 0)
+            for name in TRAFFIC_CLASSES
+        }
+
+    @property
+    def in_flight(self) -> int:
+        return sum(state.in_flight for state in self.classes.values())
+
+    def _can_run(self, state: _ClassState) -> bool:
+        """该类别现在能否占用一个名额（不能占用其他类别尚未用完的保留名额）"""
+        held_for_others = sum(max(0, other.reserved - other.in_flight)
+                              for other in self.classes.values() if other is not state)
+        return self.capacity - self.in_flight > held_for_others
+
+    def _grant(self, state: _ClassState, waiter: Optional[_Waiter] = None, starved: bool = False):
+        state.in_flight += 1
+        state.granted += 1
+        state.virtual_time += 1.0 / state.weight
+        state.last_granted_at = time.monotonic()
+        if waiter is not None:
+            waited = time.monotonic() - waiter.enqueued_at
+            state.total_wait += waited
+            state.max_wait = max(state.max_wait, waited)
+            if starved:
+                state.starvation_grants += 1
+            waiter.future.set_result(None)
+
+    def _dispatch(self):
+        """把空出的名额分配给排队中的请求"""
+        while self.in_flight < self.capacity:
+            candidates = [state for state in self.classes.values() if state.queue and self._can_run(state)]
+            if not candidates:
+                return
+            # 某个类别排队后超过 starvation_seconds 没有领到名额时先服务它，
+            # 否则选虚拟时间最小（按权重最欠服务）的类别
+            now = time.monotonic()
+            hungriest = max(candidates, key=lambda s: self._unserved_for(s, now))
+            starved = self._unserved_for(hungriest, now) >= self.starvation_seconds
+            state = hungriest if starved else min(candidates, key=lambda s: s.virtual_time)
+            self._grant(state, state.queue.popleft(), starved)
+
+    @staticmethod
+    def _unserved_for(state: _ClassState, now: float) -> float:
+        """类别有请求排队、但一直没有领到名额的时间"""
+        return now - max(state.last_granted_at, state.queue[0].enqueued_at)
+
+    def _activate(self, state: _ClassState):
+        """类别从空闲变为排队时，虚拟时间追上其他活跃类别，不能用空闲期间积累的额度突发"""
+        active = [s.virtual_time for s in self.classes.values() if s is not state and (s.queue or s.in_flight)]
+        if active:
+            state.virtual_time = max(state.virtual_time, min(active))
+
+    async def acquire(self, traffic_class: Optional[str] = None, deadline: Optional[Deadline] = None):
+        """
+        领取一个名额，需要配合 release 使用
+
+        Args:
+            traffic_class: 流量类别，默认使用当前请求的类别
+            deadline: 请求截止时间，排队不会超过剩余时间
+
+        Raises:
+            SchedulerBusy: 排队的请求过多或排队超过 SCHEDULER_MAX_WAIT
+            DeadlineExceeded: 排队期间超过请求截止时间
+        """
+        state = self.classes.get(traffic_class or get_traffic_class(), self.classes[INTERACTIVE])
+        if not state.queue and not state.in_flight:
+            self._activate(state)
+        if not state.queue and self.in_flight < self.capacity and self._can_run(state):
+            self._grant(state)
+            return
+        if self.max_queue and len(state.queue) >= self.max_queue:
+            state.rejected += 1
+            raise SchedulerBusy(f"{state.name} 排队请求过多，请稍后重试")
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future())
+        state.queue.append(waiter)
+        timeout = SCHEDULER_MAX_WAIT if deadline is None else min(SCHEDULER_MAX_WAIT, deadline.remaining())
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 超时或取消与分配名额同时发生：名额已经分配，需要还回去
+                self.release(state.name)
+            else:
+                waiter.future.cancel()
+                state.queue.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            state.rejected += 1
+            if deadline is not None and deadline.remaining() <= 0:
+                raise DeadlineExceeded("排队等待上游名额时超过截止时间")
+            raise SchedulerBusy(f"排队等待超过 {timeout:.0f}s，请稍后重试")
+
+    def release(self, traffic_class: str):
+        """归还名额，并分配给排队中的请求"""
+        self.classes[traffic_class].in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, deadline: Optional[Deadline] = None,
+                   traffic_class: Optional[str] = None) -> AsyncIterator[None]:
+        """以上下文管理器的形式占用一个名额（调度关闭时直接执行）"""
+        if self.capacity <= 0:
+            yield
+            return
+        traffic_class = traffic_class or get_traffic_class()
+        if traffic_class not in self.classes:
+            traffic_class = INTERACTIVE
+        started = time.perf_counter()
+        await self.acquire(traffic_class, deadline)
+        bind_log_fields(queue_ms=round((time.perf_counter() - started) * 1000, 1))
+        try:
+            yield
+        finally:
+            self.release(traffic_class)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """调度器状态：总名额和各类别的排队、等待时间统计"""
+        return {
+            "capacity": self.capacity,
+            "in_flight": self.in_flight,
+            "classes": {name: state.snapshot() for name, state in self.classes.items()},
+        }
+
+
+_scheduler: Optional[FairScheduler] = None
+
+
+def get_scheduler() -> FairScheduler:
+    """获取进程内的调度器单例"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = FairScheduler()
+    return _scheduler
+
+
+class TrafficClassMiddleware:
+    """为每个 HTTP 请求确定流量类别，之后的模型调用按该类别排队"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        traffic_class = classify_request(scope["path"], Headers(scope=scope))
+        bind_log_fields(traffic_class=traffic_class)
+        token = _traffic_class.set(traffic_class)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _traffic_class.reset(token)
@@ -0,0 +1,136 @@
+"""
+跨进程共享缓存
+多 worker 部署时，所有 worker 进程通过同一个 SQLite 文件（WAL 模式）共享缓存和会话状态，
+避免每个进程各自维护一份缓存导致命中率被 worker 数量摊薄
+
+SQLite 调用是同步的（写入时可能等待其他 worker 的写锁），在事件循环中应使用 aget / aset，
+在线程池中执行。过期条目在写入时按 SHARED_CACHE_PURGE_PROBABILITY 的概率顺带清理
+"""
+import json
+import os
+import random
+import asyncio
+import sqlite3
+import threading
+import time
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# 缓存文件路径：Cloud Run 容器内 /tmp 为内存文件系统，同一实例内的所有 worker 可以共享
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "/tmp/deepseek-chat-agent/shared_cache.db")
+# 默认过期时间（秒）
+SHARED_CACHE_DEFAULT_TTL = int(os.getenv("SHARED_CACHE_DEFAULT_TTL", 3600))
+# 每次写入时顺带清理过期条目的概率（0 表示不清理）
+SHARED_CACHE_PURGE_PROBABILITY = float(os.getenv("SHARED_CACHE_PURGE_PROBABILITY", 0.01))
+
+
+class SharedCache:
+    """基于 SQLite WAL 模式的键值缓存，可在多个进程之间共享"""
+
+    def __init__(self, path: str = SHARED_CACHE_PATH, default_ttl: int = SHARED_CACHE_DEFAULT_TTL):
+        """
+        初始化共享缓存
+
+        Args:
+            path: SQLite 数据库文件路径
+            default_ttl: 默认过期时间（秒）
+        """
+        self.path = path
+        self.default_ttl = default_ttl
+        # sqlite3 连接不能跨线程使用，每个线程持有自己的连接
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache (expires_at)")
+        logger.info(f"Shared cache ready at {path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None：自动提交，每条语句即一个短事务，减少写锁持有时间
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+
+        Returns:
+            缓存值，不存在或已过期时返回 None
+        """
+        row = self._connect().execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        """
+        写入缓存
+
+        Args:
+            key: 缓存键
+            value: 可 JSON 序列化的值
+            ttl: 过期时间（秒），默认使用 default_ttl
+        """
+        expires_at = time.time() + (ttl if ttl is not None else self.default_ttl)
+        self._connect().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), expires_at)
+        )
+        if SHARED_CACHE_PURGE_PROBABILITY > 0 and random.random() < SHARED_CACHE_PURGE_PROBABILITY:
+            purged = self.purge_expired()
+            if purged:
+                logger.debug(f"Purged {purged} expired shared cache entries")
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """在线程池中读取缓存（不阻塞事件循环）"""
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Any, ttl: Optional[int] = None):
+        """在线程池中写入缓存（不阻塞事件循环）"""
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    def delete(self, key: str):
+        """删除缓存"""
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def purge_expired(self) -> int:
+        """清理所有过期条目，返回清理数量"""
+        cursor = self._connect().execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        return cursor.rowcount
+
+
+_shared_cache: Optional[SharedCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache() -> SharedCache:
+    """获取进程内的共享缓存单例（底层文件由所有 worker 共享）"""
+    global _shared_cache
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = SharedCache()
+    return _shared_cache
@@ -34,14 +34,73 @@ from dotenv import load_dotenv
 # 加载 .env 文件（必须在检查环境变量之前）
 load_dotenv()
 
-# 配置日志 - 立即输出，不缓冲
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    force=True  # 强制重新配置
-)
+# 配置日志：请求线程只入队，后台线程立即写入 stdout（LOG_FORMAT=text 时使用文本格式）
+from app.structured_logging import configure_logging
+configure_logging()
 logger = logging.getLogger(__name__)
 
+# 启动模式：
+# - gradio（默认）：单进程 Gradio UI
+# - api：多 worker FastAPI 服务
+# - combined：Gradio UI 挂载到 FastAPI 应用，单进程同一端口同时提供 UI 和 API
+APP_MODE = os.getenv("APP_MODE", "gradio").lower()
+
+
+def get_worker_count() -> int:
+    """获取 API 模式的 worker 数量，默认与容器可用 CPU 核数一致"""
+    workers = os.getenv("WEB_CONCURRENCY")
+    if workers:
+        return max(1, int(workers))
+    try:
+        # 遵循容器的 CPU 亲和性限制
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return max(1, os.cpu_count() or 1)
+
+
+def run_api_server(port: int):
+    """
+    以多 worker 模式启动 FastAPI 服务
+
+    各 worker 是独立进程，缓存等共享状态通过 app.shared_cache 的 SQLite 文件共享
+    """
+    import uvicorn
+    workers = get_worker_count()
+    logger.info(f"Launching FastAPI server on 0.0.0.0:{port} with {workers} worker(s)")
+    # 多 worker 模式下 uvicorn 需要以导入字符串的形式加载应用
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+        # 不使用 uvicorn 自带的同步日志配置，日志统一走队列；访问日志由 RequestLoggingMiddleware 输出
+        log_config=None,
+        access_log=False
+    )
+
+
+def run_combined_server(port: int):
+    """
+    以合并模式启动：Gradio UI 挂载在 FastAPI 应用的 GRADIO_MOUNT_PATH 下
+
+    Gradio 的队列和会话状态保存在进程内，因此合并模式固定为单 worker
+    """
+    import uvicorn
+    from app.combined_app import app as combined_app, GRADIO_MOUNT_PATH
+    logger.info(f"Launching combined API + Gradio server on 0.0.0.0:{port} (UI at {GRADIO_MOUNT_PATH})")
+    uvicorn.run(
+        combined_app,
+        host="0.0.0.0",
+        port=port,
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+        # 不使用 uvicorn 自带的同步日志配置，日志统一走队列；访问日志由 RequestLoggingMiddleware 输出
+        log_config=None,
+        access_log=False
+    )
+
 
 def main():
     """主启动函数"""
@@ -49,12 +108,12 @@ def main():
         # 获取端口
         port = int(os.getenv("PORT", 8080))
         logger.info("=" * 50)
-        logger.info("Starting DeepSeek Chat Agent - Gradio UI")
+        logger.info(f"Starting DeepSeek Chat Agent - mode: {APP_MODE}")
         logger.info(f"Port: {port}")
         logger.info("=" * 50)
         
         # 验证环境变量
-        api_key = os.getenv("DEEPSEEK_API_KEY")
+        api_key = os.getenv("DEEPSEEK_API_KEY") or os.getenv("DEEPSEEK_API_KEYS")
         if not api_key:
             logger.error("DEEPSEEK_API_KEY environment variable is not set")
             sys.exit(1)
@@ -63,12 +122,21 @@ def main():
         api_base = os.getenv("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
         logger.info(f"✓ DEEPSEEK_API_BASE: {api_base}")
         
+        if APP_MODE == "api":
+            run_api_server(port)
+            return
+        if APP_MODE == "combined":
+            run_combined_server(port)
+            return
+        
         # 导入并启动 Gradio 应用
         # 直接启动 Gradio，不使用健康检查服务器
         # Gradio 启动后会立即监听端口，满足 Cloud Run 的要求
         logger.info("Importing Gradio app module...")
         try:
             from app.gradio_app import create_demo
+            from app.memory_diagnostics import admin_routes
+            from app.conversation_store import exit_on_sigterm
             logger.info("✓ Gradio module imported successfully")
         except Exception as e:
             logger.error(f"Failed to import Gradio app: {e}", exc_info=True)
@@ -84,6 +152,8 @@ def main():
         
         logger.info(f"Launching Gradio server on 0.0.0.0:{port}")
         logger.info("This may take a few seconds...")
+        # Cloud Run 停止实例时发送 SIGTERM：正常退出，写完对话存储中排队的消息
+        exit_on_sigterm()
         
         # 启动 Gradio - 使用阻塞模式
         # 重要：server_name 必须是 "0.0.0.0" 才能从外部访问
@@ -106,7 +176,8 @@ def main():
             inbrowser=False,
             root_path=root_path,  # 本地开发时不设置，避免 URL 双斜杠问题
             favicon_path=None,  # 禁用 favicon 加载，加快启动
-            quiet=False  # 显示启动信息
+            quiet=False,  # 显示启动信息
+            app_kwargs={"routes": admin_routes()}  # 内存诊断管理接口
         )
         
         # 这行代码不会被执行，因为 launch() 会阻塞
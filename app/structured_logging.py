@@ -0,0 +1,244 @@
+"""
+结构化、非阻塞的日志管道
+- 请求线程只把日志记录放进内存队列，由后台线程格式化并写入 stdout，不在请求路径上做同步 IO
+- 输出 JSON 格式（Cloud Run 按 severity / message 字段解析），附带请求上下文：
+  request_id、路由、延迟、token 数、后端等
+- 成功请求的日志按 LOG_SUCCESS_SAMPLE_RATE 采样（同一请求的日志要么全部保留、要么全部丢弃），
+  WARNING 及以上级别总是保留
+- 队列满时丢弃非错误日志并计数，错误日志仍然入队
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import contextvars
+import logging.handlers
+from typing import Any, Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 日志级别
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 输出格式：json（Cloud Run 结构化日志）或 text（本地开发）
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# 成功请求日志的采样比例（0~1），WARNING 及以上级别不采样
+LOG_SUCCESS_SAMPLE_RATE = float(os.getenv("LOG_SUCCESS_SAMPLE_RATE", 1.0))
+# 日志队列容量，超过后丢弃非错误日志
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# 当前请求的日志上下文（可变字典：流式响应等子任务复制上下文后仍写入同一个字典）
+_log_context: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("log_context", default=None)
+
+# LogRecord 自带的属性，格式化时不作为附加字段输出
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "context"}
+
+
+def _dumps(data: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(data, default=str).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def _record_fields(record: logging.LogRecord) -> Dict[str, Any]:
+    """请求上下文和 extra 传入的附加字段"""
+    fields = dict(getattr(record, "context", None) or {})
+    for key, value in vars(record).items():
+        if key not in _RESERVED_ATTRS and key != "sampled":
+            fields[key] = value
+    return fields
+
+
+def should_sample() -> bool:
+    """按 LOG_SUCCESS_SAMPLE_RATE 决定是否保留一次成功请求的日志"""
+    return LOG_SUCCESS_SAMPLE_RATE >= 1.0 or random.random() < LOG_SUCCESS_SAMPLE_RATE
+
+
+def get_log_context() -> Optional[Dict[str, Any]]:
+    """获取当前请求的日志上下文（不在请求中时为 None）"""
+    return _log_context.get()
+
+
+def bind_log_fields(**fields: Any):
+    """向当前请求的日志上下文添加字段（如 token 数、后端），会出现在之后的日志和请求完成事件中"""
+    context = _log_context.get()
+    if context is not None:
+        context.update(fields)
+
+
+def log_event(logger: logging.Logger, message: str, level: int = logging.INFO, **fields: Any):
+    """
+    记录一条带结构化字段的日志
+
+    不在请求上下文中的成功事件（如 Gradio 对话）单独按采样比例决定是否保留
+
+    Args:
+        logger: 日志记录器
+        message: 事件描述
+        level: 日志级别
+        **fields: 附加字段，JSON 格式下作为顶层字段输出
+    """
+    extra = dict(fields)
+    if level < logging.WARNING and _log_context.get() is None:
+        extra["sampled"] = should_sample()
+    logger.log(level, message, extra=extra)
+
+
+class SamplingFilter(logging.Filter):
+    """丢弃未被采样的成功日志，WARNING 及以上级别总是保留"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        context = _log_context.get()
+        if context is not None:
+            return context.get("sampled", True)
+        return getattr(record, "sampled", True)
+
+
+class JSONFormatter(logging.Formatter):
+    """Cloud Run 结构化日志格式"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": self.formatTime(record),
+            "logger": record.name,
+        }
+        data.update(_record_fields(record))
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return _dumps(data)
+
+
+class TextFormatter(logging.Formatter):
+    """文本格式，附加字段以 JSON 形式附加在行尾"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _record_fields(record)
+        return f"{line} {_dumps(fields)}" if fields else line
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    只做入队的日志处理器
+
+    格式化（包括异常堆栈）在后台线程完成，请求线程只合并消息参数并记录当前请求上下文
+    """
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        context = _log_context.get()
+        record.context = {k: v for k, v in context.items() if k != "sampled"} if context else None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        if record.levelno >= logging.ERROR:
+            # 错误日志不丢弃（出现频率低，队列满时短暂阻塞可以接受）
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging():
+    """
+    配置进程的根日志记录器（可重复调用，只生效一次）
+
+    替代各入口中的 logging.basicConfig：根记录器只挂一个队列处理器，
+    由后台线程写入 stdout
+    """
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_FORMAT))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    # 进程退出前写完队列中剩余的日志
+    atexit.register(_listener.stop)
+
+
+class RequestLoggingMiddleware:
+    """
+    为每个 HTTP 请求建立日志上下文，并在请求结束时输出一条请求完成事件
+
+    request_id 优先使用 X-Request-ID 请求头，其次是 Cloud Run 的 X-Cloud-Trace-Context，
+    并通过 X-Request-ID 响应头返回
+    """
+
+    def __init__(self, app: ASGIApp, logger_name: str = "app.access"):
+        self.app = app
+        self.logger = logging.getLogger(logger_name)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        request_id = (headers.get("x-request-id")
+                      or headers.get("x-cloud-trace-context", "").split("/")[0]
+                      or uuid.uuid4().hex)
+        context = {
+            "request_id": request_id,
+            "route": scope["path"],
+            "method": scope["method"],
+            "sampled": should_sample(),
+        }
+        token = _log_context.set(context)
+        started = time.perf_counter()
+        status = {"code": 500, "first_byte": None}
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            elif message["type"] == "http.response.body" and status["first_byte"] is None:
+                status["first_byte"] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finished = time.perf_counter()
+            code = status["code"]
+            level = logging.ERROR if code >= 500 else logging.WARNING if code >= 400 else logging.INFO
+            fields = {
+                "status": code,
+                "latency_ms": round((finished - started) * 1000, 1),
+            }
+            if status["first_byte"] is not None:
+                fields["ttfb_ms"] = round((status["first_byte"] - started) * 1000, 1)
+            self.logger.log(level, "request completed", extra=fields)
+            _log_context.reset(token)
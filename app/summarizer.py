@@ -0,0 +1,173 @@
+"""
+对话摘要压缩
+长对话超过阈值后，较早的轮次由后台任务压缩成一条摘要消息：
+- 摘要在后台生成，不阻塞当前回复；生成完成后的下一轮对话才开始使用
+- 摘要会被缓存并重复使用，直到新的消息再次超过阈值，再把旧摘要和新的旧消息合并成新摘要
+- 摘要生成失败时保留原消息，内存中的消息数上限（CONVERSATION_MEMORY_MESSAGES）仍然有效
+"""
+import os
+import asyncio
+import logging
+from typing import List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from app.chat_service import ainvoke_chat, estimate_tokens
+from app.scheduler import BATCH, set_traffic_class
+from app.deadline import Deadline
+
+logger = logging.getLogger(__name__)
+
+# 是否启用后台摘要
+CONVERSATION_SUMMARY_ENABLED = os.getenv("CONVERSATION_SUMMARY_ENABLED", "true").lower() == "true"
+# 历史消息估算 token 数超过该值时触发摘要
+CONVERSATION_SUMMARY_TRIGGER_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TRIGGER_TOKENS", 4000))
+# 历史消息数超过该值时触发摘要（应小于 CONVERSATION_MEMORY_MESSAGES，避免消息在摘要前被截断）
+CONVERSATION_SUMMARY_TRIGGER_MESSAGES = int(os.getenv("CONVERSATION_SUMMARY_TRIGGER_MESSAGES", 24))
+# 摘要时保留原文的最近消息数
+CONVERSATION_SUMMARY_KEEP_MESSAGES = int(os.getenv("CONVERSATION_SUMMARY_KEEP_MESSAGES", 6))
+# 摘要的最大 token 数
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", 800))
+# 单次摘要调用的截止时间（秒）
+CONVERSATION_SUMMARY_TIMEOUT = float(os.getenv("CONVERSATION_SUMMARY_TIMEOUT", 60))
+
+SUMMARY_SYSTEM_PROMPT = """你负责压缩一段编程助手与用户的对话。请用中文输出简洁的摘要，保留：
+- 用户的目标、约束和偏好
+- 已确定的方案、关键代码片段（函数名、接口、报错信息）
+- 尚未解决的问题
+不要编造对话中没有的内容。"""
+
+
+def count_tokens(messages: List[BaseMessage]) -> int:
+    """估算消息列表的 token 数"""
+    return sum(estimate_tokens(str(m.content)) for m in messages)
+
+
+def format_transcript(messages: List[BaseMessage]) -> str:
+    """把消息列表转换成摘要用的纯文本对话记录"""
+    lines = []
+    for m in messages:
+        speaker = "用户" if isinstance(m, HumanMessage) else "助手"
+        lines.append(f"{speaker}：{m.content}")
+    return "\n\n".join(lines)
+
+
+class ConversationCompactor:
+    """单个会话的摘要状态：缓存的摘要和进行中的后台摘要任务"""
+
+    def __init__(self, enabled: bool = CONVERSATION_SUMMARY_ENABLED,
+                 trigger_tokens: int = CONVERSATION_SUMMARY_TRIGGER_TOKENS,
+                 trigger_messages: int = CONVERSATION_SUMMARY_TRIGGER_MESSAGES,
+                 keep_messages: int = CONVERSATION_SUMMARY_KEEP_MESSAGES):
+        """
+        初始化摘要状态
+
+        Args:
+            enabled: 是否启用后台摘要
+            trigger_tokens: 触发摘要的 token 阈值
+            trigger_messages: 触发摘要的消息数阈值
+            keep_messages: 摘要时保留原文的最近消息数
+        """
+        self.enabled = enabled
+        self.trigger_tokens = trigger_tokens
+        self.trigger_messages = trigger_messages
+        self.keep_messages = keep_messages
+        self.summary: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+        # 正在被摘要的消息（按对象身份识别，摘要完成后从历史中移除）
+        self._pending: List[BaseMessage] = []
+
+    def summary_messages(self) -> List[BaseMessage]:
+        """返回放在历史最前面的摘要消息（没有摘要时为空列表）"""
+        if not self.summary:
+            return []
+        return [SystemMessage(content=f"以下是本次对话较早部分的摘要：\n{self.summary}")]
+
+    def apply(self, history: List[BaseMessage]) -> List[BaseMessage]:
+        """
+        后台摘要已完成时，用摘要替换被压缩的旧消息
+
+        Args:
+            history: 当前的 LangChain 聊天历史
+
+        Returns:
+            压缩后的聊天历史（摘要未完成时原样返回）
+        """
+        if self._task is None or not self._task.done():
+            return history
+        task, pending = self._task, self._pending
+        self._task, self._pending = None, []
+        # 失败已由 _on_task_done 记录
+        if task.cancelled() or task.exception() is not None:
+            return history
+        self.summary = task.result()
+        pending_ids = {id(m) for m in pending}
+        # 旧消息可能已被消息数上限截断掉一部分，只移除仍在历史中的
+        compacted = [m for m in history if id(m) not in pending_ids]
+        logger.info(f"Compacted {len(history) - len(compacted)} messages into summary "
+                    f"(~{estimate_tokens(self.summary)} tokens)")
+        return compacted
+
+    def maybe_schedule(self, history: List[BaseMessage]):
+        """
+        历史超过阈值时启动后台摘要任务（已有任务在运行时不重复启动）
+
+        Args:
+            history: 当前的 LangChain 聊天历史
+        """
+        if not self.enabled or self._task is not None:
+            return
+        if len(history) <= self.trigger_messages and count_tokens(history) <= self.trigger_tokens:
+            return
+        older = history[:-self.keep_messages] if self.keep_messages else list(history)
+        if not older:
+            return
+        self._pending = list(older)
+        self._task = asyncio.create_task(summarize(self._pending, self.summary))
+        self._task.add_done_callback(self._on_task_done)
+
+    @staticmethod
+    def _on_task_done(task: asyncio.Task):
+        """
+        读取摘要任务的异常并记录日志
+
+        任务可能被 reset 丢弃、或会话不再使用而没有调用 apply，在这里读取异常，
+        避免 asyncio 报告 "Task exception was never retrieved"
+        """
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.warning(f"Conversation summary failed: {error}")
+
+    def reset(self):
+        """丢弃摘要并取消进行中的摘要任务（开始新会话时调用）"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self.summary = None
+        self._task = None
+        self._pending = []
+
+
+async def summarize(messages: List[BaseMessage], previous_summary: Optional[str] = None) -> str:
+    """
+    把较早的对话（以及之前的摘要）压缩成一段摘要
+
+    Args:
+        messages: 要压缩的消息
+        previous_summary: 之前的摘要
+
+    Returns:
+        新的摘要文本
+    """
+    # 后台摘要按批量流量排队，不和交互请求争抢上游名额（摘要在独立任务中运行，不影响调用方）
+    set_traffic_class(BATCH)
+    transcript = format_transcript(messages)
+    if previous_summary:
+        transcript = f"之前的摘要：\n{previous_summary}\n\n之后的对话：\n{transcript}"
+    return await ainvoke_chat(
+        [SystemMessage(content=SUMMARY_SYSTEM_PROMPT), HumanMessage(content=transcript)],
+        temperature=0.3,
+        max_tokens=CONVERSATION_SUMMARY_MAX_TOKENS,
+        deadline=Deadline(CONVERSATION_SUMMARY_TIMEOUT)
+    )
@@ -0,0 +1,255 @@
+"""
+Agent 可调用的本地工具
+- Tool：工具名称、说明、参数 JSON Schema、实现函数和超时
+- ToolRegistry：按名称注册和查找工具，生成传给模型的工具定义
+- 内置工具：python（在 bubblewrap 沙箱中执行代码，默认关闭）、current_time
+"""
+import os
+import sys
+import signal
+import shutil
+import asyncio
+import inspect
+import logging
+import threading
+import subprocess
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 单个工具调用的默认超时（秒）
+AGENT_TOOL_TIMEOUT = float(os.getenv("AGENT_TOOL_TIMEOUT", 10))
+# 是否启用 python 工具（执行模型生成的代码，默认关闭；启用后沙箱不可用时仍然不会注册）
+AGENT_PYTHON_ENABLED = os.getenv("AGENT_PYTHON_ENABLED", "false").lower() == "true"
+# python 工具子进程的内存上限（MB）
+AGENT_PYTHON_MEMORY_MB = int(os.getenv("AGENT_PYTHON_MEMORY_MB", 256))
+# bubblewrap 可执行文件（沙箱：无网络、只读文件系统、独立的 PID / IPC / 用户命名空间）
+AGENT_PYTHON_BWRAP = os.getenv("AGENT_PYTHON_BWRAP", "bwrap")
+# 沙箱内运行代码的用户和组 ID；服务以 root 运行时在进入沙箱前切换到该用户
+AGENT_PYTHON_UID = int(os.getenv("AGENT_PYTHON_UID", 65534))
+# 沙箱内单个文件的大小上限（字节）
+AGENT_PYTHON_MAX_FILE_BYTES = 10 * 1024 * 1024
+# 工具输出返回给模型的最大字符数
+AGENT_TOOL_OUTPUT_LIMIT = int(os.getenv("AGENT_TOOL_OUTPUT_LIMIT", 4000))
+
+
+class Tool:
+    """一个可供模型调用的本地工具"""
+
+    def __init__(self, name: str, description: str, parameters: Dict[str, Any],
+                 func: Callable[..., Any], timeout: float = AGENT_TOOL_TIMEOUT):
+        """
+        Args:
+            name: 工具名称（模型调用时使用）
+            description: 工具说明（告诉模型何时使用）
+            parameters: 参数的 JSON Schema
+            func: 实现函数，可以是同步或异步函数，参数与 parameters 对应，返回文本结果
+            timeout: 单次调用超时（秒）
+        """
+        self.name = name
+        self.description = description
+        self.parameters = parameters
+        self.func = func
+        self.timeout = timeout
+
+    def schema(self) -> Dict[str, Any]:
+        """OpenAI function calling 格式的工具定义"""
+        return {
+            "type": "function",
+            "function": {
+                "name": self.name,
+                "description": self.description,
+                "parameters": self.parameters,
+            }
+        }
+
+    async def run(self, arguments: Dict[str, Any]) -> str:
+        """执行工具（同步函数在线程池中运行，不阻塞事件循环）"""
+        if inspect.iscoroutinefunction(self.func):
+            result = await self.func(**arguments)
+        else:
+            result = await asyncio.to_thread(self.func, **arguments)
+        return truncate_output(str(result))
+
+
+class ToolRegistry:
+    """工具注册表"""
+
+    def __init__(self, tools: Optional[List[Tool]] = None):
+        self._tools: Dict[str, Tool] = {}
+        for tool in tools or []:
+            self.register(tool)
+
+    def register(self, tool: Tool):
+        """注册工具（同名工具会被覆盖）"""
+        self._tools[tool.name] = tool
+
+    def get(self, name: str) -> Optional[Tool]:
+        """按名称查找工具"""
+        return self._tools.get(name)
+
+    def names(self) -> List[str]:
+        return list(self._tools)
+
+    def schemas(self) -> List[Dict[str, Any]]:
+        """全部工具的定义（传给模型的 tools 参数）"""
+        return [tool.schema() for tool in self._tools.values()]
+
+
+def truncate_output(text: str, limit: int = AGENT_TOOL_OUTPUT_LIMIT) -> str:
+    """截断过长的工具输出，避免占满上下文"""
+    if len(text) <= limit:
+        return text
+    return text[:limit] + f"\n...（输出过长，已截断 {len(text) - limit} 个字符）"
+
+
+def sandbox_command(code: str) -> List[str]:
+    """
+    在沙箱中执行代码的完整命令
+
+    - prlimit：限制 CPU 时间、内存、文件大小和打开文件数，不产生 core dump
+      （用外部命令设置 rlimit，不在多线程的服务进程中使用 preexec_fn）
+    - setpriv：服务以 root 运行时切换到 AGENT_PYTHON_UID，沙箱内外都不是服务的用户
+    - bwrap：新的网络（没有任何网卡）、PID、IPC、UTS、cgroup 和用户命名空间；只读挂载系统目录和
+      Python 安装目录，/proc 只包含沙箱内的进程，看不到服务进程的环境变量；/tmp 为空的 tmpfs；
+      清空环境变量、去掉所有 capability，服务退出时沙箱随之退出
+    """
+    cpu_seconds = int(AGENT_TOOL_TIMEOUT) + 1
+    memory = AGENT_PYTHON_MEMORY_MB * 1024 * 1024
+    # 子进程的环境变量为空（没有 PATH），使用绝对路径
+    command = [
+        shutil.which("prlimit") or "prlimit", f"--cpu={cpu_seconds}", f"--as={memory}", f"--fsize={AGENT_PYTHON_MAX_FILE_BYTES}",
+        "--core=0", "--nofile=64", "--",
+    ]
+    if os.geteuid() == 0:
+        command += [shutil.which("setpriv") or "setpriv", f"--reuid={AGENT_PYTHON_UID}", f"--regid={AGENT_PYTHON_UID}", "--clear-groups", "--"]
+    command += [
+        shutil.which(AGENT_PYTHON_BWRAP) or AGENT_PYTHON_BWRAP,
+        "--unshare-all", "--unshare-user",
+        "--uid", str(AGENT_PYTHON_UID), "--gid", str(AGENT_PYTHON_UID),
+        "--die-with-parent", "--new-session", "--cap-drop", "ALL",
+        "--clearenv", "--setenv", "PATH", "/usr/local/bin:/usr/bin:/bin", "--setenv", "HOME", "/tmp",
+        "--ro-bind", "/usr", "/usr",
+        "--ro-bind-try", "/bin", "/bin",
+        "--ro-bind-try", "/lib", "/lib",
+        "--ro-bind-try", "/lib64", "/lib64",
+        "--proc", "/proc",
+        "--dev", "/dev",
+        "--tmpfs", "/tmp",
+    ]
+    # 虚拟环境或非标准位置安装的 Python（在 /tmp 之后挂载，位于 /tmp 下时也不会被 tmpfs 覆盖）
+    for prefix in dict.fromkeys([sys.base_prefix, sys.prefix, os.path.dirname(os.path.dirname(sys.executable))]):
+        if not prefix.startswith("/usr/"):
+            command += ["--ro-bind-try", prefix, prefix]
+    command += ["--chdir", "/tmp", "--", sys.executable, "-I", "-c", code]
+    return command
+
+
+def sandbox_available() -> bool:
+    """沙箱能否正常启动（缺少 bwrap / prlimit，或内核不允许创建命名空间时返回 False）"""
+    required = [AGENT_PYTHON_BWRAP, "prlimit"] + (["setpriv"] if os.geteuid() == 0 else [])
+    missing = [name for name in required if shutil.which(name) is None]
+    if missing:
+        logger.error(f"python tool disabled: {', '.join(missing)} not found")
+        return False
+    try:
+        result = subprocess.run(sandbox_command("pass"), stdin=subprocess.DEVNULL, capture_output=True,
+                                timeout=AGENT_TOOL_TIMEOUT, start_new_session=True)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"python tool disabled: sandbox failed to start: {e}")
+        return False
+    if result.returncode != 0:
+        logger.error(f"python tool disabled: sandbox failed to start: "
+                     f"{result.stderr.decode('utf-8', errors='replace').strip()}")
+        return False
+    return True
+
+
+async def run_python(code: str) -> str:
+    """
+    在沙箱中执行 Python 代码，返回标准输出和错误输出
+
+    沙箱的隔离方式见 sandbox_command；子进程在独立的会话中运行，超时或请求被取消时杀掉整个进程组
+    """
+    process = await asyncio.create_subprocess_exec(
+        *sandbox_command(code),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        env={},
+        start_new_session=True
+    )
+    try:
+        output, _ = await process.communicate()
+    finally:
+        # 超时或请求被取消时 communicate 被中断，需要杀掉子进程
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+    text = output.decode("utf-8", errors="replace")
+    if process.returncode != 0:
+        text += f"\n[exit code {process.returncode}]"
+    return text or "（没有输出，请使用 print 输出结果）"
+
+
+def current_time(tz_offset_hours: float = 8) -> str:
+    """返回当前时间（默认东八区）"""
+    tz = timezone(timedelta(hours=tz_offset_hours))
+    return datetime.now(tz).isoformat(timespec="seconds")
+
+
+def create_default_registry() -> ToolRegistry:
+    """创建包含内置工具的注册表"""
+    registry = ToolRegistry()
+    if AGENT_PYTHON_ENABLED and sandbox_available():
+        registry.register(Tool(
+            name="python",
+            description="执行一段 Python 代码并返回 print 的输出。用于验证代码、计算和数据处理。"
+                        "每次调用都是全新的进程，不保留状态。",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "code": {"type": "string", "description": "要执行的 Python 代码，用 print 输出结果"}
+                },
+                "required": ["code"]
+            },
+            func=run_python
+        ))
+    registry.register(Tool(
+        name="current_time",
+        description="获取当前日期和时间",
+        parameters={
+            "type": "object",
+            "properties": {
+                "tz_offset_hours": {"type": "number", "description": "时区相对 UTC 的小时数，默认 8（北京时间）"}
+            }
+        },
+        func=current_time,
+        timeout=1
+    ))
+    return registry
+
+
+_registry: Optional[ToolRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_tool_registry() -> ToolRegistry:
+    """获取进程内的默认工具注册表单例（首次创建时可能要试运行沙箱，会阻塞）"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = create_default_registry()
+    return _registry
+
+
+async def aget_tool_registry() -> ToolRegistry:
+    """在线程池中获取默认工具注册表（首次创建时试运行沙箱，不阻塞事件循环）"""
+    if _registry is not None:
+        return _registry
+    return await asyncio.to_thread(get_tool_registry)
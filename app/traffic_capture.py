@@ -0,0 +1,207 @@
+"""
+线上流量采集
+记录聊天请求的“形状”（不记录任何消息内容），供 app.traffic_replay 按原始节奏回放做容量测试：
+- 到达时间、路由、流量类别、请求头中的超时
+- 每条消息的角色和字符数、temperature / max_tokens 等参数
+- 响应状态码、延迟、首字节时间、prompt / completion token 数
+
+每个请求一行紧凑 JSON（JSON Lines），由后台线程写入文件。请求结束时先把请求体转换为形状（解析一次 JSON，
+相比请求本身的开销很小），队列中只保存几百字节的形状记录，不保存原始请求体，排队再多也不会占用大量内存。
+队列满时丢弃记录并计数，不影响请求。
+
+记录格式示例：
+{"t":1760870000.123,"r":"/api/chat/stream","c":"interactive","m":[["s",20],["u",1200],["a",800],["u",60]],
+ "p":{"temperature":0.7,"max_tokens":2000},"s":200,"ms":5400.2,"fb":800.1,"pt":520,"ct":210}
+"""
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.structured_logging import get_log_context
+
+logger = logging.getLogger(__name__)
+
+# 采集文件路径，为空时不采集（多 worker 部署时路径中可以使用 {pid}，每个进程写自己的文件）
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+# 采集比例（0~1）
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE_RATE", 1.0))
+# 采集的路由
+TRAFFIC_CAPTURE_ROUTES = {
+    route.strip() for route in
+    os.getenv("TRAFFIC_CAPTURE_ROUTES", "/api/chat,/api/chat/simple,/api/chat/stream,/api/agent,/api/chat/sample").split(",")
+    if route.strip()
+}
+# 请求体超过该大小（字节）时不再缓存，只记录大小
+TRAFFIC_CAPTURE_MAX_BODY = int(os.getenv("TRAFFIC_CAPTURE_MAX_BODY", 1024 * 1024))
+# 待写入记录的队列容量，超过后丢弃
+TRAFFIC_CAPTURE_QUEUE_SIZE = int(os.getenv("TRAFFIC_CAPTURE_QUEUE_SIZE", 10000))
+
+# 消息角色的缩写
+ROLE_CODES = {"system": "s", "user": "u", "assistant": "a", "tool": "t"}
+# 记录的请求参数
+CAPTURED_PARAMS = ("temperature", "max_tokens", "max_steps", "n", "temperatures", "scorers", "return_all", "stream")
+
+
+def request_shape(route: str, body: Optional[bytes], query_string: bytes) -> Dict[str, Any]:
+    """
+    把请求转换为脱敏后的形状：消息只保留角色和字符数
+
+    Args:
+        route: 请求路径
+        body: 请求体（超过 TRAFFIC_CAPTURE_MAX_BODY 时为 None）
+        query_string: 查询字符串
+
+    Returns:
+        {"m": [[角色, 字符数], ...], "p": {参数}}，请求体无法解析时只有 "b"（请求体字节数）
+    """
+    if route == "/api/chat/simple":
+        user_input = parse_qs(query_string.decode("latin-1")).get("user_input", [""])[0]
+        return {"m": [["u", len(user_input)]], "p": {}}
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("messages"), list):
+        return {"b": len(body) if body is not None else TRAFFIC_CAPTURE_MAX_BODY}
+    messages = [
+        [ROLE_CODES.get(m.get("role"), "u"), len(str(m.get("content") or ""))]
+        for m in data["messages"] if isinstance(m, dict)
+    ]
+    params = {key: data[key] for key in CAPTURED_PARAMS if data.get(key) is not None}
+    return {"m": messages, "p": params}
+
+
+class TrafficRecorder:
+    """在后台线程中把采集记录追加写入 JSON Lines 文件"""
+
+    def __init__(self, path: str, queue_size: int = TRAFFIC_CAPTURE_QUEUE_SIZE):
+        self.path = path.format(pid=os.getpid())
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=queue_size)
+        self.captured = 0
+        self.dropped = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def record(self, entry: Dict[str, Any]):
+        """提交一条记录（不阻塞，队列满时丢弃）"""
+        if self._thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+                self._thread.start()
+                logger.info("Capturing traffic shapes to %s", self.path)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                entry = self.queue.get()
+                try:
+                    f.write(self._format(entry))
+                    self.captured += 1
+                except Exception as e:
+                    logger.warning("Failed to write traffic capture record: %s", e)
+                # 队列空闲时再 flush，突发时合并写入
+                if self.queue.empty():
+                    f.flush()
+
+    @staticmethod
+    def _format(entry: Dict[str, Any]) -> str:
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"path": self.path, "captured": self.captured, "dropped": self.dropped, "queued": self.queue.qsize()}
+
+
+_recorder: Optional[TrafficRecorder] = None
+
+
+def get_traffic_recorder() -> Optional[TrafficRecorder]:
+    """获取进程内的采集器单例（未配置 TRAFFIC_CAPTURE_PATH 时为 None）"""
+    global _recorder
+    if _recorder is None and TRAFFIC_CAPTURE_PATH:
+        _recorder = TrafficRecorder(TRAFFIC_CAPTURE_PATH)
+    return _recorder
+
+
+class TrafficCaptureMiddleware:
+    """
+    采集聊天请求的形状
+
+    需要放在 RequestLoggingMiddleware 内层：token 数等响应信息从请求的日志上下文中读取
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        recorder = get_traffic_recorder()
+        if (recorder is None or scope["type"] != "http" or scope["method"] != "POST"
+                or scope["path"] not in TRAFFIC_CAPTURE_ROUTES
+                or (TRAFFIC_CAPTURE_SAMPLE_RATE < 1.0 and random.random() >= TRAFFIC_CAPTURE_SAMPLE_RATE)):
+            await self.app(scope, receive, send)
+            return
+
+        arrived = time.time()
+        started = time.perf_counter()
+        body = bytearray()
+        state = {"status": 500, "first_byte": None, "overflow": False}
+
+        async def receive_wrapper() -> Message:
+            message = await receive()
+            if message["type"] == "http.request" and not state["overflow"]:
+                body.extend(message.get("body", b""))
+                if len(body) > TRAFFIC_CAPTURE_MAX_BODY:
+                    state["overflow"] = True
+                    body.clear()
+            return message
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body" and state["first_byte"] is None:
+                state["first_byte"] = time.perf_counter()
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            finished = time.perf_counter()
+            context = get_log_context() or {}
+            headers = Headers(scope=scope)
+            entry = {
+                "t": round(arrived, 3),
+                "r": scope["path"],
+                "s": state["status"],
+                "ms": round((finished - started) * 1000, 1),
+            }
+            # 在这里就转换为形状，原始请求体随请求一起释放，不进入队列
+            entry.update(request_shape(
+                scope["path"], None if state["overflow"] else bytes(body), scope.get("query_string", b"")
+            ))
+            body.clear()
+            if state["first_byte"] is not None:
+                entry["fb"] = round((state["first_byte"] - started) * 1000, 1)
+            if "x-request-timeout" in headers:
+                entry["to"] = headers["x-request-timeout"]
+            for field, key in (("traffic_class", "c"), ("prompt_tokens", "pt"), ("completion_tokens", "ct"),
+                               ("cache_hit", "hit"), ("cancelled", "x")):
+                if context.get(field) is not None:
+                    entry[key] = context[field]
+            recorder.record(entry)
@@ -0,0 +1,254 @@
+"""
+按采集的流量回放请求（容量测试）
+读取 app.traffic_capture 写出的 JSON Lines 文件，按原始到达间隔（可加速）向目标服务发送形状相同的请求：
+消息条数、角色、每条消息的长度、参数、流量类别和超时都与原始请求一致，内容为填充文本。
+请求按时间表发出，不等待前一个请求完成（开环），能复现原始流量的突发。
+
+用法：
+    # 按 4 倍速回放到本地服务
+    python -m app.traffic_replay replay capture.jsonl --target http://localhost:8080 --speed 4
+
+    # 启动模拟上游（OpenAI 兼容接口，按给定速度生成填充内容，不消耗真实 API 额度），
+    # 服务端配置 DEEPSEEK_API_BASE=http://localhost:9100/v1 后回放
+    python -m app.traffic_replay stub --port 9100
+    python -m app.traffic_replay replay capture.jsonl --target http://localhost:8080 --match-completions
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from app.traffic_capture import ROLE_CODES
+
+ROLES = {code: role for role, code in ROLE_CODES.items()}
+# 填充文本（中英文混合，长度按字符数截取）
+FILLER = "请解释下面这段代码的作用并给出优化建议。The quick brown fox jumps over the lazy dog. "
+
+
+def load_records(path: str, routes: Optional[List[str]] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """读取采集记录，按到达时间排序（跳过无法还原消息的记录）"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "m" not in record or (routes and record.get("r") not in routes):
+                continue
+            records.append(record)
+    records.sort(key=lambda r: r["t"])
+    return records[:limit] if limit else records
+
+
+def filler_text(length: int, seed: int) -> str:
+    """生成指定长度的填充文本（每个请求带不同前缀，避免命中回复缓存）"""
+    text = f"[{seed}] "
+    repeat = length // len(FILLER) + 1
+    return (text + FILLER * repeat)[:max(length, 1)]
+
+
+def build_request(record: Dict[str, Any], seed: int, match_completions: bool = False) -> Dict[str, Any]:
+    """
+    把采集记录还原为 httpx 请求参数
+
+    Args:
+        record: 采集记录
+        seed: 请求序号
+        match_completions: 用原始回复的 token 数作为 max_tokens（配合模拟上游复现回复长度）
+    """
+    route = record["r"]
+    headers = {}
+    if record.get("c"):
+        headers["X-Traffic-Class"] = record["c"]
+    if record.get("to"):
+        headers["X-Request-Timeout"] = str(record["to"])
+    if route == "/api/chat/simple":
+        return {"url": route, "params": {"user_input": filler_text(record["m"][0][1], seed)}, "headers": headers}
+    body = dict(record.get("p") or {})
+    body["messages"] = [
+        {"role": ROLES.get(code, "user"), "content": filler_text(length, seed)}
+        for code, length in record["m"]
+    ]
+    if match_completions and record.get("ct"):
+        body["max_tokens"] = max(1, min(int(record["ct"]), 5000))
+    return {"url": route, "json": body, "headers": headers}
+
+
+async def send_one(client: httpx.AsyncClient, record: Dict[str, Any], seed: int,
+                   scheduled: float, match_completions: bool) -> Dict[str, Any]:
+    """发送一个请求，记录状态码、延迟、首个数据块的时间和调度延迟"""
+    request = build_request(record, seed, match_completions)
+    started = time.perf_counter()
+    result = {"route": record["r"], "lag": started - scheduled, "status": None, "error": None, "first_byte": None}
+    try:
+        async with client.stream("POST", **request) as response:
+            result["status"] = response.status_code
+            async for chunk in response.aiter_bytes():
+                if result["first_byte"] is None and chunk:
+                    result["first_byte"] = time.perf_counter() - started
+                if b'"error"' in chunk and record["r"] == "/api/chat/stream":
+                    result["error"] = "stream error event"
+    except Exception as e:
+        result["error"] = e.__class__.__name__
+    result["latency"] = time.perf_counter() - started
+    return result
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> str:
+    """按路由汇总延迟分位数、状态码和错误数"""
+    lines = [f"{len(results)} requests in {elapsed:.1f}s ({len(results) / max(elapsed, 1e-9):.1f} req/s), "
+             f"max schedule lag {max((r['lag'] for r in results), default=0) * 1000:.0f}ms"]
+    routes = sorted({r["route"] for r in results})
+    for route in routes:
+        group = [r for r in results if r["route"] == route]
+        latencies = [r["latency"] for r in group if r["status"] == 200 and not r["error"]]
+        first_bytes = [r["first_byte"] for r in group if r["first_byte"] is not None]
+        statuses: Dict[str, int] = {}
+        for r in group:
+            key = str(r["status"]) if r["status"] is not None else r["error"]
+            statuses[key] = statuses.get(key, 0) + 1
+        lines.append(
+            f"{route}: n={len(group)} ok={len(latencies)} "
+            f"p50={percentile(latencies, 50):.2f}s p95={percentile(latencies, 95):.2f}s "
+            f"p99={percentile(latencies, 99):.2f}s ttfb_p50={percentile(first_bytes, 50):.2f}s "
+            f"ttfb_p95={percentile(first_bytes, 95):.2f}s status={statuses}"
+        )
+    return "\n".join(lines)
+
+
+async def replay(records: List[Dict[str, Any]], target: str, speed: float = 1.0, timeout: float = 300,
+                 match_completions: bool = False) -> List[Dict[str, Any]]:
+    """
+    按原始到达间隔（除以 speed）回放请求
+
+    Args:
+        records: 采集记录（按到达时间排序）
+        target: 目标服务地址
+        speed: 回放倍速
+        timeout: 单个请求的超时（秒）
+        match_completions: 用原始回复的 token 数作为 max_tokens
+
+    Returns:
+        每个请求的结果
+    """
+    if not records:
+        return []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    async with httpx.AsyncClient(base_url=target, timeout=timeout, limits=limits) as client:
+        origin = records[0]["t"]
+        start = time.perf_counter()
+        tasks = []
+        for seed, record in enumerate(records):
+            scheduled = start + (record["t"] - origin) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send_one(client, record, seed, scheduled, match_completions)))
+        return await asyncio.gather(*tasks)
+
+
+def create_stub_app(first_token_seconds: float = 0.5, tokens_per_second: float = 30.0, reply_tokens: int = 300):
+    """
+    模拟上游：OpenAI 兼容的 /v1/chat/completions
+
+    回复长度为 reply_tokens 和请求 max_tokens 中较小的一个（回放时使用 --match-completions
+    即可按原始回复长度生成）。每个 token 为 4 个字符（与 estimate_tokens 的估算一致），按给定速度逐个输出
+    """
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    async def completions(request: Request):
+        data = await request.json()
+        tokens = min(int(data.get("max_tokens") or reply_tokens), reply_tokens)
+        prompt_tokens = sum(len(str(m.get("content") or "")) for m in data.get("messages", [])) // 4
+        created = int(time.time())
+        chunk_meta = {"id": "stub", "created": created, "model": data.get("model", "stub")}
+
+        if not data.get("stream"):
+            await asyncio.sleep(first_token_seconds + tokens / tokens_per_second)
+            return JSONResponse({
+                **chunk_meta,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "stub" * tokens},
+                             "finish_reason": "length"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": tokens,
+                          "total_tokens": prompt_tokens + tokens},
+            })
+
+        async def stream():
+            await asyncio.sleep(first_token_seconds)
+            for i in range(tokens):
+                delta = {"role": "assistant", "content": "stub"} if i == 0 else {"content": "stub"}
+                event = {**chunk_meta, "object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                yield f"data: {json.dumps(event)}\n\n"
+                await asyncio.sleep(1 / tokens_per_second)
+            event = {**chunk_meta, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "length"}]}
+            yield f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+
+
+def main(argv: List[str]):
+    parser = argparse.ArgumentParser(prog="python -m app.traffic_replay", description="按采集的流量回放请求")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser("replay", help="回放采集的请求")
+    replay_parser.add_argument("capture", help="采集文件（TRAFFIC_CAPTURE_PATH）")
+    replay_parser.add_argument("--target", default="http://localhost:8080", help="目标服务地址")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="回放倍速")
+    replay_parser.add_argument("--routes", help="只回放这些路由（逗号分隔）")
+    replay_parser.add_argument("--limit", type=int, help="最多回放的请求数")
+    replay_parser.add_argument("--timeout", type=float, default=300, help="单个请求的超时（秒）")
+    replay_parser.add_argument("--match-completions", action="store_true",
+                               help="用原始回复的 token 数作为 max_tokens（配合模拟上游复现回复长度）")
+    replay_parser.add_argument("--output", help="把每个请求的结果写入 JSON Lines 文件")
+
+    stub_parser = commands.add_parser("stub", help="启动模拟上游")
+    stub_parser.add_argument("--host", default="127.0.0.1")
+    stub_parser.add_argument("--port", type=int, default=9100)
+    stub_parser.add_argument("--first-token", type=float, default=0.5, help="首 token 延迟（秒）")
+    stub_parser.add_argument("--tokens-per-second", type=float, default=30.0, help="每秒生成的 token 数")
+    stub_parser.add_argument("--reply-tokens", type=int, default=300, help="回复的最大 token 数")
+
+    args = parser.parse_args(argv)
+    if args.command == "stub":
+        import uvicorn
+        uvicorn.run(create_stub_app(args.first_token, args.tokens_per_second, args.reply_tokens),
+                    host=args.host, port=args.port, log_level="warning")
+        return
+
+    records = load_records(args.capture, args.routes.split(",") if args.routes else None, args.limit)
+    if not records:
+        print("没有可回放的记录")
+        return
+    span = records[-1]["t"] - records[0]["t"]
+    print(f"回放 {len(records)} 个请求，原始时长 {span:.1f}s，{args.speed}x 预计 {span / args.speed:.1f}s")
+    started = time.perf_counter()
+    results = asyncio.run(replay(records, args.target, args.speed, args.timeout, args.match_completions))
+    print(summarize(results, time.perf_counter() - started))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
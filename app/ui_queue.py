@@ -0,0 +1,44 @@
+"""
+Gradio 队列与并发配置
+gradio_app.py 和 gradio_app_api.py 共用，保证多用户同时访问时的并发上限和排队行为可预期
+"""
+import os
+
+import gradio as gr
+
+# 聊天事件共用的并发组：所有聊天按钮/回车提交共享同一个并发上限
+CHAT_CONCURRENCY_ID = "chat"
+# 同时进行中的聊天请求数上限（异步处理函数不占用线程，可以设置得比较大）
+CHAT_CONCURRENCY_LIMIT = int(os.getenv("GRADIO_CHAT_CONCURRENCY_LIMIT", 32))
+# 其他事件（清空、状态检查等）的默认并发上限
+DEFAULT_CONCURRENCY_LIMIT = int(os.getenv("GRADIO_DEFAULT_CONCURRENCY_LIMIT", 8))
+# 排队的最大请求数，超过后新请求直接提示繁忙，0 表示不限制
+MAX_QUEUE_SIZE = int(os.getenv("GRADIO_MAX_QUEUE_SIZE", 128))
+
+
+def chat_event_options() -> dict:
+    """聊天事件的公共参数：加入 chat 并发组，并显示排队位置和预计等待时间"""
+    return {
+        "concurrency_id": CHAT_CONCURRENCY_ID,
+        "concurrency_limit": CHAT_CONCURRENCY_LIMIT,
+        "show_progress": "full",
+    }
+
+
+def configure_queue(demo: gr.Blocks) -> gr.Blocks:
+    """
+    启用 Gradio 队列
+
+    队列启用后，排队中的用户会在界面上看到自己的排队位置和预计等待时间
+
+    Args:
+        demo: Gradio Blocks 实例
+
+    Returns:
+        配置好队列的 Blocks 实例
+    """
+    return demo.queue(
+        default_concurrency_limit=DEFAULT_CONCURRENCY_LIMIT,
+        max_size=MAX_QUEUE_SIZE or None,
+        status_update_rate="auto",
+    )